@@ -105,4 +105,63 @@ export const automaticCheckIn = asyncErrorHandler(async (req: Request, res: Resp
     };
 
     return res.status(201).json({ response });
-}); 
\ No newline at end of file
+});
+
+const MONGO_ID = /^[a-f\d]{24}$/i;
+
+// Same checks as automaticCheckInValidationRules, applied to one bulk item
+const automaticCheckInError = (checkIn: any): string | null => {
+    if (!checkIn || typeof checkIn !== "object") return "Invalid check-in";
+    const { studentId, sessionId, location, confidence, timestamp } = checkIn;
+    if (typeof studentId !== "string" || !MONGO_ID.test(studentId)) return "Invalid student ID";
+    if (typeof sessionId !== "string" || !MONGO_ID.test(sessionId)) return "Invalid session ID";
+    if (typeof location !== "string") return "Invalid location";
+    if (typeof confidence !== "number" || confidence < 0 || confidence > 1) return "Invalid confidence score";
+    if (typeof timestamp !== "string" || Number.isNaN(Date.parse(timestamp))) return "Invalid timestamp";
+    return null;
+};
+
+export const automaticBulkCheckIn = asyncErrorHandler(async (req: Request, res: Response) => {
+    const { checkIns } = req.body;
+    const results = [];
+
+    // Processed in order so duplicate and rate-limit checks behave as they do for single check-ins
+    for (const checkIn of checkIns) {
+        const { studentId, sessionId, location, confidence, timestamp } = checkIn ?? {};
+        const error = automaticCheckInError(checkIn);
+        if (error) {
+            results.push({ studentId, sessionId, status: false, message: error });
+            continue;
+        }
+        try {
+            const log = await handleAutomaticCheckIn({
+                studentId,
+                sessionId,
+                location,
+                confidence,
+                timestamp: new Date(timestamp)
+            });
+            results.push({ studentId, sessionId, status: true, log });
+        } catch (error) {
+            results.push({
+                studentId,
+                sessionId,
+                status: false,
+                message: error instanceof Error ? error.message : "Failed to process check-in"
+            });
+        }
+    }
+
+    const succeeded = results.filter((result) => result.status).length;
+    const response: IResponseDTO = {
+        status: true,
+        data: {
+            results,
+            succeeded,
+            failed: results.length - succeeded
+        },
+        message: "Automatic bulk check-in processed"
+    };
+
+    return res.status(200).json({ response });
+});
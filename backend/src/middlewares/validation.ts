@@ -22,6 +22,12 @@ export const automaticCheckInValidationRules = [
     body('timestamp').isISO8601().withMessage('Invalid timestamp')
 ];
 
+// Items are validated one by one in the controller so that a single bad
+// check-in is reported in its result instead of rejecting the whole batch
+export const automaticBulkCheckInValidationRules = [
+    body('checkIns').isArray({ min: 1, max: 500 }).withMessage('checkIns must be an array of 1 to 500 check-ins')
+];
+
 export const sessionIdValidationRules = [
     param('sessionId').isMongoId().withMessage('Invalid session ID')
 ];
@@ -8,6 +8,7 @@ import {
     sessionIdValidationRules,
     studentClassValidationRules,
     automaticCheckInValidationRules,
+    automaticBulkCheckInValidationRules,
     validationErrorHandler
 } from "../../middlewares/index.js";
 import {
@@ -16,7 +17,8 @@ import {
     studentCheckIn,
     getAttendance,
     getStudentAttendanceHistory,
-    automaticCheckIn
+    automaticCheckIn,
+    automaticBulkCheckIn
 } from "../../controllers/attendance_controller.js";
 import {
     getClassAttendanceReport,
@@ -136,4 +138,14 @@ router.post("/auto-checkin",
     automaticCheckIn
 );
 
+/**
+ * Handles a batch of automatic check-ins from the ml service in one request
+ */
+router.post("/auto-checkin/bulk",
+    sessionMiddleware,
+    automaticBulkCheckInValidationRules,
+    validationErrorHandler,
+    automaticBulkCheckIn
+);
+
 export default router; 
\ No newline at end of file
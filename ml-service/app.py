@@ -1,19 +1,28 @@
-from fastapi import FastAPI, HTTPException, Depends, File, UploadFile, WebSocket
+from fastapi import FastAPI, HTTPException, Depends, Request, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 import uvicorn
 import os
 from dotenv import load_dotenv
 import asyncio
-import cv2
+import json
+import time
 import numpy as np
-import httpx
+from contextlib import asynccontextmanager
 from datetime import datetime
 
-from services.face_recognition import FaceRecognitionService
+from services.face_recognition import get_face_recognition_service
 from services.anomaly_detection import AnomalyDetectionService
 from services.engagement_prediction import EngagementPredictionService
+from services.inference_executor import get_inference_executor
+from services.batch_scheduler import create_batch_scheduler
+from services.checkin_consensus import create_checkin_consensus
+from services.checkin_dispatcher import create_checkin_dispatcher
+from services.stream_frames import FrameRateController, LatestFrameSlot
+from services.face_tracker import FaceTracker
+from services.motion_gate import MotionGate
 from utils.auth import verify_token
 from utils.errors import (
     ValidationError,
@@ -25,7 +34,19 @@ from utils.errors import (
 
 load_dotenv()
 
-app = FastAPI(title="TRACE ML Service")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await checkins.start()
+    yield
+    await checkins.stop()
+    anomaly_detection.shutdown()
+    engagement_prediction.shutdown()
+    inference.shutdown()
+    face_recognition.storage.close()
+
+
+app = FastAPI(title="TRACE ML Service", lifespan=lifespan)
 
 # CORS configuration
 app.add_middleware(
@@ -36,10 +57,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize services
-face_recognition = FaceRecognitionService()
-anomaly_detection = AnomalyDetectionService()
-engagement_prediction = EngagementPredictionService()
+# Initialize services around a single shared face gallery
+face_recognition = get_face_recognition_service()
+anomaly_detection = AnomalyDetectionService(face_recognition)
+engagement_prediction = EngagementPredictionService(face_recognition)
+# CPU-bound detection/encoding runs here so the event loop stays responsive
+inference = get_inference_executor()
+# Face encoding and matching from all video streams is batched together
+face_batcher = create_batch_scheduler(face_recognition, inference)
+# Check-ins are queued and sent to the backend in bulk over a pooled client
+checkins = create_checkin_dispatcher(
+    os.getenv("BACKEND_URL", "http://localhost:3000")
+)
+# A student is only checked in once per session, after repeated matches
+checkin_consensus = create_checkin_consensus()
+# Bounds on the detection options a video stream may request
+MIN_DETECT_DIMENSION = 160
+MAX_DETECT_UPSAMPLE = 2
+# Batch verification works through images this many at a time
+VERIFY_BATCH_CHUNK = int(os.getenv("VERIFY_BATCH_CHUNK", "16"))
+VERIFY_BATCH_MAX_IMAGES = int(os.getenv("VERIFY_BATCH_MAX_IMAGES", "256"))
 
 
 class FaceVerificationRequest(BaseModel):
@@ -47,12 +84,32 @@ class FaceVerificationRequest(BaseModel):
     user_id: str
 
 
+class FaceBatchImage(BaseModel):
+    face_data: str  # Base64 encoded image
+    user_id: Optional[str] = None  # Expected user; omit to identify
+
+
+class FaceBatchVerificationRequest(BaseModel):
+    images: List[FaceBatchImage]
+
+
 class EngagementPredictionRequest(BaseModel):
     face_data: str  # Base64 encoded image
     user_id: str
     session_id: str
 
 
+class EngagementFeedbackRequest(BaseModel):
+    user_id: str
+    session_id: str
+    engagement: float
+    attention: float
+
+
+class ModelRollbackRequest(BaseModel):
+    version: Optional[int] = None
+
+
 class AnomalyDetectionRequest(BaseModel):
     face_data: str  # Base64 encoded image
     user_id: str
@@ -65,29 +122,144 @@ class VideoStreamRequest(BaseModel):
     session_id: str
 
 
+async def read_image_upload(request: Request) -> tuple:
+    """Image bytes and fields from a multipart or raw binary upload.
+
+    multipart/form-data carries the image in an `image` file part and the
+    other fields as form fields; application/octet-stream (or image/*)
+    carries the encoded image as the whole body, with the fields in the
+    query string. Either way the bytes go straight to cv2.imdecode without
+    a base64 round trip.
+    """
+    fields = dict(request.query_params)
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("image")
+        if upload is None or isinstance(upload, str):
+            raise ValidationError("Missing image file")
+        image = await upload.read()
+        fields.update(
+            (key, value) for key, value in form.items() if isinstance(value, str)
+        )
+    elif content_type.startswith(("application/octet-stream", "image/")):
+        image = await request.body()
+    else:
+        raise ValidationError(
+            "Expected multipart/form-data or application/octet-stream"
+        )
+    if not image:
+        raise ValidationError("Missing image data")
+    return image, fields
+
+
+async def verify_face_image(face_data, user_id: Optional[str]) -> dict:
+    """Verify base64 or raw encoded image data against user_id's face"""
+    if not face_data or not user_id:
+        raise ValidationError("Missing required data")
+
+    # Decode and detect once in the inference pool, then share the analysis
+    analysis = await inference.run(
+        lambda: face_recognition.analyze(face_data).warm()
+    )
+    metrics = analysis.quality
+
+    result = await face_recognition.verify_face(analysis, user_id)
+    return {
+        "match": result["match"],
+        "confidence": result["confidence"],
+        "face_id": result["face_id"],
+        "metrics": metrics,
+    }
+
+
+async def register_face_image(face_data, user_id: Optional[str]) -> dict:
+    """Register base64 or raw encoded image data as user_id's face"""
+    if not face_data or not user_id:
+        raise ValidationError("Missing required data")
+
+    # Decode and detect once in the inference pool, then share the analysis
+    analysis = await inference.run(
+        lambda: face_recognition.analyze(face_data).warm()
+    )
+    metrics = analysis.quality
+    if metrics["score"] < 67:
+        return {
+            "success": False,
+            "message": "Face quality too low for registration.",
+            "metrics": metrics,
+        }
+
+    reg_result = await face_recognition.register_face(analysis, user_id)
+    return {
+        "success": reg_result["status"] in ["new", "updated"],
+        "status": reg_result["status"],
+        "user_id": reg_result["user_id"],
+        "message": reg_result["message"],
+        "metrics": metrics,
+    }
+
+
+async def predict_engagement_image(
+    face_data, user_id: Optional[str], session_id: Optional[str]
+) -> dict:
+    """Predict engagement from base64 or raw encoded image data"""
+    if not face_data or not user_id or not session_id:
+        raise ValidationError("Missing required data")
+
+    analysis = await inference.run(
+        lambda: face_recognition.analyze(face_data).warm(
+            encoding=False, landmarks=True
+        )
+    )
+    prediction = await engagement_prediction.predict(analysis, user_id, session_id)
+    return {
+        "engagement": prediction["engagement"],
+        "attention": prediction["attention"],
+        "timestamp": prediction["timestamp"],
+    }
+
+
+async def detect_anomaly_image(
+    face_data, user_id: Optional[str], session_id: Optional[str]
+) -> dict:
+    """Detect anomalies in base64 or raw encoded image data"""
+    if not face_data or not user_id or not session_id:
+        raise ValidationError("Missing required data")
+
+    analysis = await inference.run(
+        lambda: face_recognition.analyze(face_data).warm(
+            encoding=False, landmarks=True
+        )
+    )
+    result = await anomaly_detection.detect(analysis, user_id, session_id)
+    return {
+        "is_anomaly": result["is_anomaly"],
+        "confidence": result["confidence"],
+        "reason": result["reason"],
+    }
+
+
 @app.post("/api/v1/face/verify")
 async def verify_face(
     request: FaceVerificationRequest, token: str = Depends(verify_token)
 ):
     try:
-        data = request.dict()
-        face_data = data.get("face_data")
-        location = data.get("user_id")
-
-        if not face_data or not location:
-            raise ValidationError("Missing required data")
+        return await verify_face_image(request.face_data, request.user_id)
+    except Exception as e:
+        if isinstance(
+            e, (ValidationError, NotFoundError, ConflictError, DatabaseError)
+        ):
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        raise HTTPException(status_code=500, detail="Face verification failed")
 
-        # Decode image and compute quality metrics
-        image = face_recognition.decode_base64_image(face_data)
-        metrics = face_recognition.compute_face_quality(image)
 
-        result = await face_recognition.verify_face(face_data, location)
-        return {
-            "match": result["match"],
-            "confidence": result["confidence"],
-            "face_id": result["face_id"],
-            "metrics": metrics,
-        }
+@app.post("/api/v1/face/verify/upload")
+async def verify_face_upload(request: Request, token: str = Depends(verify_token)):
+    """verify_face for multipart or application/octet-stream images"""
+    try:
+        image, fields = await read_image_upload(request)
+        return await verify_face_image(image, fields.get("user_id"))
     except Exception as e:
         if isinstance(
             e, (ValidationError, NotFoundError, ConflictError, DatabaseError)
@@ -96,36 +268,96 @@ async def verify_face(
         raise HTTPException(status_code=500, detail="Face verification failed")
 
 
+async def stream_batch_verification(images: List[FaceBatchImage]):
+    """NDJSON lines of per-face results, one line per image, in order.
+
+    Images are split into chunks of VERIFY_BATCH_CHUNK that run concurrently
+    on the inference pool; each chunk decodes and detects its images and
+    then encodes and matches all of their faces in one batch. A chunk's
+    lines are sent as soon as it and every earlier chunk are done.
+    """
+    chunks = [
+        images[start : start + VERIFY_BATCH_CHUNK]
+        for start in range(0, len(images), VERIFY_BATCH_CHUNK)
+    ]
+    tasks = [
+        asyncio.create_task(
+            inference.run(
+                face_recognition.identify_images,
+                [item.face_data for item in chunk],
+            )
+        )
+        for chunk in chunks
+    ]
+    index = 0
+    try:
+        for chunk, task in zip(chunks, tasks):
+            try:
+                results = await task
+            except Exception as e:
+                print(f"Batch verification chunk failed: {e}")
+                results = [{"error": "Face verification failed"}] * len(chunk)
+            for item, result in zip(chunk, results):
+                line = {"index": index, **result}
+                if item.user_id is not None:
+                    line["user_id"] = item.user_id
+                    for face in line.get("faces", []):
+                        # A face only identifies as user_id below the threshold
+                        face["match"] = face["user_id"] == item.user_id
+                    line["match"] = any(face["match"] for face in line.get("faces", []))
+                yield json.dumps(line) + "\n"
+                index += 1
+    finally:
+        # The client may disconnect mid-stream
+        for task in tasks:
+            task.cancel()
+
+
+@app.post("/api/v1/face/verify-batch")
+async def verify_face_batch(
+    request: FaceBatchVerificationRequest, token: str = Depends(verify_token)
+):
+    """Verify or identify every face in many images, or in one group photo.
+
+    Streams application/x-ndjson: one {"index", "faces"} (or "error") line
+    per image, where each face has its location, confidence and the user it
+    identifies as. Images sent with a user_id also get "match" flags.
+    """
+    try:
+        if not request.images:
+            raise ValidationError("No images provided")
+        if len(request.images) > VERIFY_BATCH_MAX_IMAGES:
+            raise ValidationError(f"At most {VERIFY_BATCH_MAX_IMAGES} images per batch")
+        return StreamingResponse(
+            stream_batch_verification(request.images),
+            media_type="application/x-ndjson",
+        )
+    except ValidationError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+
 @app.post("/api/v1/face/register")
 async def register_face(
     request: FaceVerificationRequest, token: str = Depends(verify_token)
 ):
     try:
-        data = request.dict()
-        face_data = data.get("face_data")
-        user_id = data.get("user_id")
-
-        if not face_data or not user_id:
-            raise ValidationError("Missing required data")
-
-        # Decode image and compute quality metrics
-        image = face_recognition.decode_base64_image(face_data)
-        metrics = face_recognition.compute_face_quality(image)
-        if metrics["score"] < 67:
-            return {
-                "success": False,
-                "message": "Face quality too low for registration.",
-                "metrics": metrics,
-            }
+        return await register_face_image(request.face_data, request.user_id)
+    except Exception as e:
+        if isinstance(
+            e, (ValidationError, NotFoundError, ConflictError, DatabaseError)
+        ):
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        raise HTTPException(status_code=500, detail="Face registration failed")
 
-        reg_result = await face_recognition.register_face(face_data, user_id)
-        return {
-            "success": reg_result["status"] in ["new", "updated"],
-            "status": reg_result["status"],
-            "user_id": reg_result["user_id"],
-            "message": reg_result["message"],
-            "metrics": metrics,
-        }
+
+@app.post("/api/v1/face/register/upload")
+async def register_face_upload(
+    request: Request, token: str = Depends(verify_token)
+):
+    """register_face for multipart or application/octet-stream images"""
+    try:
+        image, fields = await read_image_upload(request)
+        return await register_face_image(image, fields.get("user_id"))
     except Exception as e:
         if isinstance(
             e, (ValidationError, NotFoundError, ConflictError, DatabaseError)
@@ -139,14 +371,9 @@ async def predict_engagement(
     request: EngagementPredictionRequest, token: str = Depends(verify_token)
 ):
     try:
-        prediction = await engagement_prediction.predict(
+        return await predict_engagement_image(
             request.face_data, request.user_id, request.session_id
         )
-        return {
-            "engagement": prediction["engagement"],
-            "attention": prediction["attention"],
-            "timestamp": prediction["timestamp"],
-        }
     except Exception as e:
         if isinstance(
             e, (ValidationError, NotFoundError, ConflictError, DatabaseError)
@@ -155,19 +382,93 @@ async def predict_engagement(
         raise HTTPException(status_code=500, detail="Engagement prediction failed")
 
 
+@app.post("/api/v1/engagement/predict/upload")
+async def predict_engagement_upload(
+    request: Request, token: str = Depends(verify_token)
+):
+    """predict_engagement for multipart or application/octet-stream images"""
+    try:
+        image, fields = await read_image_upload(request)
+        return await predict_engagement_image(
+            image, fields.get("user_id"), fields.get("session_id")
+        )
+    except Exception as e:
+        if isinstance(
+            e, (ValidationError, NotFoundError, ConflictError, DatabaseError)
+        ):
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        raise HTTPException(status_code=500, detail="Engagement prediction failed")
+
+
+@app.post("/api/v1/engagement/feedback")
+async def engagement_feedback(
+    request: EngagementFeedbackRequest, token: str = Depends(verify_token)
+):
+    """Label a student's recent samples; the model is updated in the background"""
+    try:
+        if not (0 <= request.engagement <= 1 and 0 <= request.attention <= 1):
+            raise ValidationError("Engagement and attention must be between 0 and 1")
+        labelled = await engagement_prediction.train_model(
+            request.user_id,
+            request.session_id,
+            {"engagement": request.engagement, "attention": request.attention},
+        )
+        return {"labelled_samples": labelled}
+    except Exception as e:
+        if isinstance(
+            e, (ValidationError, NotFoundError, ConflictError, DatabaseError)
+        ):
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        raise HTTPException(status_code=500, detail="Failed to record feedback")
+
+
+@app.post("/api/v1/engagement/model/rollback")
+async def rollback_engagement_model(
+    request: ModelRollbackRequest, token: str = Depends(verify_token)
+):
+    try:
+        try:
+            version = await engagement_prediction.rollback_model(request.version)
+        except ValueError as e:
+            raise ValidationError(str(e))
+        return {"version": version}
+    except Exception as e:
+        if isinstance(
+            e, (ValidationError, NotFoundError, ConflictError, DatabaseError)
+        ):
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        raise HTTPException(
+            status_code=500, detail="Failed to roll back engagement model"
+        )
+
+
+@app.get("/api/v1/engagement/sessions/{session_id}")
+async def get_session_engagement(
+    session_id: str,
+    since: Optional[datetime] = None,
+    token: str = Depends(verify_token),
+):
+    """Class engagement for a session, served from incrementally kept rollups"""
+    try:
+        return await engagement_prediction.get_session_engagement(session_id, since)
+    except Exception as e:
+        if isinstance(
+            e, (ValidationError, NotFoundError, ConflictError, DatabaseError)
+        ):
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        raise HTTPException(
+            status_code=500, detail="Failed to get session engagement"
+        )
+
+
 @app.post("/api/v1/anomaly/detect")
 async def detect_anomaly(
     request: AnomalyDetectionRequest, token: str = Depends(verify_token)
 ):
     try:
-        result = await anomaly_detection.detect(
+        return await detect_anomaly_image(
             request.face_data, request.user_id, request.session_id
         )
-        return {
-            "is_anomaly": result["is_anomaly"],
-            "confidence": result["confidence"],
-            "reason": result["reason"],
-        }
     except Exception as e:
         if isinstance(
             e, (ValidationError, NotFoundError, ConflictError, DatabaseError)
@@ -176,6 +477,142 @@ async def detect_anomaly(
         raise HTTPException(status_code=500, detail="Anomaly detection failed")
 
 
+@app.post("/api/v1/anomaly/detect/upload")
+async def detect_anomaly_upload(request: Request, token: str = Depends(verify_token)):
+    """detect_anomaly for multipart or application/octet-stream images"""
+    try:
+        image, fields = await read_image_upload(request)
+        return await detect_anomaly_image(
+            image, fields.get("user_id"), fields.get("session_id")
+        )
+    except Exception as e:
+        if isinstance(
+            e, (ValidationError, NotFoundError, ConflictError, DatabaseError)
+        ):
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        raise HTTPException(status_code=500, detail="Anomaly detection failed")
+
+
+def parse_stream_flag(metadata: dict, key: str, default: bool) -> bool:
+    """A boolean stream option; JSON booleans, 0/1 and their string forms"""
+    value = metadata.get(key)
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    flag = str(value).strip().lower()
+    if flag in ("1", "true", "yes", "on"):
+        return True
+    if flag in ("0", "false", "no", "off"):
+        return False
+    raise ValidationError(f"Invalid {key} option")
+
+
+def detect_video_frame(
+    frame_data: bytes,
+    motion_gate: Optional[MotionGate] = None,
+    max_dimension: Optional[int] = None,
+    upsample: Optional[int] = None,
+) -> tuple:
+    """Decode a video frame and detect its faces (runs in the inference pool)"""
+    frame = face_recognition.decode_image_bytes(frame_data)
+
+    def detect(image: np.ndarray) -> list:
+        return face_recognition.detect_faces(image, max_dimension, upsample)
+
+    if motion_gate is None:
+        return frame, detect(frame)
+    # Static frames reuse the last detections; changed regions are re-detected
+    return frame, motion_gate.detect(frame, detect)
+
+
+async def identify_tracked_faces(
+    tracker: FaceTracker, frame: np.ndarray, face_locations: list, session_id: str
+) -> list:
+    """Identify a frame's faces, reusing cached identities of tracked faces.
+
+    Each result's `fresh` flag says whether it was encoded and matched this
+    frame rather than replayed from the track's cached identity.
+    """
+    tracks = tracker.update(face_locations)
+
+    def pending(track) -> bool:
+        # Matches not yet checked in are retried often so that consensus
+        # sees several independent matches
+        identity = track.identity
+        return bool(
+            identity
+            and identity["match"]
+            and not checkin_consensus.is_checked_in(session_id, identity["user_id"])
+        )
+
+    # Only new tracks, tracks due for re-verification, weak matches and
+    # unconfirmed matches are encoded again
+    stale = [
+        i
+        for i, track in enumerate(tracks)
+        if tracker.needs_identification(track, pending=pending(track))
+    ]
+    identified = await face_batcher.identify(
+        frame, [face_locations[i] for i in stale]
+    )
+    for i, result in zip(stale, identified):
+        tracker.set_identity(tracks[i], result, result["confidence"])
+    fresh = set(stale)
+    return [
+        dict(
+            track.identity,
+            location=location,
+            track_id=track.track_id,
+            fresh=i in fresh,
+        )
+        for i, (track, location) in enumerate(zip(tracks, face_locations))
+    ]
+
+
+async def handle_frame_results(
+    websocket: WebSocket, stream_data: dict, results: list, hit_interval: float
+):
+    """Check in matched faces and report every face back to the client.
+
+    `hit_interval` is how far apart fresh matches of one face can be on this
+    stream, so that consensus can wait long enough on slow streams.
+    """
+    for result in results:
+        # Only fresh matches count; cached identities would repeat one match
+        if (
+            result["match"]
+            and result["fresh"]
+            and checkin_consensus.observe(
+                stream_data["session_id"],
+                result["user_id"],
+                hit_interval=hit_interval,
+            )
+        ):
+            # Queue the check-in; delivery happens in the background
+            checkins.submit(
+                {
+                    "studentId": result["user_id"],
+                    "sessionId": stream_data["session_id"],
+                    "location": stream_data["location"],
+                    "confidence": result["confidence"],
+                    "timestamp": datetime.now().isoformat(),
+                }
+            )
+
+        # Send result back to client
+        await websocket.send_json(
+            {
+                "type": "face_detected",
+                "data": {
+                    "match": result["match"],
+                    "confidence": result["confidence"],
+                    "location": stream_data["location"],
+                },
+            }
+        )
+
+
 @app.websocket("/ws/video-stream")
 async def video_stream(websocket: WebSocket):
     await websocket.accept()
@@ -193,51 +630,90 @@ async def video_stream(websocket: WebSocket):
         if not all(stream_data.values()):
             raise ValidationError("Missing stream metadata")
 
-        while True:
-            # Receive video frame
-            frame_data = await websocket.receive_bytes()
-
-            # Convert bytes to numpy array
-            nparr = np.frombuffer(frame_data, np.uint8)
-            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-            # Process frame
-            faces = face_recognition.detect_faces(frame)
-
-            for face in faces:
-                # Verify face
-                result = face_recognition.verify_face(face)
-
-                if result["match"]:
-                    # Send check-in to backend
-                    try:
-                        async with httpx.AsyncClient() as client:
-                            await client.post(
-                                f"{os.getenv('BACKEND_URL')}/api/v1/attendance/auto-checkin",
-                                json={
-                                    "studentId": result["user_id"],
-                                    "sessionId": stream_data["session_id"],
-                                    "location": stream_data["location"],
-                                    "confidence": result["confidence"],
-                                    "timestamp": datetime.now().isoformat(),
-                                },
-                            )
-                    except Exception as e:
-                        raise MLServiceError(
-                            f"Failed to send check-in to backend: {str(e)}"
-                        )
-
-                # Send result back to client
-                await websocket.send_json(
-                    {
-                        "type": "face_detected",
-                        "data": {
-                            "match": result["match"],
-                            "confidence": result["confidence"],
-                            "location": stream_data["location"],
-                        },
-                    }
+        # Cameras can tune detection: a smaller max dimension is faster, more
+        # upsampling finds smaller (more distant) faces
+        try:
+            detect_options = {
+                key: int(metadata[key])
+                for key in ("max_dimension", "upsample")
+                if metadata.get(key) is not None
+            }
+        except (TypeError, ValueError):
+            raise ValidationError("Invalid detection options")
+        # Clamp so one camera can neither break resizing nor monopolise the
+        # shared pool: 0 disables downscaling, otherwise at least 160 pixels
+        if "max_dimension" in detect_options:
+            max_dimension = detect_options["max_dimension"]
+            detect_options["max_dimension"] = (
+                max(MIN_DETECT_DIMENSION, max_dimension) if max_dimension > 0 else 0
+            )
+        if "upsample" in detect_options:
+            detect_options["upsample"] = min(
+                max(detect_options["upsample"], 0), MAX_DETECT_UPSAMPLE
+            )
+
+        # Skip detection on frames where nothing moved, unless turned off
+        motion_gating = parse_stream_flag(
+            metadata, "motion_gating", os.getenv("MOTION_GATING", "1") == "1"
+        )
+        motion_gate = MotionGate() if motion_gating else None
+
+        # Clients that opt in are told what frame rate we can keep up with
+        adaptive_fps = parse_stream_flag(metadata, "adaptive_fps", False)
+        frame_slot = LatestFrameSlot()
+        frame_rate = FrameRateController()
+        face_tracker = FaceTracker()
+
+        async def receive_frames():
+            # Keep reading while a frame is processed so that only the
+            # freshest one is kept and stale frames are dropped
+            try:
+                while True:
+                    frame_slot.put(await websocket.receive_bytes())
+            finally:
+                frame_slot.close()
+
+        receiver = asyncio.create_task(receive_frames())
+        checkin_consensus.open_stream(stream_data["session_id"])
+        try:
+            while True:
+                frame_data = await frame_slot.get()
+                if frame_data is None:
+                    break
+
+                # Detect faces in the inference pool, then encode and match
+                # them in a batch shared with the other active streams
+                started = time.monotonic()
+                frame, face_locations = await inference.run(
+                    detect_video_frame, frame_data, motion_gate, **detect_options
                 )
+                results = await identify_tracked_faces(
+                    face_tracker, frame, face_locations, stream_data["session_id"]
+                )
+                frame_rate.record(time.monotonic() - started)
+
+                await handle_frame_results(
+                    websocket,
+                    stream_data,
+                    results,
+                    face_tracker.retry_spacing(frame_slot.frame_interval),
+                )
+
+                if adaptive_fps and frame_rate.should_notify():
+                    await websocket.send_json(
+                        {
+                            "type": "frame_rate",
+                            "data": {
+                                "target_fps": round(frame_rate.target_fps, 1),
+                                **frame_slot.stats(),
+                                **(motion_gate.stats() if motion_gate else {}),
+                            },
+                        }
+                    )
+            # Re-raise whatever ended the receiver (e.g. a disconnect)
+            await receiver
+        finally:
+            receiver.cancel()
 
     except Exception as e:
         if isinstance(
@@ -0,0 +1,299 @@
+import numpy as np
+import os
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+from .embedding_store import EmbeddingStore
+
+# IVF state: (centroids, bucket lists, face_id -> bucket), replaced as a whole
+_Trained = Tuple[np.ndarray, List[Set[str]], Dict[str, int]]
+
+
+class ExactIndex:
+    """Exhaustive search over the whole gallery"""
+
+    def __init__(self, store: EmbeddingStore):
+        self.store = store
+
+    def add(self, face_id: str, encoding) -> None:
+        pass
+
+    def remove(self, face_id: str) -> None:
+        pass
+
+    def search(self, encoding, k: int = 1) -> List[Tuple[str, float]]:
+        return self.store.search(encoding, k)
+
+    def search_batch(self, encodings, k: int = 1) -> List[List[Tuple[str, float]]]:
+        return self.store.search_batch(encodings, k)
+
+    def rebuild(self) -> None:
+        pass
+
+    def save(self, path: str) -> None:
+        pass
+
+    def load(self, path: str) -> None:
+        pass
+
+
+class IVFIndex:
+    """Inverted-file index over the gallery.
+
+    Encodings are bucketed by their nearest k-means centroid. A query probes
+    the `nprobe` closest buckets and re-ranks that shortlist exactly against
+    the gallery, so returned distances keep their usual meaning. Raising
+    `nprobe` trades latency for recall. Until the gallery is large enough to
+    train the centroids, searches fall back to an exhaustive scan.
+
+    Training runs on a background thread from a snapshot of the gallery and
+    the centroids, buckets and assignments are swapped in together, so
+    registrations never wait for k-means and searches keep using the
+    previous state (or exact search) until it finishes. Faces added or
+    removed meanwhile are reconciled at the swap.
+    """
+
+    def __init__(
+        self,
+        store: EmbeddingStore,
+        nlist: int = 256,
+        nprobe: int = 8,
+        train_iterations: int = 10,
+    ):
+        self.store = store
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_iterations = train_iterations
+        self.trained_size = 0
+        self._trained: Optional[_Trained] = None
+        self._mutex = threading.Lock()
+        self._training: Optional[threading.Thread] = None
+        self._touched: Set[str] = set()
+
+    @property
+    def min_train_size(self) -> int:
+        return self.nlist * 8
+
+    @property
+    def is_trained(self) -> bool:
+        return self._trained is not None
+
+    @property
+    def centroids(self) -> Optional[np.ndarray]:
+        trained = self._trained
+        return None if trained is None else trained[0]
+
+    def add(self, face_id: str, encoding) -> None:
+        """Insert or move an encoding into its nearest bucket"""
+        with self._mutex:
+            if self._training is not None:
+                self._touched.add(face_id)
+            if self._trained is not None:
+                self._place(self._trained, face_id, encoding)
+        # Train once the gallery is big enough, and retrain as it outgrows
+        # the centroids; geometric growth keeps the amortized cost low
+        if self._needs_training():
+            self._start_training()
+
+    def remove(self, face_id: str) -> None:
+        with self._mutex:
+            if self._training is not None:
+                self._touched.add(face_id)
+            if self._trained is not None:
+                self._unplace(self._trained, face_id)
+
+    def search(self, encoding, k: int = 1) -> List[Tuple[str, float]]:
+        """Probe the closest buckets and re-rank the shortlist exactly"""
+        trained = self._trained
+        if trained is None:
+            return self.store.search(encoding, k)
+        centroids, lists, _ = trained
+        query = np.asarray(encoding, dtype=np.float32).reshape(-1)
+        candidates = set()
+        # Bucket sets are updated on the event loop while this runs on a pool
+        # thread; set.update copies under the GIL, and IDs removed since are
+        # dropped by search_among, which reads the store under its lock
+        for bucket in self._nearest_centroids(centroids, query, self.nprobe):
+            candidates.update(lists[bucket])
+        return self.store.search_among(query, candidates, k)
+
+    def search_batch(self, encodings, k: int = 1) -> List[List[Tuple[str, float]]]:
+        """Search several encodings; shortlists differ per query"""
+        if not self.is_trained:
+            return self.store.search_batch(encodings, k)
+        return [self.search(encoding, k) for encoding in encodings]
+
+    def rebuild(self) -> None:
+        """Retrain centroids on the current gallery and reassign every encoding.
+
+        Blocks for the whole k-means run; registrations trigger training on
+        a background thread instead.
+        """
+        with self._mutex:
+            self._touched = set()
+        ids, vectors = self.store.snapshot()
+        if vectors.shape[0] < self.min_train_size:
+            with self._mutex:
+                self._trained = None
+                self.trained_size = 0
+            return
+        self._install(ids, *self._train(vectors))
+
+    def save(self, path: str) -> None:
+        """Persist centroids and bucket assignments"""
+        with self._mutex:
+            if self._trained is None:
+                return
+            centroids, _, assignment = self._trained
+            assignment = dict(assignment)
+            trained_size = self.trained_size
+        ids = list(assignment.keys())
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                centroids=centroids,
+                ids=np.array(ids, dtype=str),
+                buckets=np.array([assignment[i] for i in ids], dtype=np.int32),
+                trained_size=np.int64(trained_size),
+            )
+        os.replace(tmp_path, path)
+
+    def load(self, path: str) -> None:
+        """Restore a saved index and reconcile it with the gallery"""
+        if os.path.exists(path):
+            data = np.load(path)
+            centroids = data["centroids"].astype(np.float32)
+            lists = [set() for _ in range(centroids.shape[0])]
+            assignment = {}
+            for face_id, bucket in zip(data["ids"].tolist(), data["buckets"].tolist()):
+                if face_id in self.store:
+                    lists[bucket].add(face_id)
+                    assignment[face_id] = bucket
+            with self._mutex:
+                self._trained = (centroids, lists, assignment)
+                self.trained_size = int(data["trained_size"])
+            missing = [i for i in self.store.ids if i not in assignment]
+            for face_id in missing:
+                self.add(face_id, self.store.get(face_id))
+        # Retrain in the background once the gallery has outgrown the centroids
+        if self._needs_training():
+            self._start_training()
+
+    def _needs_training(self) -> bool:
+        size = len(self.store)
+        if size < self.min_train_size:
+            return False
+        return self._trained is None or size > 4 * self.trained_size
+
+    def _start_training(self):
+        with self._mutex:
+            if self._training is not None:
+                return
+            self._touched = set()
+            self._training = threading.Thread(
+                target=self._background_train, name="ivf-train", daemon=True
+            )
+            self._training.start()
+
+    def _background_train(self):
+        try:
+            ids, vectors = self.store.snapshot()
+            self._install(ids, *self._train(vectors))
+        except Exception as e:
+            print(f"IVF index training failed: {e}")
+            return
+        finally:
+            with self._mutex:
+                self._training = None
+                self._touched = set()
+        # The gallery may have outgrown the new centroids while they trained
+        if self._needs_training():
+            self._start_training()
+
+    def _train(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        centroids = self._kmeans(vectors)
+        return centroids, self._assign(vectors, centroids)
+
+    def _install(self, ids: List[str], centroids: np.ndarray, buckets: np.ndarray):
+        lists = [set() for _ in range(centroids.shape[0])]
+        assignment = {}
+        for face_id, bucket in zip(ids, buckets.tolist()):
+            lists[bucket].add(face_id)
+            assignment[face_id] = bucket
+        trained = (centroids, lists, assignment)
+        with self._mutex:
+            # Faces registered or deleted since the snapshot was taken
+            for face_id in self._touched:
+                self._unplace(trained, face_id)
+                encoding = self.store.get(face_id)
+                if encoding is not None:
+                    self._place(trained, face_id, encoding)
+            self._touched = set()
+            self._trained = trained
+            self.trained_size = len(ids)
+
+    def _place(self, trained: _Trained, face_id: str, encoding):
+        centroids, lists, assignment = trained
+        self._unplace(trained, face_id)
+        query = np.asarray(encoding, np.float32).reshape(-1)
+        bucket = int(self._nearest_centroids(centroids, query, 1)[0])
+        lists[bucket].add(face_id)
+        assignment[face_id] = bucket
+
+    @staticmethod
+    def _unplace(trained: _Trained, face_id: str):
+        _, lists, assignment = trained
+        bucket = assignment.pop(face_id, None)
+        if bucket is not None:
+            lists[bucket].discard(face_id)
+
+    @staticmethod
+    def _nearest_centroids(
+        centroids: np.ndarray, query: np.ndarray, n: int
+    ) -> np.ndarray:
+        sq = np.einsum("ij,ij->i", centroids, centroids) - 2.0 * (centroids @ query)
+        n = min(n, sq.shape[0])
+        top = np.argpartition(sq, n - 1)[:n]
+        return top[np.argsort(sq[top])]
+
+    def _kmeans(self, vectors: np.ndarray) -> np.ndarray:
+        rng = np.random.default_rng(42)
+        n = min(self.nlist, vectors.shape[0])
+        centroids = vectors[rng.choice(vectors.shape[0], n, replace=False)].copy()
+        for _ in range(self.train_iterations):
+            buckets = self._assign(vectors, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, buckets, vectors)
+            counts = np.bincount(buckets, minlength=n)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, None]
+            # Reseed empty buckets from random encodings
+            if empty.any():
+                centroids[empty] = vectors[rng.choice(vectors.shape[0], empty.sum())]
+        return centroids
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        buckets = np.empty(vectors.shape[0], dtype=np.intp)
+        c_sq = np.einsum("ij,ij->i", centroids, centroids)
+        # Chunk to bound the size of the distance matrix
+        for start in range(0, vectors.shape[0], 8192):
+            chunk = vectors[start : start + 8192]
+            buckets[start : start + 8192] = np.argmin(
+                c_sq[None, :] - 2.0 * (chunk @ centroids.T), axis=1
+            )
+        return buckets
+
+
+def create_index(store: EmbeddingStore):
+    """Build the gallery index selected by FACE_INDEX (exact or ivf)"""
+    kind = os.getenv("FACE_INDEX", "exact").lower()
+    if kind == "ivf":
+        return IVFIndex(
+            store,
+            nlist=int(os.getenv("FACE_INDEX_NLIST", "256")),
+            nprobe=int(os.getenv("FACE_INDEX_NPROBE", "8")),
+        )
+    if kind != "exact":
+        print(f"Unknown FACE_INDEX '{kind}', falling back to exact search")
+    return ExactIndex(store)
@@ -1,115 +1,146 @@
+import asyncio
 import numpy as np
 from sklearn.ensemble import IsolationForest
-from typing import Dict, Any
-import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Union
 import os
+import time
 from datetime import datetime
-from .face_recognition import FaceRecognitionService
+from .face_recognition import FaceRecognitionService, get_face_recognition_service
+from .face_analysis import FaceAnalysis
+from .background import spawn
+from .anomaly_model_store import UserAnomalyModel, create_anomaly_model_store
+from .landmark_features import landmark_encoder, pairwise_distances_batch, reduced_distances_batch
 
 class AnomalyDetectionService:
-    def __init__(self):
-        self.face_recognition = FaceRecognitionService()
-        self.anomaly_detector = IsolationForest(contamination=0.1, random_state=42)
-        self.user_models = {}
-        self.load_models()
+    def __init__(
+        self,
+        face_recognition: Optional[FaceRecognitionService] = None,
+        min_samples: int = 5,
+        history_size: int = 50,
+        refit_samples: int = 10,
+        refit_interval: float = 10 * 60,
+        feature_set: Optional[str] = None,
+    ):
+        # Share the process-wide gallery instead of loading another copy
+        self.face_recognition = face_recognition or get_face_recognition_service()
+        self.min_samples = min_samples
+        self.history_size = history_size
+        # A user's forest is refitted in the background after this many new
+        # samples, or on the next sample once refit_interval has passed
+        self.refit_samples = refit_samples
+        self.refit_interval = refit_interval
+        # "canonical" uses the aligned landmark encoding shared with engagement,
+        # "full" every within-group landmark distance, "reduced" a small set of
+        # scale-normalised ones
+        self.feature_set = feature_set or os.getenv("ANOMALY_FEATURES", "canonical")
+        if self.feature_set not in ("canonical", "full", "reduced"):
+            raise ValueError(f"Unknown anomaly feature set '{self.feature_set}'")
+        # Per-user models are loaded on demand and written behind
+        self.user_models = create_anomaly_model_store(history_size)
+        # One trainer thread so refits never compete with inference for cores
+        self._trainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="anomaly-train")
+        self._tasks = set()
+        self.user_models.migrate_legacy('data/anomaly_models.json')
 
-    def load_models(self):
-        """Load anomaly detection models from storage"""
-        try:
-            if os.path.exists('data/anomaly_models.json'):
-                with open('data/anomaly_models.json', 'r') as f:
-                    self.user_models = json.load(f)
-        except Exception as e:
-            print(f"Error loading anomaly models: {e}")
-
-    def save_models(self):
-        """Save anomaly detection models to storage"""
-        try:
-            os.makedirs('data', exist_ok=True)
-            with open('data/anomaly_models.json', 'w') as f:
-                json.dump(self.user_models, f)
-        except Exception as e:
-            print(f"Error saving anomaly models: {e}")
+    def _new_detector(self) -> IsolationForest:
+        return IsolationForest(contamination=0.1, random_state=42)
 
-    def extract_features(self, face_data: str) -> np.ndarray:
+    def extract_features(self, face_data: Union[str, FaceAnalysis]) -> np.ndarray:
         """Extract features from face data for anomaly detection"""
+        return self.extract_features_batch([face_data])[0]
+
+    def extract_features_batch(self, faces: List[Union[str, FaceAnalysis]]) -> np.ndarray:
+        """Extract features for several faces at once, shape (faces, features)"""
         try:
-            # Decode image
-            image = self.face_recognition.decode_base64_image(face_data)
-            
-            # Get face landmarks
-            landmarks = self.face_recognition.get_face_landmarks(image)
-            if not landmarks:
+            # Get face landmarks (reuses the request's decode and detection)
+            landmarks = [self.face_recognition.analyze(face_data).landmarks for face_data in faces]
+            if not all(landmarks):
                 raise ValueError("No face landmarks detected")
             
-            # Extract features from landmarks
-            features = []
-            for key, points in landmarks.items():
-                # Calculate distances between key points
-                for i in range(len(points) - 1):
-                    for j in range(i + 1, len(points)):
-                        dist = np.sqrt(
-                            (points[i][0] - points[j][0])**2 +
-                            (points[i][1] - points[j][1])**2
-                        )
-                        features.append(dist)
-            
-            return np.array(features)
+            if self.feature_set == "canonical":
+                return landmark_encoder.encode_batch(landmarks)
+            if self.feature_set == "reduced":
+                return reduced_distances_batch(landmarks)
+            return pairwise_distances_batch(landmarks)
         except Exception as e:
             raise Exception(f"Feature extraction failed: {e}")
 
-    async def detect(self, face_data: str, user_id: str, session_id: str) -> Dict[str, Any]:
+    async def detect(self, face_data: Union[str, FaceAnalysis], user_id: str, session_id: str) -> Dict[str, Any]:
         """Detect anomalies in face data"""
         try:
             # Extract features
             features = self.extract_features(face_data)
             
-            # Get or create user model
-            if user_id not in self.user_models:
-                self.user_models[user_id] = {
-                    "model": self.anomaly_detector,
-                    "features": []
-                }
-            
-            # Update user model
-            self.user_models[user_id]["features"].append(features)
-            if len(self.user_models[user_id]["features"]) > 10:
-                self.user_models[user_id]["features"] = self.user_models[user_id]["features"][-10:]
-            
-            # Fit model if enough samples
-            if len(self.user_models[user_id]["features"]) >= 5:
-                X = np.array(self.user_models[user_id]["features"])
-                self.user_models[user_id]["model"].fit(X)
-            
-            # Predict anomaly
+            # Score against the user's last fitted model; fitting never
+            # happens on the request path
+            user_model = await self.get_user_model(user_id)
+            model = user_model.model
             is_anomaly = False
             confidence = 0.0
             reason = None
             
-            if len(self.user_models[user_id]["features"]) >= 5:
-                prediction = self.user_models[user_id]["model"].predict([features])[0]
-                score = self.user_models[user_id]["model"].score_samples([features])[0]
-                
-                is_anomaly = prediction == -1
+            if model is not None and model.n_features_in_ == len(features):
+                score = model.score_samples([features])[0]
+                # Same decision as model.predict, without a second pass over the trees
+                is_anomaly = score < model.offset_
                 confidence = abs(score)
                 
                 if is_anomaly:
                     reason = "Unusual facial features detected"
             
-            # Save updated models
-            self.save_models()
+            # Update user samples and refit in the background when due
+            user_model.features.append(features)
+            user_model.new_samples += 1
+            self.user_models.mark_dirty(user_id, user_model)
+            self._schedule_refit(user_id, user_model)
             
             return {
-                "is_anomaly": is_anomaly,
+                "is_anomaly": bool(is_anomaly),
                 "confidence": float(confidence),
                 "reason": reason
             }
         except Exception as e:
             raise Exception(f"Anomaly detection failed: {e}")
 
-    def get_user_model(self, user_id: str) -> Dict[str, Any]:
+    def _schedule_refit(self, user_id: str, user_model: UserAnomalyModel):
+        if user_model.fitting or len(user_model.features) < self.min_samples:
+            return
+        due = (
+            user_model.model is None
+            or user_model.new_samples >= self.refit_samples
+            or (user_model.new_samples and time.monotonic() - user_model.fitted_at >= self.refit_interval)
+        )
+        if not due:
+            return
+        user_model.fitting = True
+        spawn(self._tasks, self._refit(user_id, user_model))
+
+    async def _refit(self, user_id: str, user_model: UserAnomalyModel):
+        # Snapshot the samples on the loop thread; detect keeps appending
+        samples = list(user_model.features)
+        user_model.new_samples = 0
+        try:
+            loop = asyncio.get_running_loop()
+            # Samples of a different length (e.g. older landmark layouts) can't share a model
+            X = np.array([f for f in samples if len(f) == len(samples[-1])])
+            user_model.model = await loop.run_in_executor(self._trainer, self._fit, X)
+            user_model.fitted_at = time.monotonic()
+            self.user_models.mark_dirty(user_id, user_model)
+        except Exception as e:
+            print(f"Error refitting anomaly model for {user_id}: {e}")
+        finally:
+            user_model.fitting = False
+
+    def _fit(self, X: np.ndarray) -> IsolationForest:
+        # Fit a fresh forest and swap it in whole, so concurrent requests
+        # always score against a complete model
+        return self._new_detector().fit(X)
+
+    async def get_user_model(self, user_id: str) -> UserAnomalyModel:
         """Get anomaly detection model for a user"""
-        return self.user_models.get(user_id, {
-            "model": self.anomaly_detector,
-            "features": []
-        }) 
\ No newline at end of file
+        return await self.user_models.get(user_id)
+
+    def shutdown(self):
+        self._trainer.shutdown(wait=False, cancel_futures=True)
+        self.user_models.close()
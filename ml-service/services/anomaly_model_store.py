@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import json
+import numpy as np
+import os
+import pickle
+from collections import OrderedDict, deque
+from typing import Any, Dict
+from .background import WriteBehind
+
+
+class UserAnomalyModel:
+    """A user's recent feature samples and the forest last fitted on them"""
+
+    def __init__(self, history_size: int):
+        self.features = deque(maxlen=history_size)
+        self.model: Any = None
+        self.new_samples = 0
+        self.fitted_at = 0.0
+        self.fitting = False
+
+
+class AnomalyModelStore:
+    """Per-user binary anomaly model files behind an LRU cache.
+
+    Each user's samples and fitted forest live in their own pickle under
+    `directory`, so saving one user never touches the others. Users are
+    loaded on first use and the least recently used are evicted beyond
+    `cache_size`. Changes are written behind: `mark_dirty` only records the
+    user, and dirty users are flushed together every `flush_interval`
+    seconds on a worker thread. Evicted users that are still dirty are held
+    until their flush so no update is lost.
+    """
+
+    def __init__(
+        self,
+        directory: str = "data/anomaly_models",
+        history_size: int = 50,
+        cache_size: int = 1000,
+        flush_interval: float = 5.0,
+    ):
+        self.directory = directory
+        self.history_size = history_size
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self._cache: "OrderedDict[str, UserAnomalyModel]" = OrderedDict()
+        self._dirty: Dict[str, UserAnomalyModel] = {}
+        self._writing: Dict[str, UserAnomalyModel] = {}
+        self._write_behind = WriteBehind(self.flush, flush_interval)
+        os.makedirs(directory, exist_ok=True)
+
+    async def get(self, user_id: str) -> UserAnomalyModel:
+        """Return the user's model, loading it from disk if it isn't cached"""
+        user_model = self._cache.get(user_id)
+        if user_model is not None:
+            self._cache.move_to_end(user_id)
+            return user_model
+        user_model = self._dirty.get(user_id) or self._writing.get(user_id)
+        if user_model is None:
+            user_model = await asyncio.to_thread(self._read, user_id)
+            # Another request may have loaded the user while we were reading
+            user_model = self._cache.get(user_id, user_model)
+        self._cache[user_id] = user_model
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return user_model
+
+    def mark_dirty(self, user_id: str, user_model: UserAnomalyModel):
+        """Schedule the user's model to be written on the next flush"""
+        self._dirty[user_id] = user_model
+        self._write_behind.schedule()
+
+    async def flush(self):
+        """Write every dirty user in the background"""
+        # Snapshot on the loop thread, where the models are mutated
+        self._writing, self._dirty = self._dirty, {}
+        pending = {
+            user_id: self._serialize(user_id, user_model)
+            for user_id, user_model in self._writing.items()
+        }
+        try:
+            failed = await asyncio.to_thread(self._write_all, pending)
+            for user_id in failed:
+                if user_id not in self._dirty:
+                    self.mark_dirty(user_id, self._writing[user_id])
+        finally:
+            self._writing = {}
+
+    def close(self):
+        """Synchronously write any dirty users, e.g. at shutdown"""
+        self._write_behind.cancel()
+        pending = {
+            user_id: self._serialize(user_id, user_model)
+            for user_id, user_model in self._dirty.items()
+        }
+        self._dirty.clear()
+        self._write_all(pending)
+
+    def migrate_legacy(self, path: str):
+        """Import samples from the old all-users JSON file, then retire it"""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r") as f:
+                stored = json.load(f)
+            for user_id, entry in stored.items():
+                user_model = UserAnomalyModel(self.history_size)
+                for features in entry.get("features", []):
+                    user_model.features.append(np.asarray(features, dtype=np.float64))
+                user_model.new_samples = len(user_model.features)
+                self._write(user_id, self._serialize(user_id, user_model))
+            os.replace(path, f"{path}.migrated")
+        except Exception as e:
+            print(f"Error migrating anomaly models: {e}")
+
+    def _path(self, user_id: str) -> str:
+        # User IDs are not guaranteed to be safe file names
+        digest = hashlib.sha1(user_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.pkl")
+
+    def _serialize(self, user_id: str, user_model: UserAnomalyModel) -> Dict[str, Any]:
+        return {
+            "user_id": user_id,
+            "features": list(user_model.features),
+            "model": user_model.model,
+            "new_samples": user_model.new_samples,
+        }
+
+    def _read(self, user_id: str) -> UserAnomalyModel:
+        user_model = UserAnomalyModel(self.history_size)
+        path = self._path(user_id)
+        if not os.path.exists(path):
+            return user_model
+        try:
+            with open(path, "rb") as f:
+                stored = pickle.load(f)
+            user_model.features.extend(stored["features"])
+            user_model.model = stored["model"]
+            user_model.new_samples = stored["new_samples"]
+        except Exception as e:
+            print(f"Error loading anomaly model for {user_id}: {e}")
+        return user_model
+
+    def _write_all(self, pending: Dict[str, Dict[str, Any]]) -> list:
+        failed = []
+        for user_id, stored in pending.items():
+            try:
+                self._write(user_id, stored)
+            except Exception as e:
+                print(f"Error saving anomaly model for {user_id}: {e}")
+                failed.append(user_id)
+        return failed
+
+    def _write(self, user_id: str, stored: Dict[str, Any]):
+        path = self._path(user_id)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+def create_anomaly_model_store(history_size: int) -> AnomalyModelStore:
+    """Build a store configured by ANOMALY_MODEL_CACHE and ANOMALY_FLUSH_S"""
+    return AnomalyModelStore(
+        history_size=history_size,
+        cache_size=int(os.getenv("ANOMALY_MODEL_CACHE", "1000")),
+        flush_interval=float(os.getenv("ANOMALY_FLUSH_S", "5")),
+    )
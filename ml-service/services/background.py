@@ -0,0 +1,107 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Coroutine, List, Optional, Set, Tuple
+
+
+def spawn(tasks: Set[asyncio.Task], coro: Coroutine) -> asyncio.Task:
+    """Start coro as a task held in `tasks` until it finishes.
+
+    The event loop only keeps weak references to tasks, so fire-and-forget
+    work needs a strong one to avoid being garbage collected mid-flight.
+    """
+    task = asyncio.create_task(coro)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+
+class MicroBatcher:
+    """Coalesces concurrent submissions into batches processed together.
+
+    Items wait at most `max_wait` seconds or until `max_batch` units (as
+    counted by `size`) are pending. The batch is then handed to the async
+    `process`, which returns one result per item in order, and each
+    submitter gets its own result or the batch's exception.
+    """
+
+    def __init__(
+        self,
+        process: Callable[[List[Any]], Awaitable[Any]],
+        max_batch: int,
+        max_wait: float,
+        size: Callable[[Any], int] = lambda item: 1,
+    ):
+        self.process = process
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.size = size
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._pending_size = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, item: Any) -> Any:
+        """Process item as part of a batch and return its result"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        self._pending_size += self.size(item)
+        if self._pending_size >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending, self._pending_size = self._pending, [], 0
+        spawn(self._tasks, self._run(batch))
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future]]):
+        try:
+            results = await self.process([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class WriteBehind:
+    """Runs an async `flush` at most every `interval` seconds after changes.
+
+    `schedule` arms a timer if none is pending; when it fires, `flush` runs
+    as a task. A flush never overlaps the previous one: if that is still
+    writing, the timer is simply re-armed.
+    """
+
+    def __init__(self, flush: Callable[[], Awaitable[None]], interval: float):
+        self.flush = flush
+        self.interval = interval
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushing: Optional[asyncio.Task] = None
+
+    def schedule(self):
+        """Flush within `interval` seconds, unless a flush is already due"""
+        if self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.interval, self._start)
+
+    def cancel(self):
+        """Drop the pending timer, e.g. before a synchronous final write"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _start(self):
+        self._timer = None
+        if self._flushing is not None and not self._flushing.done():
+            self.schedule()
+            return
+        self._flushing = asyncio.create_task(self.flush())
@@ -0,0 +1,59 @@
+import numpy as np
+import os
+from typing import Any, Dict, List, Tuple
+from .background import MicroBatcher
+from .face_recognition import FaceRecognitionService
+from .inference_executor import InferenceExecutor
+
+
+class FaceBatchScheduler:
+    """Coalesces face identification from all active streams into batches.
+
+    Streams submit a decoded frame with its detected face locations. Work is
+    held for at most `max_wait` seconds or until `max_batch` faces are
+    pending, then the whole batch is encoded with one dlib call and matched
+    against the gallery with one matrix-matrix product on the inference
+    pool. Each stream's future is resolved with its own results.
+    """
+
+    def __init__(
+        self,
+        face_service: FaceRecognitionService,
+        executor: InferenceExecutor,
+        max_batch: int = 32,
+        max_wait: float = 0.01,
+    ):
+        self.face_service = face_service
+        self.executor = executor
+        self._batcher = MicroBatcher(
+            self._process, max_batch, max_wait, size=lambda item: len(item[1])
+        )
+
+    async def identify(
+        self, image: np.ndarray, face_locations: List[tuple]
+    ) -> List[Dict[str, Any]]:
+        """Identify the faces at face_locations in image as part of a batch"""
+        if not face_locations:
+            return []
+        return await self._batcher.submit((image, face_locations))
+
+    async def _process(
+        self, batch: List[Tuple[np.ndarray, List[tuple]]]
+    ) -> List[List[Dict[str, Any]]]:
+        return await self.executor.run(
+            self.face_service.identify_batch,
+            [image for image, _ in batch],
+            [locations for _, locations in batch],
+        )
+
+
+def create_batch_scheduler(
+    face_service: FaceRecognitionService, executor: InferenceExecutor
+) -> FaceBatchScheduler:
+    """Build a scheduler sized by FACE_BATCH_MAX and FACE_BATCH_WAIT_MS"""
+    return FaceBatchScheduler(
+        face_service,
+        executor,
+        max_batch=int(os.getenv("FACE_BATCH_MAX", "32")),
+        max_wait=float(os.getenv("FACE_BATCH_WAIT_MS", "10")) / 1000,
+    )
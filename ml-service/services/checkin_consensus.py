@@ -0,0 +1,129 @@
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Set
+
+
+class _SessionState:
+    def __init__(self, now: float):
+        self.hits: Dict[str, Deque[float]] = {}
+        self.checked_in: Set[str] = set()
+        self.last_seen = now
+
+
+class CheckinConsensus:
+    """Confirms identities per session before they are checked in.
+
+    A match only counts towards a check-in once the same student has been
+    matched `min_hits` times within `window` seconds, and each student is
+    checked in at most once per session. Callers should only pass matches
+    from fresh encodings, not identities cached across frames, so each hit
+    is an independent match. Slow streams can't produce `min_hits` matches
+    within `window`, so callers pass how far apart their matches can be at
+    best and the window is stretched to fit, up to `max_window`. A
+    session's state is kept while its cameras reconnect and only expires
+    after `session_ttl` seconds without activity, so memory stays bounded
+    by the recent sessions.
+    """
+
+    # Stretched windows leave this much room for frame timing jitter
+    JITTER_SLACK = 1.5
+
+    def __init__(
+        self,
+        min_hits: int = 5,
+        window: float = 3.0,
+        max_window: float = 15.0,
+        session_ttl: float = 3 * 60 * 60,
+    ):
+        self.min_hits = min_hits
+        self.window = window
+        self.max_window = max(window, max_window)
+        self.session_ttl = session_ttl
+        self._sessions: Dict[str, _SessionState] = {}
+        self._next_sweep = 0.0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def open_stream(self, session_id: str, now: Optional[float] = None):
+        """Note a stream (re)connecting to session_id, keeping its state alive"""
+        now = time.monotonic() if now is None else now
+        self._session(session_id, now).last_seen = now
+
+    def is_checked_in(self, session_id: str, user_id: str) -> bool:
+        state = self._sessions.get(session_id)
+        return state is not None and user_id in state.checked_in
+
+    def observe(
+        self,
+        session_id: str,
+        user_id: str,
+        now: Optional[float] = None,
+        hit_interval: Optional[float] = None,
+    ) -> bool:
+        """Record a match. True exactly once, when the student is confirmed.
+
+        `hit_interval` is the shortest time between two matches of the same
+        face on the caller's stream, e.g. its processed frame interval.
+        """
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        state = self._session(session_id, now)
+        state.last_seen = now
+        if user_id in state.checked_in:
+            return False
+
+        hits = state.hits.setdefault(user_id, deque())
+        hits.append(now)
+        window = self.hit_window(hit_interval)
+        while hits and now - hits[0] > window:
+            hits.popleft()
+        if len(hits) < self.min_hits:
+            return False
+
+        del state.hits[user_id]
+        state.checked_in.add(user_id)
+        return True
+
+    def hit_window(self, hit_interval: Optional[float] = None) -> float:
+        """How long min_hits matches spaced hit_interval apart may take"""
+        if not hit_interval:
+            return self.window
+        needed = (self.min_hits - 1) * hit_interval * self.JITTER_SLACK
+        return min(self.max_window, max(self.window, needed))
+
+    def _session(self, session_id: str, now: float) -> _SessionState:
+        state = self._sessions.get(session_id)
+        if state is None:
+            state = self._sessions[session_id] = _SessionState(now)
+        return state
+
+    def _expire(self, now: float):
+        # Sweeping is amortised so that observe stays O(1) on the hot path
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.window
+        for session_id, state in list(self._sessions.items()):
+            if now - state.last_seen > self.session_ttl:
+                del self._sessions[session_id]
+                continue
+            # Forget students whose hits have all fallen out of any window
+            stale = [
+                user_id
+                for user_id, hits in state.hits.items()
+                if now - hits[-1] > self.max_window
+            ]
+            for user_id in stale:
+                del state.hits[user_id]
+
+
+def create_checkin_consensus() -> CheckinConsensus:
+    """Build a consensus buffer configured by CHECKIN_MIN_HITS, CHECKIN_WINDOW_S,
+    CHECKIN_MAX_WINDOW_S and CHECKIN_SESSION_TTL_S"""
+    return CheckinConsensus(
+        min_hits=int(os.getenv("CHECKIN_MIN_HITS", "5")),
+        window=float(os.getenv("CHECKIN_WINDOW_S", "3")),
+        max_window=float(os.getenv("CHECKIN_MAX_WINDOW_S", "15")),
+        session_ttl=float(os.getenv("CHECKIN_SESSION_TTL_S", str(3 * 60 * 60))),
+    )
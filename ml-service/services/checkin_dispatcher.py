@@ -0,0 +1,303 @@
+import asyncio
+import httpx
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, List, Optional
+from .background import WriteBehind
+
+
+class CheckinDispatcher:
+    """Delivers automatic check-ins to the backend in bulk.
+
+    Check-ins are queued and coalesced into POSTs to
+    /api/v1/attendance/auto-checkin/bulk of up to `max_batch` events, sent
+    over one long-lived pooled client so connections are reused. A batch
+    that fails with a transport error, 5xx or any 4xx other than a
+    validation error (e.g. 429, 408, 401) is retried with exponential
+    backoff, never sooner than a Retry-After asks; if it still fails it is
+    appended to a local JSONL spool. The spool is replayed at start, after
+    each successful delivery and every `replay_interval` seconds while idle,
+    and stays on disk until each of its check-ins is delivered. A batch
+    rejected as invalid (400/422) is split to isolate the bad check-ins,
+    which are the only ones dropped.
+    """
+
+    # Longest Retry-After honoured, so a bogus header can't stall delivery
+    MAX_RETRY_AFTER = 600.0
+
+    def __init__(
+        self,
+        backend_url: str,
+        spool_path: str = "data/checkin_spool.jsonl",
+        max_batch: int = 100,
+        flush_interval: float = 0.5,
+        max_retries: int = 5,
+        base_backoff: float = 0.5,
+        max_backoff: float = 30.0,
+        max_queue: int = 10000,
+        replay_interval: float = 30.0,
+    ):
+        self.backend_url = backend_url.rstrip("/")
+        self.spool_path = spool_path
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.replay_interval = replay_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._worker: Optional[asyncio.Task] = None
+        # Check-ins the worker holds outside the queue and the spool
+        self._in_flight: List[Dict[str, Any]] = []
+        # Spool writes and rotation happen on worker threads
+        self._spool_lock = threading.Lock()
+        # Loop time before which the backend asked not to be called again
+        self._retry_at = 0.0
+        # Check-ins that didn't fit in the queue, spooled off the event loop
+        self._overflow: List[Dict[str, Any]] = []
+        self._overflow_writer = WriteBehind(self._spool_overflow, flush_interval)
+
+    async def start(self):
+        """Open the pooled client and start the delivery worker"""
+        if self._worker is not None:
+            return
+        self._client = httpx.AsyncClient(
+            base_url=self.backend_url,
+            timeout=httpx.Timeout(10.0),
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10),
+        )
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the worker, spool anything undelivered and close the client"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        # A batch cut off mid-delivery may be sent twice; the backend ignores
+        # repeated check-ins, while dropping it would lose them
+        self._overflow_writer.cancel()
+        remaining, self._in_flight = self._in_flight + self._overflow, []
+        self._overflow = []
+        while not self._queue.empty():
+            remaining.append(self._queue.get_nowait())
+        if remaining:
+            await asyncio.to_thread(self._spool, remaining)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def submit(self, check_in: Dict[str, Any]):
+        """Queue a check-in for delivery without waiting for the backend"""
+        if self._worker is None:
+            asyncio.get_running_loop().create_task(self.start())
+        try:
+            self._queue.put_nowait(check_in)
+        except asyncio.QueueFull:
+            # The backend has fallen far behind; keep the event on disk, but
+            # write it from a worker thread together with any others
+            self._overflow.append(check_in)
+            self._overflow_writer.schedule()
+
+    async def _spool_overflow(self):
+        overflow, self._overflow = self._overflow, []
+        if overflow:
+            await asyncio.to_thread(self._spool, overflow)
+
+    async def _run(self):
+        # Whatever a previous run or outage left behind goes first
+        await self._replay_spool()
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                # Idle: retry the spool rather than wait for the next check-in
+                await self._replay_spool()
+                continue
+            self._in_flight = batch
+            undelivered = await self._deliver(batch)
+            if undelivered:
+                await asyncio.to_thread(self._spool, undelivered)
+                self._in_flight = []
+            else:
+                self._in_flight = []
+                await self._replay_spool()
+
+    async def _next_batch(self) -> List[Dict[str, Any]]:
+        """Wait for one check-in, then collect more for up to flush_interval.
+
+        Empty if nothing arrived within replay_interval.
+        """
+        try:
+            batch = [await asyncio.wait_for(self._queue.get(), self.replay_interval)]
+        except asyncio.TimeoutError:
+            return []
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _deliver(self, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """POST a batch, retrying transient failures. Returns what it gave up on."""
+        backoff = self.base_backoff
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries):
+            if self._retry_at > loop.time():
+                await asyncio.sleep(self._retry_at - loop.time())
+            try:
+                response = await self._client.post(
+                    "/api/v1/attendance/auto-checkin/bulk", json={"checkIns": batch}
+                )
+                if response.status_code in (400, 422):
+                    if len(batch) > 1:
+                        # Validation rejects the whole batch for one bad
+                        # check-in; halve it until the bad ones are isolated
+                        middle = len(batch) // 2
+                        undelivered = await self._deliver(batch[:middle])
+                        return undelivered + await self._deliver(batch[middle:])
+                    # Only a validation error means retrying won't help
+                    print(
+                        "Backend rejected check-in: "
+                        f"{response.status_code} {response.text}"
+                    )
+                    return []
+                if response.status_code < 400:
+                    self._log_failures(response)
+                    return []
+                # Rate limiting, timeouts, auth or config problems and server
+                # errors may all clear up; retry, then spool
+                print(
+                    f"Backend refused {len(batch)} check-ins: "
+                    f"{response.status_code} {response.text}"
+                )
+                retry_after = self._retry_after(response)
+                if retry_after is not None:
+                    self._retry_at = max(self._retry_at, loop.time() + retry_after)
+            except httpx.TransportError as e:
+                print(f"Failed to send check-ins to backend: {e}")
+            if attempt < self.max_retries - 1:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+        return batch
+
+    @classmethod
+    def _retry_after(cls, response: httpx.Response) -> Optional[float]:
+        """Seconds the response's Retry-After header asks to wait, if any"""
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                return None
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=timezone.utc)
+            seconds = (retry_at - datetime.now(timezone.utc)).total_seconds()
+        return min(max(seconds, 0.0), cls.MAX_RETRY_AFTER)
+
+    @staticmethod
+    def _log_failures(response: httpx.Response):
+        """Log the check-ins the backend processed but refused"""
+        try:
+            results = response.json()["response"]["data"]["results"]
+        except (ValueError, KeyError, TypeError):
+            return
+        for result in results:
+            if not result.get("status"):
+                print(
+                    f"Check-in for {result.get('studentId')} refused: "
+                    f"{result.get('message')}"
+                )
+
+    async def _replay_spool(self):
+        """Resend spooled check-ins, spooling again whatever still fails.
+
+        Until every batch is delivered or spooled again, the replay file
+        holds whatever is left, so a crash mid-replay loses nothing.
+        """
+        spooled = await asyncio.to_thread(self._take_spool)
+        while spooled:
+            batch, rest = spooled[: self.max_batch], spooled[self.max_batch :]
+            undelivered = await self._deliver(batch)
+            if undelivered:
+                await asyncio.to_thread(self._respool, undelivered + rest)
+                return
+            await asyncio.to_thread(self._write_replay, rest)
+            spooled = rest
+
+    @property
+    def _replay_path(self) -> str:
+        return f"{self.spool_path}.replay"
+
+    def _spool(self, check_ins: List[Dict[str, Any]]):
+        os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+        with self._spool_lock, open(self.spool_path, "a") as f:
+            for check_in in check_ins:
+                f.write(json.dumps(check_in) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _respool(self, check_ins: List[Dict[str, Any]]):
+        # A crash in between replays these twice; the backend ignores repeats
+        self._spool(check_ins)
+        os.remove(self._replay_path)
+
+    def _write_replay(self, check_ins: List[Dict[str, Any]]):
+        """Shrink the replay file to the check-ins not yet delivered"""
+        if not check_ins:
+            os.remove(self._replay_path)
+            return
+        tmp_path = f"{self._replay_path}.tmp"
+        with open(tmp_path, "w") as f:
+            for check_in in check_ins:
+                f.write(json.dumps(check_in) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._replay_path)
+
+    def _take_spool(self) -> List[Dict[str, Any]]:
+        # Move the spool aside so new failures start a fresh file; a replay
+        # file left by a crash is taken first
+        if not os.path.exists(self._replay_path):
+            with self._spool_lock:
+                if not os.path.exists(self.spool_path):
+                    return []
+                os.replace(self.spool_path, self._replay_path)
+        check_ins = []
+        with open(self._replay_path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        check_ins.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        print(f"Skipping corrupt spooled check-in: {line[:80]}")
+        return check_ins
+
+
+def create_checkin_dispatcher(backend_url: str) -> CheckinDispatcher:
+    """Build a dispatcher configured by CHECKIN_BATCH_MAX, CHECKIN_FLUSH_MS,
+    CHECKIN_REPLAY_S and CHECKIN_SPOOL_PATH"""
+    return CheckinDispatcher(
+        backend_url,
+        spool_path=os.getenv("CHECKIN_SPOOL_PATH", "data/checkin_spool.jsonl"),
+        max_batch=int(os.getenv("CHECKIN_BATCH_MAX", "100")),
+        flush_interval=float(os.getenv("CHECKIN_FLUSH_MS", "500")) / 1000,
+        replay_interval=float(os.getenv("CHECKIN_REPLAY_S", "30")),
+    )
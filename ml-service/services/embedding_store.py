@@ -0,0 +1,322 @@
+import numpy as np
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class _ReadWriteLock:
+    """Many concurrent readers or one writer; waiting writers go first"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+class EmbeddingStore:
+    """Contiguous float32 gallery of face encodings with a parallel ID index.
+
+    Rows live in a preallocated matrix that doubles when full, so register,
+    update and delete mutate it in place and matching is a single
+    matrix-vector product instead of a list -> array conversion per call.
+
+    A store built with `from_mapped` reads straight from memory-mapped
+    snapshot arrays and only copies them into private memory on the first
+    mutation.
+
+    Searches run on inference pool threads while registrations mutate the
+    store on the event loop, so reads and writes go through a readers/writer
+    lock; a search never sees a row half-written or moved by `remove`.
+    """
+
+    def __init__(self, dim: int = 128, initial_capacity: int = 1024):
+        self.dim = dim
+        self._vectors = np.empty((max(initial_capacity, 1), dim), dtype=np.float32)
+        self._sq_norms: Optional[np.ndarray] = np.empty(
+            max(initial_capacity, 1), dtype=np.float32
+        )
+        self._ids = []
+        self._row_map: Optional[Dict[str, int]] = {}
+        self._mapped = False
+        self._lock = _ReadWriteLock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, face_id: str) -> bool:
+        with self._lock.read():
+            return face_id in self._rows
+
+    @property
+    def is_mapped(self) -> bool:
+        """Whether rows are still served from the memory-mapped snapshot"""
+        return self._mapped
+
+    @property
+    def ids(self) -> List[str]:
+        """IDs in row order"""
+        with self._lock.read():
+            if self._mapped:
+                return self._ids.tolist()
+            return list(self._ids)
+
+    @property
+    def _rows(self) -> Dict[str, int]:
+        # Built lazily so mapped stores can answer searches without it
+        if self._row_map is None:
+            self._row_map = {
+                str(face_id): row for row, face_id in enumerate(self._ids)
+            }
+        return self._row_map
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """Read-only view of the populated rows.
+
+        Later writes show through the view; use `snapshot` for a consistent
+        copy from another thread.
+        """
+        view = self._vectors[: len(self._ids)]
+        view.flags.writeable = False
+        return view
+
+    def snapshot(self) -> Tuple[List[str], np.ndarray]:
+        """Consistent copy of the IDs and their (rows x dim) encodings"""
+        with self._lock.read():
+            size = len(self._ids)
+            ids = self._ids.tolist() if self._mapped else list(self._ids)
+            return ids, np.array(self._vectors[:size])
+
+    def get(self, face_id: str) -> Optional[np.ndarray]:
+        """Get a copy of the encoding stored for an ID"""
+        with self._lock.read():
+            row = self._rows.get(face_id)
+            if row is None:
+                return None
+            return self._vectors[row].copy()
+
+    def add(self, face_id: str, encoding) -> None:
+        """Insert an encoding, or overwrite it if the ID already exists"""
+        vector = self._as_vector(encoding)
+        with self._lock.write():
+            self._materialize()
+            row = self._rows.get(face_id)
+            if row is None:
+                row = len(self._ids)
+                if row == self._vectors.shape[0]:
+                    self._grow()
+                self._ids.append(face_id)
+                self._rows[face_id] = row
+            self._vectors[row] = vector
+            self._sq_norms[row] = np.dot(vector, vector)
+
+    def update(self, face_id: str, encoding) -> None:
+        """Overwrite the encoding of an existing ID"""
+        if face_id not in self:
+            raise KeyError(face_id)
+        self.add(face_id, encoding)
+
+    def remove(self, face_id: str) -> bool:
+        """Remove an ID by moving the last row into its slot"""
+        with self._lock.write():
+            if face_id not in self._rows:
+                return False
+            self._materialize()
+            row = self._rows.pop(face_id)
+            last = len(self._ids) - 1
+            if row != last:
+                last_id = self._ids[last]
+                self._vectors[row] = self._vectors[last]
+                self._sq_norms[row] = self._sq_norms[last]
+                self._ids[row] = last_id
+                self._rows[last_id] = row
+            self._ids.pop()
+            return True
+
+    def distances(self, encoding) -> np.ndarray:
+        """Euclidean distance from an encoding to every row"""
+        query = self._as_vector(encoding)
+        with self._lock.read():
+            return self._distances(query)
+
+    def search(self, encoding, k: int = 1) -> List[Tuple[str, float]]:
+        """Return the k nearest (id, distance) pairs, closest first"""
+        query = self._as_vector(encoding)
+        with self._lock.read():
+            if not len(self._ids) or k <= 0:
+                return []
+            distances = self._distances(query)
+            return self._top_k(np.arange(distances.shape[0]), distances, k)
+
+    def search_batch(self, encodings, k: int = 1) -> List[List[Tuple[str, float]]]:
+        """Top-k search for many encodings with one matrix-matrix product"""
+        queries = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock.read():
+            size = len(self._ids)
+            if not size or k <= 0:
+                return [[] for _ in range(queries.shape[0])]
+            sq = (
+                self._norms()[None, :size]
+                - 2.0 * (queries @ self._vectors[:size].T)
+                + np.einsum("ij,ij->i", queries, queries)[:, None]
+            )
+            distances = np.sqrt(np.maximum(sq, 0.0))
+            rows = np.arange(size)
+            return [self._top_k(rows, row_distances, k) for row_distances in distances]
+
+    def search_among(
+        self, encoding, face_ids: Iterable[str], k: int = 1
+    ) -> List[Tuple[str, float]]:
+        """Exact k-nearest search restricted to a candidate set of IDs"""
+        query = self._as_vector(encoding)
+        with self._lock.read():
+            row_map = self._rows
+            rows = np.fromiter(
+                (row_map[face_id] for face_id in face_ids if face_id in row_map),
+                dtype=np.intp,
+            )
+            if not rows.size or k <= 0:
+                return []
+            sq = (
+                self._norms()[rows]
+                - 2.0 * (self._vectors[rows] @ query)
+                + np.dot(query, query)
+            )
+            return self._top_k(rows, np.sqrt(np.maximum(sq, 0.0)), k)
+
+    def to_dict(self) -> Dict[str, List[float]]:
+        """Serialize as an id -> encoding mapping"""
+        with self._lock.read():
+            return {
+                face_id: self._vectors[row].tolist()
+                for face_id, row in self._rows.items()
+            }
+
+    @classmethod
+    def from_dict(cls, encodings: Dict[str, List[float]], dim: int = 128):
+        """Build a store from an id -> encoding mapping"""
+        store = cls(dim=dim, initial_capacity=max(1024, len(encodings)))
+        for face_id, encoding in encodings.items():
+            store.add(face_id, encoding)
+        return store
+
+    @classmethod
+    def from_arrays(cls, ids: List[str], vectors: np.ndarray, dim: int = 128):
+        """Build a store from an ID list and a matching (rows x dim) matrix"""
+        if vectors.shape != (len(ids), dim):
+            raise ValueError(
+                f"Expected {len(ids)} x {dim} encodings, got {vectors.shape}"
+            )
+        store = cls(dim=dim, initial_capacity=max(1024, len(ids)))
+        store._vectors[: len(ids)] = vectors
+        store._sq_norms[: len(ids)] = np.einsum("ij,ij->i", vectors, vectors)
+        store._ids = list(ids)
+        store._row_map = None
+        return store
+
+    @classmethod
+    def from_mapped(cls, ids: np.ndarray, vectors: np.ndarray, dim: int = 128):
+        """Wrap memory-mapped ID and encoding arrays without copying them.
+
+        Pages stay shared with every other process mapping the same snapshot
+        until the store is first mutated.
+        """
+        if vectors.shape != (ids.shape[0], dim):
+            raise ValueError(
+                f"Expected {ids.shape[0]} x {dim} encodings, got {vectors.shape}"
+            )
+        store = cls(dim=dim, initial_capacity=1)
+        store._vectors = vectors
+        store._sq_norms = None
+        store._ids = ids
+        store._row_map = None
+        store._mapped = True
+        return store
+
+    def _distances(self, query: np.ndarray) -> np.ndarray:
+        size = len(self._ids)
+        sq = (
+            self._norms()[:size]
+            - 2.0 * (self._vectors[:size] @ query)
+            + np.dot(query, query)
+        )
+        return np.sqrt(np.maximum(sq, 0.0))
+
+    def _as_vector(self, encoding) -> np.ndarray:
+        vector = np.asarray(encoding, dtype=np.float32).reshape(-1)
+        if vector.shape[0] != self.dim:
+            raise ValueError(
+                f"Expected encoding of length {self.dim}, got {vector.shape[0]}"
+            )
+        return vector
+
+    def _top_k(
+        self, rows: np.ndarray, distances: np.ndarray, k: int
+    ) -> List[Tuple[str, float]]:
+        k = min(k, distances.shape[0])
+        if k < distances.shape[0]:
+            top = np.argpartition(distances, k - 1)[:k]
+        else:
+            top = np.arange(distances.shape[0])
+        top = top[np.argsort(distances[top])]
+        return [(str(self._ids[rows[i]]), float(distances[i])) for i in top]
+
+    def _norms(self) -> np.ndarray:
+        if self._sq_norms is None:
+            self._sq_norms = np.einsum("ij,ij->i", self._vectors, self._vectors)
+        return self._sq_norms
+
+    def _materialize(self):
+        """Copy a mapped store into private, growable memory"""
+        if not self._mapped:
+            return
+        size = len(self._ids)
+        vectors = np.empty((max(1024, size * 2), self.dim), dtype=np.float32)
+        vectors[:size] = self._vectors
+        sq_norms = np.empty(vectors.shape[0], dtype=np.float32)
+        sq_norms[:size] = self._norms()
+        self._vectors = vectors
+        self._sq_norms = sq_norms
+        self._ids = self._ids.tolist()
+        self._row_map = None
+        self._mapped = False
+
+    def _grow(self):
+        capacity = self._vectors.shape[0] * 2
+        vectors = np.empty((capacity, self.dim), dtype=np.float32)
+        sq_norms = np.empty(capacity, dtype=np.float32)
+        size = len(self._ids)
+        vectors[:size] = self._vectors[:size]
+        sq_norms[:size] = self._sq_norms[:size]
+        self._vectors = vectors
+        self._sq_norms = sq_norms
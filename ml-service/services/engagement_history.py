@@ -0,0 +1,745 @@
+import asyncio
+import hashlib
+import json
+import numpy as np
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from .background import WriteBehind
+
+# chunk-<seq>[-<last seq>]-<first ms>-<last ms>.npz
+_CHUNK_NAME = re.compile(r"chunk-(\d+)(?:-(\d+))?-(\d+)-(\d+)\.npz")
+_COLUMNS = ("user_id", "timestamp", "engagement", "attention")
+
+
+class EngagementRing:
+    """Fixed-size ring of a student's latest predictions in one session"""
+
+    def __init__(self, capacity: int):
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.engagement = np.zeros(capacity, dtype=np.float32)
+        self.attention = np.zeros(capacity, dtype=np.float32)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, timestamp: float, engagement: float, attention: float):
+        i = self._next
+        self.timestamps[i] = timestamp
+        self.engagement[i] = engagement
+        self.attention[i] = attention
+        self._next = (i + 1) % len(self.timestamps)
+        self._count = min(self._count + 1, len(self.timestamps))
+
+    def order(self) -> np.ndarray:
+        """Indices of the held entries, oldest first"""
+        start = (self._next - self._count) % len(self.timestamps)
+        return (start + np.arange(self._count)) % len(self.timestamps)
+
+
+class MinuteAggregates:
+    """Per-minute count, mean and minimum of engagement and attention"""
+
+    def __init__(self):
+        # minute -> [count, engagement sum, engagement min,
+        #            attention sum, attention min]
+        self.minutes: Dict[int, List[float]] = {}
+
+    def add(self, timestamp: float, engagement: float, attention: float):
+        minute = int(timestamp // 60)
+        bucket = self.minutes.get(minute)
+        if bucket is None:
+            self.minutes[minute] = [1, engagement, engagement, attention, attention]
+            return
+        bucket[0] += 1
+        bucket[1] += engagement
+        bucket[2] = min(bucket[2], engagement)
+        bucket[3] += attention
+        bucket[4] = min(bucket[4], attention)
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "minute": datetime.fromtimestamp(minute * 60).isoformat(),
+                "count": int(count),
+                "mean_engagement": eng_sum / count,
+                "min_engagement": eng_min,
+                "mean_attention": att_sum / count,
+                "min_attention": att_min,
+            }
+            for minute, (count, eng_sum, eng_min, att_sum, att_min) in sorted(
+                self.minutes.items()
+            )
+        ]
+
+
+class _RollupMinute:
+    """One minute of a session rollup"""
+
+    # Per-student columns: count, engagement sum, attention sum,
+    # engagement min, attention min
+    COLUMNS = 5
+
+    def __init__(self, bins: int):
+        self.count = 0
+        self.engagement_sum = 0.0
+        self.attention_sum = 0.0
+        self.engagement_hist = np.zeros(bins, dtype=np.int64)
+        self.attention_hist = np.zeros(bins, dtype=np.int64)
+        # One row per student, indexed like SessionRollup.students
+        self.students = np.zeros((0, self.COLUMNS))
+
+    def add(
+        self,
+        row: int,
+        engagement: float,
+        attention: float,
+        engagement_bin: int,
+        attention_bin: int,
+    ):
+        self.count += 1
+        self.engagement_sum += engagement
+        self.attention_sum += attention
+        self.engagement_hist[engagement_bin] += 1
+        self.attention_hist[attention_bin] += 1
+        if row >= len(self.students):
+            grown = np.zeros((max(row + 1, 2 * len(self.students)), self.COLUMNS))
+            grown[:, 3:] = np.inf
+            grown[: len(self.students)] = self.students
+            self.students = grown
+        stats = self.students[row]
+        stats[0] += 1
+        stats[1] += engagement
+        stats[2] += attention
+        stats[3] = min(stats[3], engagement)
+        stats[4] = min(stats[4], attention)
+
+
+class SessionRollup:
+    """Class-wide engagement for one session, maintained as samples arrive.
+
+    Every minute holds class totals, fixed-bin histograms and per-student
+    counts, sums and minimums, so a summary of the whole session, or of the
+    minutes since some time, costs O(minutes x (students + bins)) however
+    many predictions the session has had.
+    """
+
+    BINS = 100
+
+    def __init__(self):
+        self.minutes: Dict[int, _RollupMinute] = {}
+        # user -> row of the student in every minute
+        self.students: Dict[str, int] = {}
+        # row -> [last timestamp, last engagement, last attention]
+        self.last: List[List[float]] = []
+
+    def add(
+        self, user_id: str, timestamp: float, engagement: float, attention: float
+    ):
+        row = self.students.get(user_id)
+        if row is None:
+            row = self.students[user_id] = len(self.last)
+            self.last.append([timestamp, engagement, attention])
+        elif timestamp >= self.last[row][0]:
+            self.last[row] = [timestamp, engagement, attention]
+
+        minute = int(timestamp // 60)
+        bucket = self.minutes.get(minute)
+        if bucket is None:
+            bucket = self.minutes[minute] = _RollupMinute(self.BINS)
+        bucket.add(
+            row, engagement, attention, self._bin(engagement), self._bin(attention)
+        )
+
+    def summary(
+        self, since: Optional[float] = None, percentiles=(10, 25, 50, 75, 90)
+    ) -> Dict[str, Any]:
+        """Summary of the session, or from the minute holding `since` on"""
+        first_minute = None if since is None else int(since // 60)
+        # Per-student totals over the covered minutes, columns as in a minute
+        totals = np.zeros((len(self.last), _RollupMinute.COLUMNS))
+        totals[:, 3:] = np.inf
+        engagement_hist = np.zeros(self.BINS, dtype=np.int64)
+        attention_hist = np.zeros(self.BINS, dtype=np.int64)
+        timeline = []
+        for minute, bucket in sorted(self.minutes.items()):
+            if first_minute is not None and minute < first_minute:
+                continue
+            # Rows grow ahead of need, so unused ones are cut off
+            stats = bucket.students[: len(self.last)]
+            rows = len(stats)
+            totals[:rows, :3] += stats[:, :3]
+            np.minimum(totals[:rows, 3:], stats[:, 3:], out=totals[:rows, 3:])
+            engagement_hist += bucket.engagement_hist
+            attention_hist += bucket.attention_hist
+            timeline.append(
+                {
+                    "minute": datetime.fromtimestamp(minute * 60).isoformat(),
+                    "samples": bucket.count,
+                    "students": int(np.count_nonzero(stats[:, 0])),
+                    "mean_engagement": bucket.engagement_sum / bucket.count,
+                    "mean_attention": bucket.attention_sum / bucket.count,
+                }
+            )
+        students = []
+        for user_id, row in sorted(self.students.items()):
+            count, eng_sum, att_sum, eng_min, att_min = totals[row].tolist()
+            if not count:
+                continue
+            last_ts, last_eng, last_att = self.last[row]
+            students.append(
+                {
+                    "user_id": user_id,
+                    "samples": int(count),
+                    "mean_engagement": eng_sum / count,
+                    "mean_attention": att_sum / count,
+                    "min_engagement": eng_min,
+                    "min_attention": att_min,
+                    "last_seen": datetime.fromtimestamp(last_ts).isoformat(),
+                    "last_engagement": last_eng,
+                    "last_attention": last_att,
+                }
+            )
+        samples = int(totals[:, 0].sum())
+        return {
+            "samples": samples,
+            "students": len(students),
+            "mean_engagement": totals[:, 1].sum() / samples if samples else None,
+            "mean_attention": totals[:, 2].sum() / samples if samples else None,
+            "engagement_percentiles": self._percentiles(engagement_hist, percentiles),
+            "attention_percentiles": self._percentiles(attention_hist, percentiles),
+            "timeline": timeline,
+            "per_student": students,
+        }
+
+    def _bin(self, value: float) -> int:
+        return min(max(int(value * self.BINS), 0), self.BINS - 1)
+
+    def _percentiles(self, hist: np.ndarray, percentiles) -> Dict[str, float]:
+        total = hist.sum()
+        if not total:
+            return {}
+        cumulative = np.cumsum(hist)
+        result = {}
+        for p in percentiles:
+            # Upper edge of the first bin holding the p-th percentile sample
+            index = int(np.searchsorted(cumulative, total * p / 100))
+            result[f"p{p}"] = (index + 1) / self.BINS
+        return result
+
+
+class _Series:
+    def __init__(self, capacity: int):
+        self.ring = EngagementRing(capacity)
+        self.aggregates = MinuteAggregates()
+
+
+class EngagementHistory:
+    """Bounded in-memory engagement history backed by columnar chunks.
+
+    Each (user, session) keeps its latest `ring_size` predictions in a ring
+    buffer plus per-minute aggregates; at most `max_series` of these are held,
+    least recently used first out. Every prediction is also buffered per
+    session and appended every `flush_interval` seconds, on a worker thread,
+    as a new chunk under `directory/<session>/`:
+
+      chunk-<seq>-<first ts>-<last ts>.npz   user_id, timestamp, engagement,
+                                             attention columns
+
+    Once a session has `compact_chunks` unmerged chunks they are merged into
+    one, and once it has been idle for `compact_idle` seconds all of its
+    chunks are, so a long session leaves a few dozen files rather than one
+    per flush. A merged chunk is named after the range of sequence numbers
+    it replaces and keeps each row's original one in a `seq` column:
+
+      chunk-<seq>-<last seq>-<first ts>-<last ts>.npz
+
+    Each session's chunks are listed once and then indexed in memory, and
+    their time range is in the file name so `query` only opens chunks that
+    overlap the requested range.
+    """
+
+    def __init__(
+        self,
+        directory: str = "data/engagement_history",
+        ring_size: int = 512,
+        max_series: int = 10000,
+        max_rollups: int = 256,
+        flush_interval: float = 10.0,
+        compact_chunks: int = 32,
+        compact_idle: float = 300.0,
+    ):
+        self.directory = directory
+        self.ring_size = ring_size
+        self.max_series = max_series
+        self.flush_interval = flush_interval
+        self.compact_chunks = compact_chunks
+        self.compact_idle = compact_idle
+        self._series: "OrderedDict[Tuple[str, str], _Series]" = OrderedDict()
+        self.max_rollups = max_rollups
+        self._rollups: "OrderedDict[str, SessionRollup]" = OrderedDict()
+        # session -> rollup rebuild in progress, and rows recorded meanwhile
+        self._rebuilding: Dict[str, asyncio.Task] = {}
+        self._rebuild_backlog: Dict[str, List[Tuple[str, float, float, float]]] = {}
+        # session -> rows not yet written, as (user_id, timestamp, eng, att)
+        self._pending: Dict[str, List[Tuple[str, float, float, float]]] = {}
+        self._writing: Dict[str, List[Tuple[str, float, float, float]]] = {}
+        self._writing_seq: Dict[str, int] = {}
+        self._next_seq: Dict[str, int] = {}
+        # session -> (path, seq, last seq, first ts, last ts) of its chunks.
+        # Written by the flush thread and read by queries on any thread.
+        self._chunk_index: Dict[str, List[Tuple[str, int, int, float, float]]] = {}
+        self._index_lock = threading.Lock()
+        # session -> when a chunk was last written, until fully compacted
+        self._last_written: Dict[str, float] = {}
+        self._write_behind = WriteBehind(self.flush, flush_interval)
+        os.makedirs(directory, exist_ok=True)
+
+    def record(
+        self,
+        user_id: str,
+        session_id: str,
+        timestamp: float,
+        engagement: float,
+        attention: float,
+    ):
+        """Add one prediction to memory and schedule it to be persisted"""
+        series = self._get_series(user_id, session_id)
+        series.ring.append(timestamp, engagement, attention)
+        series.aggregates.add(timestamp, engagement, attention)
+        row = (user_id, timestamp, engagement, attention)
+        # Uncached rollups are rebuilt from disk and pending rows on demand
+        rollup = self._rollups.get(session_id)
+        if rollup is not None:
+            self._rollups.move_to_end(session_id)
+            rollup.add(*row)
+        elif session_id in self._rebuild_backlog:
+            self._rebuild_backlog[session_id].append(row)
+        self._pending.setdefault(session_id, []).append(row)
+        self._write_behind.schedule()
+
+    def recent(self, user_id: str, session_id: str) -> List[Dict[str, Any]]:
+        """The user's latest predictions in the session, oldest first"""
+        series = self._series.get((user_id, session_id))
+        if series is None:
+            return []
+        ring = series.ring
+        return [
+            {
+                "timestamp": datetime.fromtimestamp(ring.timestamps[i]).isoformat(),
+                "engagement": float(ring.engagement[i]),
+                "attention": float(ring.attention[i]),
+            }
+            for i in ring.order()
+        ]
+
+    def minute_aggregates(self, user_id: str, session_id: str) -> List[Dict[str, Any]]:
+        """Per-minute aggregates for the user in the session"""
+        series = self._series.get((user_id, session_id))
+        if series is None:
+            # Evicted or from an earlier run; rebuild from disk
+            columns = self.query(session_id, user_id=user_id)
+            aggregates = MinuteAggregates()
+            for ts, eng, att in zip(
+                columns["timestamp"], columns["engagement"], columns["attention"]
+            ):
+                aggregates.add(float(ts), float(eng), float(att))
+            return aggregates.to_list()
+        return series.aggregates.to_list()
+
+    async def session_summary(
+        self, session_id: str, since: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """Class timeline, percentiles and per-student summaries for a session.
+
+        With `since`, every figure covers only the minutes from the one
+        holding `since` on; either way it comes from the session's rollup.
+        """
+        rollup = await self._load_rollup(session_id)
+        return (rollup or SessionRollup()).summary(since)
+
+    def query(
+        self,
+        session_id: str,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        user_id: Optional[str] = None,
+    ) -> Dict[str, np.ndarray]:
+        """Columns of every persisted or pending prediction in [start, end]"""
+        return self._read_columns(self._snapshot(session_id), start, end, user_id)
+
+    def _snapshot(self, session_id: str) -> Tuple[str, int, list]:
+        """The chunks and in-memory rows a read of the session should see.
+
+        Taken on the event loop, where rows are recorded and flushes start,
+        so that _read_columns can then run on a worker thread.
+        """
+        # Chunks being written right now are still read from _writing
+        limit = self._writing_seq.get(session_id)
+        if limit is None:
+            limit = self._peek_seq(session_id)
+        rows = self._writing.get(session_id, []) + self._pending.get(session_id, [])
+        return session_id, limit, rows
+
+    def _read_columns(
+        self,
+        snapshot: Tuple[str, int, list],
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        user_id: Optional[str] = None,
+    ) -> Dict[str, np.ndarray]:
+        session_id, limit, rows = snapshot
+        while True:
+            try:
+                parts = self._read_chunks(session_id, limit, start, end)
+                break
+            except FileNotFoundError:
+                # Compacted meanwhile; the merged chunk replaces those gone
+                continue
+        if rows:
+            parts.append(_to_columns(rows))
+
+        columns = _concat(parts)
+        mask = np.ones(len(columns["timestamp"]), dtype=bool)
+        if start is not None:
+            mask &= columns["timestamp"] >= start
+        if end is not None:
+            mask &= columns["timestamp"] <= end
+        if user_id is not None:
+            mask &= columns["user_id"] == user_id
+        return {name: values[mask] for name, values in columns.items()}
+
+    def _read_chunks(
+        self,
+        session_id: str,
+        limit: int,
+        start: Optional[float],
+        end: Optional[float],
+    ) -> List[Dict[str, np.ndarray]]:
+        parts = []
+        for path, seq, last_seq, first, last in self._chunks(session_id):
+            if seq >= limit:
+                continue
+            if start is not None and last < start:
+                continue
+            if end is not None and first > end:
+                continue
+            with np.load(path) as chunk:
+                part = {name: chunk[name] for name in _COLUMNS}
+                if last_seq >= limit:
+                    # Merged while some of its rows were still being written;
+                    # the snapshot has those in memory
+                    keep = chunk["seq"] < limit
+                    part = {name: values[keep] for name, values in part.items()}
+            parts.append(part)
+        return parts
+
+    async def flush(self):
+        """Append every session's pending predictions as new chunks"""
+        self._writing, self._pending = self._pending, {}
+        self._writing_seq = {
+            session_id: self._peek_seq(session_id) for session_id in self._writing
+        }
+        try:
+            failed = await asyncio.to_thread(self._write_all, self._writing)
+            for session_id in failed:
+                # Keep the rows and try again on the next flush
+                self._pending[session_id] = (
+                    self._writing[session_id] + self._pending.get(session_id, [])
+                )
+            if failed:
+                self._write_behind.schedule()
+        finally:
+            self._writing = {}
+            self._writing_seq = {}
+
+    def close(self):
+        """Synchronously write any pending predictions, e.g. at shutdown"""
+        self._write_behind.cancel()
+        pending, self._pending = self._pending, {}
+        self._write_all(pending)
+
+    def migrate_legacy(self, path: str):
+        """Import the old nested-dict JSON history as chunks, then retire it"""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r") as f:
+                stored = json.load(f)
+            sessions: Dict[str, List[Tuple[str, float, float, float]]] = {}
+            for user_id, user_sessions in stored.items():
+                for session_id, entries in user_sessions.items():
+                    rows = sessions.setdefault(session_id, [])
+                    for entry in entries:
+                        rows.append(
+                            (
+                                user_id,
+                                datetime.fromisoformat(entry["timestamp"]).timestamp(),
+                                entry["engagement"],
+                                entry["attention"],
+                            )
+                        )
+            if self._write_all(sessions):
+                raise IOError("could not write every session")
+            os.replace(path, f"{path}.migrated")
+        except Exception as e:
+            print(f"Error migrating engagement history: {e}")
+
+    def _get_series(self, user_id: str, session_id: str) -> _Series:
+        key = (user_id, session_id)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series(self.ring_size)
+            while len(self._series) > self.max_series:
+                self._series.popitem(last=False)
+        else:
+            self._series.move_to_end(key)
+        return series
+
+    async def _load_rollup(self, session_id: str) -> Optional[SessionRollup]:
+        """The session's rollup, rebuilt off the loop if it isn't cached.
+
+        None for a session without predictions; those aren't cached, so
+        unknown session IDs can't push live sessions out of the cache.
+        """
+        rollup = self._rollups.get(session_id)
+        if rollup is not None:
+            self._rollups.move_to_end(session_id)
+            return rollup
+        task = self._rebuilding.get(session_id)
+        if task is None:
+            # Rows recorded from here on go to the backlog, not the snapshot
+            snapshot = self._snapshot(session_id)
+            self._rebuild_backlog[session_id] = []
+            task = self._rebuilding[session_id] = asyncio.create_task(
+                self._rebuild_rollup(snapshot)
+            )
+        return await asyncio.shield(task)
+
+    async def _rebuild_rollup(
+        self, snapshot: Tuple[str, int, list]
+    ) -> Optional[SessionRollup]:
+        session_id = snapshot[0]
+        try:
+            rollup = await asyncio.to_thread(self._build_rollup, snapshot)
+            for row in self._rebuild_backlog.get(session_id, []):
+                rollup.add(*row)
+        finally:
+            self._rebuilding.pop(session_id, None)
+            self._rebuild_backlog.pop(session_id, None)
+        if not rollup.students:
+            return None
+        # Keep it current from now on
+        self._rollups[session_id] = rollup
+        while len(self._rollups) > self.max_rollups:
+            self._rollups.popitem(last=False)
+        return rollup
+
+    def _build_rollup(self, snapshot: Tuple[str, int, list]) -> SessionRollup:
+        rollup = SessionRollup()
+        columns = self._read_columns(snapshot)
+        for user_id, ts, eng, att in zip(
+            columns["user_id"],
+            columns["timestamp"],
+            columns["engagement"],
+            columns["attention"],
+        ):
+            rollup.add(str(user_id), float(ts), float(eng), float(att))
+        return rollup
+
+    def _session_dir(self, session_id: str) -> str:
+        # Session IDs are not guaranteed to be safe file names
+        digest = hashlib.sha1(session_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def _chunks(
+        self, session_id: str
+    ) -> List[Tuple[str, int, int, float, float]]:
+        """The session's chunks in sequence order, listed on first use"""
+        with self._index_lock:
+            chunks = self._chunk_index.get(session_id)
+            if chunks is None:
+                chunks = self._chunk_index[session_id] = self._list_chunks(
+                    session_id
+                )
+            return list(chunks)
+
+    def _list_chunks(
+        self, session_id: str
+    ) -> List[Tuple[str, int, int, float, float]]:
+        directory = self._session_dir(session_id)
+        if not os.path.isdir(directory):
+            return []
+        chunks = []
+        for name in os.listdir(directory):
+            match = _CHUNK_NAME.fullmatch(name)
+            if match:
+                seq = int(match.group(1))
+                last_seq = seq if match.group(2) is None else int(match.group(2))
+                # Bounds are stored in milliseconds
+                chunks.append(
+                    (
+                        os.path.join(directory, name),
+                        seq,
+                        last_seq,
+                        int(match.group(3)) / 1000,
+                        int(match.group(4)) / 1000,
+                    )
+                )
+        chunks.sort(key=lambda chunk: (chunk[1], -chunk[2]))
+        # A crash mid-compaction leaves merged chunks next to the originals
+        kept = []
+        for chunk in chunks:
+            if kept and chunk[2] <= kept[-1][2]:
+                os.remove(chunk[0])
+                continue
+            kept.append(chunk)
+        return kept
+
+    def _write_all(self, sessions: Dict[str, List[Tuple[str, float, float, float]]]):
+        failed = []
+        for session_id, rows in sessions.items():
+            try:
+                self._write_chunk(session_id, rows)
+                self._compact(session_id)
+            except Exception as e:
+                print(f"Error saving engagement history for {session_id}: {e}")
+                failed.append(session_id)
+        # Sessions that have gone quiet are merged into a single chunk
+        now = time.monotonic()
+        for session_id, written in list(self._last_written.items()):
+            if session_id not in sessions and now - written >= self.compact_idle:
+                try:
+                    self._compact(session_id, idle=True)
+                except Exception as e:
+                    print(f"Error compacting engagement history for {session_id}: {e}")
+        return failed
+
+    def _peek_seq(self, session_id: str) -> int:
+        """Sequence number the session's next chunk will get"""
+        seq = self._next_seq.get(session_id)
+        if seq is None:
+            chunks = self._chunks(session_id)
+            seq = self._next_seq[session_id] = chunks[-1][2] + 1 if chunks else 0
+        return seq
+
+    def _write_chunk(
+        self, session_id: str, rows: List[Tuple[str, float, float, float]]
+    ):
+        if not rows:
+            return
+        seq = self._peek_seq(session_id)
+        self._save_chunk(session_id, seq, seq, _to_columns(rows))
+        self._next_seq[session_id] = seq + 1
+        self._last_written[session_id] = time.monotonic()
+
+    def _save_chunk(
+        self,
+        session_id: str,
+        seq: int,
+        last_seq: int,
+        columns: Dict[str, np.ndarray],
+        replaces: Tuple[str, ...] = (),
+    ):
+        """Write a chunk and index it in place of the `replaces` paths"""
+        # List the existing chunks before adding one
+        self._chunks(session_id)
+        directory = self._session_dir(session_id)
+        os.makedirs(directory, exist_ok=True)
+        first = int(np.floor(columns["timestamp"].min() * 1000))
+        last = int(np.ceil(columns["timestamp"].max() * 1000))
+        seqs = f"{seq:06d}" if seq == last_seq else f"{seq:06d}-{last_seq:06d}"
+        path = os.path.join(directory, f"chunk-{seqs}-{first}-{last}.npz")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, session_id=np.array(session_id), **columns)
+        os.replace(tmp_path, path)
+        with self._index_lock:
+            chunks = [
+                chunk
+                for chunk in self._chunk_index[session_id]
+                if chunk[0] not in replaces
+            ]
+            chunks.append((path, seq, last_seq, first / 1000, last / 1000))
+            chunks.sort(key=lambda chunk: chunk[1])
+            self._chunk_index[session_id] = chunks
+            # Readers that listed a removed chunk retry with the merged one
+            for old_path in replaces:
+                os.remove(old_path)
+
+    def _compact(self, session_id: str, idle: bool = False):
+        """Merge the session's unmerged chunks once there are enough of them,
+        or every chunk of an idle session"""
+        chunks = self._chunks(session_id)
+        if idle:
+            self._last_written.pop(session_id, None)
+        else:
+            chunks = [chunk for chunk in chunks if chunk[1] == chunk[2]]
+            if len(chunks) < self.compact_chunks:
+                return
+        if len(chunks) < 2:
+            return
+        parts = []
+        for path, seq, last_seq, _, _ in chunks:
+            with np.load(path) as chunk:
+                part = {name: chunk[name] for name in _COLUMNS}
+                part["seq"] = (
+                    chunk["seq"]
+                    if "seq" in chunk.files
+                    else np.full(len(part["timestamp"]), seq, dtype=np.int64)
+                )
+            parts.append(part)
+        columns = {
+            name: np.concatenate([part[name] for part in parts])
+            for name in _COLUMNS + ("seq",)
+        }
+        self._save_chunk(
+            session_id,
+            chunks[0][1],
+            chunks[-1][2],
+            columns,
+            replaces=tuple(chunk[0] for chunk in chunks),
+        )
+
+
+def _to_columns(rows: List[Tuple[str, float, float, float]]) -> Dict[str, np.ndarray]:
+    user_ids, timestamps, engagement, attention = zip(*rows)
+    return {
+        "user_id": np.array(user_ids, dtype=str),
+        "timestamp": np.array(timestamps, dtype=np.float64),
+        "engagement": np.array(engagement, dtype=np.float32),
+        "attention": np.array(attention, dtype=np.float32),
+    }
+
+
+def _concat(parts: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    if not parts:
+        return {
+            "user_id": np.array([], dtype=str),
+            "timestamp": np.array([], dtype=np.float64),
+            "engagement": np.array([], dtype=np.float32),
+            "attention": np.array([], dtype=np.float32),
+        }
+    return {
+        name: np.concatenate([part[name] for part in parts]) for name in _COLUMNS
+    }
+
+
+def create_engagement_history() -> EngagementHistory:
+    """Build a history sized by ENGAGEMENT_RING_SIZE, ENGAGEMENT_MAX_SERIES,
+    ENGAGEMENT_MAX_ROLLUPS, ENGAGEMENT_FLUSH_S, ENGAGEMENT_COMPACT_CHUNKS and
+    ENGAGEMENT_COMPACT_IDLE_S"""
+    return EngagementHistory(
+        ring_size=int(os.getenv("ENGAGEMENT_RING_SIZE", "512")),
+        max_series=int(os.getenv("ENGAGEMENT_MAX_SERIES", "10000")),
+        max_rollups=int(os.getenv("ENGAGEMENT_MAX_ROLLUPS", "256")),
+        flush_interval=float(os.getenv("ENGAGEMENT_FLUSH_S", "10")),
+        compact_chunks=int(os.getenv("ENGAGEMENT_COMPACT_CHUNKS", "32")),
+        compact_idle=float(os.getenv("ENGAGEMENT_COMPACT_IDLE_S", "300")),
+    )
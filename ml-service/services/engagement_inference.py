@@ -0,0 +1,149 @@
+import numpy as np
+import os
+import tensorflow as tf
+import threading
+from typing import List
+from .background import MicroBatcher
+from .inference_executor import InferenceExecutor, get_inference_executor
+
+
+class CompiledModelRunner:
+    """Runs a Keras model through one traced graph.
+
+    `model.predict` builds a data adapter and runs the fit/predict loop
+    machinery on every call, which dominates for a handful of samples. This
+    traces `model(x, training=False)` once for a fixed (batch, features)
+    float32 signature and reuses that graph for every batch size.
+    """
+
+    def __init__(self, model: tf.keras.Model):
+        self.model = model
+        self.input_dim = int(model.input_shape[-1])
+        self._forward = tf.function(
+            lambda x: model(x, training=False),
+            input_signature=[tf.TensorSpec([None, self.input_dim], tf.float32)],
+        )
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        return self._forward(tf.convert_to_tensor(batch, tf.float32)).numpy()
+
+    def export_tflite(self, path: str):
+        """Convert the traced graph to a TFLite flatbuffer at path"""
+        converter = tf.lite.TFLiteConverter.from_concrete_functions(
+            [self._forward.get_concrete_function()], self.model
+        )
+        flatbuffer = converter.convert()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(flatbuffer)
+        os.replace(tmp_path, path)
+
+
+class TFLiteModelRunner:
+    """Runs an exported engagement model with the TFLite interpreter"""
+
+    def __init__(self, path: str):
+        self._interpreter = tf.lite.Interpreter(model_path=path)
+        self._interpreter.allocate_tensors()
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self.input_dim = int(self._input["shape"][-1])
+        self._batch_size = int(self._input["shape"][0])
+        # The interpreter is not safe to invoke from several threads at once
+        self._lock = threading.Lock()
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        with self._lock:
+            if len(batch) != self._batch_size:
+                self._interpreter.resize_tensor_input(
+                    self._input["index"], [len(batch), self.input_dim]
+                )
+                self._interpreter.allocate_tensors()
+                self._batch_size = len(batch)
+            self._interpreter.set_tensor(
+                self._input["index"], np.asarray(batch, dtype=np.float32)
+            )
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output["index"]).copy()
+
+
+class PredictionBatcher:
+    """Merges concurrent engagement predictions into one model call.
+
+    Requests wait at most `max_wait` seconds or until `max_batch` samples
+    are pending, then the whole batch runs through the model once on the
+    inference pool and each caller gets its own row back.
+    """
+
+    def __init__(
+        self,
+        runner,
+        executor: InferenceExecutor,
+        max_batch: int = 64,
+        max_wait: float = 0.005,
+    ):
+        self.runner = runner
+        self.executor = executor
+        self._batcher = MicroBatcher(self._process, max_batch, max_wait)
+
+    async def predict(self, features: np.ndarray) -> np.ndarray:
+        """Predict one sample as part of a batch"""
+        features = np.asarray(features, dtype=np.float32)
+        # Check here so one malformed sample can't fail everyone's batch
+        if features.shape != (self.runner.input_dim,):
+            raise ValueError(
+                f"Expected {self.runner.input_dim} features, got {features.shape}"
+            )
+        return await self._batcher.submit(features)
+
+    async def _process(self, batch: List[np.ndarray]) -> np.ndarray:
+        return await self.executor.run(self.runner.predict, np.stack(batch))
+
+
+def create_engagement_runner(model: tf.keras.Model, export: bool = False):
+    """Pick the runtime from ENGAGEMENT_RUNTIME (tf|tflite).
+
+    With tflite, ENGAGEMENT_TFLITE_PATH should hold a model exported from
+    the current weights (`export=True` rewrites it first); the service falls
+    back to the traced graph if it can't be loaded.
+    """
+    compiled = CompiledModelRunner(model)
+    if os.getenv("ENGAGEMENT_RUNTIME", "tf") == "tflite":
+        path = os.getenv("ENGAGEMENT_TFLITE_PATH", "data/engagement_model.tflite")
+        try:
+            if export:
+                compiled.export_tflite(path)
+            runner = TFLiteModelRunner(path)
+            if runner.input_dim == int(model.input_shape[-1]):
+                return runner
+            print(f"TFLite model at {path} does not match the engagement model")
+        except Exception as e:
+            print(f"Error loading TFLite engagement model: {e}")
+    return compiled
+
+
+def create_prediction_batcher(runner) -> PredictionBatcher:
+    """Build a batcher sized by ENGAGEMENT_BATCH_MAX and ENGAGEMENT_BATCH_WAIT_MS"""
+    return PredictionBatcher(
+        runner,
+        get_inference_executor(),
+        max_batch=int(os.getenv("ENGAGEMENT_BATCH_MAX", "64")),
+        max_wait=float(os.getenv("ENGAGEMENT_BATCH_WAIT_MS", "5")) / 1000,
+    )
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Usage: python -m services.engagement_inference export [model_dir] [tflite_path]
+    if len(sys.argv) < 2 or sys.argv[1] != "export":
+        print(
+            "Usage: python -m services.engagement_inference export "
+            "[model_dir] [tflite_path]"
+        )
+        sys.exit(1)
+    model_dir = sys.argv[2] if len(sys.argv) > 2 else "data/engagement_model"
+    path = sys.argv[3] if len(sys.argv) > 3 else "data/engagement_model.tflite"
+    CompiledModelRunner(tf.keras.models.load_model(model_dir)).export_tflite(path)
+    print(f"Exported {model_dir} to {path}")
@@ -1,25 +1,44 @@
+import asyncio
 import numpy as np
 import tensorflow as tf
-from typing import Dict, Any
-import json
+from typing import Dict, Any, List, Optional, Union
 import os
 from datetime import datetime
-from .face_recognition import FaceRecognitionService
+from .face_recognition import FaceRecognitionService, get_face_recognition_service
+from .face_analysis import FaceAnalysis
+from .engagement_inference import create_engagement_runner, create_prediction_batcher
+from .landmark_features import FEATURE_DIM, landmark_encoder
+from .engagement_history import create_engagement_history
+from .engagement_training import RecentFeatures, create_engagement_trainer
 
 class EngagementPredictionService:
-    def __init__(self):
-        self.face_recognition = FaceRecognitionService()
+    def __init__(self, face_recognition: Optional[FaceRecognitionService] = None):
+        # Share the process-wide gallery instead of loading another copy
+        self.face_recognition = face_recognition or get_face_recognition_service()
+        # Feedback trains a copy of the model in the background; versions are
+        # kept so a bad update can be rolled back
+        self.trainer = create_engagement_trainer()
+        self.recent_features = RecentFeatures()
+        self.model_version = self.trainer.registry.current_version()
         self.model = self.load_model()
-        self.user_history = {}
-        self.load_history()
+        # Concurrent predictions share one call into a traced graph
+        self.batcher = create_prediction_batcher(create_engagement_runner(self.model))
+        # Bounded per-student rings in memory, columnar chunks on disk
+        self.history = create_engagement_history()
+        self.history.migrate_legacy('data/engagement_history.json')
 
     def load_model(self) -> tf.keras.Model:
         """Load or create engagement prediction model"""
         try:
+            if self.model_version is not None:
+                return self.trainer.registry.load(self.model_version)
             if os.path.exists('data/engagement_model'):
-                return tf.keras.models.load_model('data/engagement_model')
-            else:
-                return self.create_model()
+                model = tf.keras.models.load_model('data/engagement_model')
+                # Models saved before the canonical encoder expect the wrong shape
+                if model.input_shape[-1] == FEATURE_DIM:
+                    return model
+                print(f"Saved engagement model expects {model.input_shape[-1]} features, recreating it for {FEATURE_DIM}")
+            return self.create_model()
         except Exception as e:
             print(f"Error loading model: {e}")
             return self.create_model()
@@ -27,7 +46,7 @@ class EngagementPredictionService:
     def create_model(self) -> tf.keras.Model:
         """Create a new engagement prediction model"""
         model = tf.keras.Sequential([
-            tf.keras.layers.Dense(128, activation='relu', input_shape=(68,)),
+            tf.keras.layers.Dense(128, activation='relu', input_shape=(FEATURE_DIM,)),
             tf.keras.layers.Dropout(0.2),
             tf.keras.layers.Dense(64, activation='relu'),
             tf.keras.layers.Dropout(0.2),
@@ -43,98 +62,96 @@ class EngagementPredictionService:
         
         return model
 
-    def load_history(self):
-        """Load user engagement history"""
-        try:
-            if os.path.exists('data/engagement_history.json'):
-                with open('data/engagement_history.json', 'r') as f:
-                    self.user_history = json.load(f)
-        except Exception as e:
-            print(f"Error loading engagement history: {e}")
-
-    def save_history(self):
-        """Save user engagement history"""
-        try:
-            os.makedirs('data', exist_ok=True)
-            with open('data/engagement_history.json', 'w') as f:
-                json.dump(self.user_history, f)
-        except Exception as e:
-            print(f"Error saving engagement history: {e}")
-
-    def extract_features(self, face_data: str) -> np.ndarray:
+    def extract_features(self, face_data: Union[str, FaceAnalysis]) -> np.ndarray:
         """Extract features from face data for engagement prediction"""
+        return self.extract_features_batch([face_data])[0]
+
+    def extract_features_batch(self, faces: List[Union[str, FaceAnalysis]]) -> np.ndarray:
+        """Extract features for several faces at once, shape (faces, FEATURE_DIM)"""
         try:
-            # Decode image
-            image = self.face_recognition.decode_base64_image(face_data)
-            
-            # Get face landmarks
-            landmarks = self.face_recognition.get_face_landmarks(image)
-            if not landmarks:
+            # Get face landmarks (reuses the request's decode and detection)
+            landmarks = [self.face_recognition.analyze(face_data).landmarks for face_data in faces]
+            if not all(landmarks):
                 raise ValueError("No face landmarks detected")
             
-            # Flatten landmarks into feature vector
-            features = []
-            for key, points in landmarks.items():
-                for point in points:
-                    features.extend(point)
-            
-            return np.array(features)
+            # Aligned, fixed-order landmark coordinates
+            return landmark_encoder.encode_batch(landmarks)
         except Exception as e:
             raise Exception(f"Feature extraction failed: {e}")
 
-    async def predict(self, face_data: str, user_id: str, session_id: str) -> Dict[str, Any]:
+    async def predict(self, face_data: Union[str, FaceAnalysis], user_id: str, session_id: str) -> Dict[str, Any]:
         """Predict student engagement"""
         try:
             # Extract features
             features = self.extract_features(face_data)
             
             # Make prediction
-            prediction = self.model.predict(np.array([features]))[0]
+            prediction = await self.batcher.predict(features)
             engagement, attention = prediction
+            # Kept so later feedback can label this sample
+            self.recent_features.add(user_id, session_id, features)
             
-            # Update user history
-            if user_id not in self.user_history:
-                self.user_history[user_id] = {}
-            
-            if session_id not in self.user_history[user_id]:
-                self.user_history[user_id][session_id] = []
-            
-            self.user_history[user_id][session_id].append({
-                "timestamp": datetime.now().isoformat(),
-                "engagement": float(engagement),
-                "attention": float(attention)
-            })
-            
-            # Save updated history
-            self.save_history()
+            # Update user history; it is persisted in the background
+            now = datetime.now()
+            self.history.record(user_id, session_id, now.timestamp(), float(engagement), float(attention))
             
             return {
                 "engagement": float(engagement),
                 "attention": float(attention),
-                "timestamp": datetime.now().isoformat()
+                "timestamp": now.isoformat()
             }
         except Exception as e:
             raise Exception(f"Engagement prediction failed: {e}")
 
-    def get_user_engagement_history(self, user_id: str, session_id: str) -> Dict[str, Any]:
-        """Get engagement history for a user in a session"""
-        return self.user_history.get(user_id, {}).get(session_id, [])
+    def get_user_engagement_history(self, user_id: str, session_id: str) -> List[Dict[str, Any]]:
+        """Get recent engagement history for a user in a session"""
+        return self.history.recent(user_id, session_id)
 
-    def train_model(self, user_id: str, session_id: str, feedback: Dict[str, float]):
-        """Update model with user feedback"""
-        try:
-            history = self.get_user_engagement_history(user_id, session_id)
-            if not history:
-                return
-            
-            # Prepare training data
-            X = np.array([self.extract_features(entry["face_data"]) for entry in history])
-            y = np.array([[feedback["engagement"], feedback["attention"]] for _ in history])
-            
-            # Train model
-            self.model.fit(X, y, epochs=1, verbose=0)
-            
-            # Save model
-            self.model.save('data/engagement_model')
-        except Exception as e:
-            print(f"Model training failed: {e}") 
\ No newline at end of file
+    def get_user_engagement_minutes(self, user_id: str, session_id: str) -> List[Dict[str, Any]]:
+        """Get per-minute engagement aggregates for a user in a session"""
+        return self.history.minute_aggregates(user_id, session_id)
+
+    async def get_session_engagement(self, session_id: str, since: Optional[datetime] = None) -> Dict[str, Any]:
+        """Get class-wide engagement timeline, percentiles and per-student summaries"""
+        return await self.history.session_summary(session_id, since.timestamp() if since else None)
+
+    async def train_model(self, user_id: str, session_id: str, feedback: Dict[str, float]) -> int:
+        """Label the user's recent samples with feedback and queue a model update.
+
+        Returns the number of samples labelled. Training happens in the
+        background and never blocks predictions.
+        """
+        features = self.recent_features.take(user_id, session_id)
+        if not features:
+            return 0
+        labels = np.tile([feedback["engagement"], feedback["attention"]], (len(features), 1))
+        await asyncio.to_thread(self.trainer.feedback.append, np.stack(features), labels)
+        self.trainer.request(lambda: self.model, self._swap_model)
+        return len(features)
+
+    async def rollback_model(self, version: Optional[int] = None) -> int:
+        """Serve an earlier model version (by default the one before the current)"""
+        registry = self.trainer.registry
+        if version is None:
+            older = [v for v in registry.versions() if self.model_version is None or v < self.model_version]
+            if not older:
+                raise ValueError("No earlier engagement model version to roll back to")
+            version = older[-1]
+        elif version not in registry.versions():
+            raise ValueError(f"Unknown engagement model version {version}")
+        model = await asyncio.to_thread(registry.load, version)
+        await asyncio.to_thread(registry.set_current, version)
+        await self._swap_model(version, model)
+        return version
+
+    async def _swap_model(self, version: int, model: tf.keras.Model):
+        # Build the runtime off the event loop, then switch both references at
+        # once so every batch sees a complete model
+        runner = await asyncio.to_thread(create_engagement_runner, model, True)
+        self.model = model
+        self.batcher.runner = runner
+        self.model_version = version
+
+    def shutdown(self):
+        self.trainer.shutdown()
+        self.history.close()
\ No newline at end of file
@@ -0,0 +1,272 @@
+import asyncio
+import json
+import numpy as np
+import os
+import re
+import shutil
+import tensorflow as tf
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from .landmark_features import FEATURE_DIM
+
+_VERSION_NAME = re.compile(r"^v(\d+)$")
+
+
+class RecentFeatures:
+    """The latest encoded features of each (user, session), for labelling.
+
+    Feedback arrives after the predictions it refers to, and images are
+    never kept, so the features behind recent predictions are held here
+    until feedback labels them. Bounded to `max_series` series of
+    `per_series` samples each.
+    """
+
+    def __init__(self, per_series: int = 64, max_series: int = 10000):
+        self.per_series = per_series
+        self.max_series = max_series
+        self._series: "OrderedDict[Tuple[str, str], deque]" = OrderedDict()
+
+    def add(self, user_id: str, session_id: str, features: np.ndarray):
+        key = (user_id, session_id)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = deque(maxlen=self.per_series)
+            while len(self._series) > self.max_series:
+                self._series.popitem(last=False)
+        else:
+            self._series.move_to_end(key)
+        series.append(np.asarray(features, dtype=np.float32))
+
+    def take(self, user_id: str, session_id: str) -> List[np.ndarray]:
+        """Remove and return the series' features so each is labelled once"""
+        series = self._series.pop((user_id, session_id), None)
+        return list(series) if series else []
+
+
+class FeedbackStore:
+    """Append-only file of labelled samples: FEATURE_DIM features + 2 labels.
+
+    Rows are raw float32 so appends are a single write and reads are a
+    memory map; no images or landmarks are kept.
+    """
+
+    ROW = FEATURE_DIM + 2
+
+    def __init__(self, path: str = "data/engagement_feedback.f32"):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, features: np.ndarray, labels: np.ndarray):
+        rows = np.hstack(
+            [
+                np.asarray(features, dtype=np.float32).reshape(-1, FEATURE_DIM),
+                np.asarray(labels, dtype=np.float32).reshape(-1, 2),
+            ]
+        )
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "ab") as f:
+                f.write(rows.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+    def __len__(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // (self.ROW * 4)
+
+    def rows(self) -> np.ndarray:
+        """All complete rows, memory-mapped, shape (rows, ROW)"""
+        count = len(self)
+        if not count:
+            return np.empty((0, self.ROW), dtype=np.float32)
+        # A torn final row from a crash is ignored
+        return np.memmap(
+            self.path, dtype=np.float32, mode="r", shape=(count, self.ROW)
+        )
+
+
+class ModelRegistry:
+    """Numbered engagement model versions with an atomically switched CURRENT.
+
+      CURRENT       text file naming the live version
+      v<N>/         SavedModel plus meta.json (trained rows, creation time)
+
+    Publishing writes the new version first and then replaces CURRENT, so a
+    crash leaves the previous version live. Older versions are kept (up to
+    `keep`) for rollback.
+    """
+
+    def __init__(self, directory: str = "data/engagement_models", keep: int = 5):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+    def versions(self) -> List[int]:
+        found = []
+        for name in os.listdir(self.directory):
+            match = _VERSION_NAME.match(name)
+            if match and os.path.exists(self._meta_path(int(match.group(1)))):
+                found.append(int(match.group(1)))
+        return sorted(found)
+
+    def current_version(self) -> Optional[int]:
+        path = os.path.join(self.directory, "CURRENT")
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return int(f.read().strip())
+
+    def metadata(self, version: int) -> Dict[str, Any]:
+        with open(self._meta_path(version), "r") as f:
+            return json.load(f)
+
+    def load(self, version: int) -> tf.keras.Model:
+        return tf.keras.models.load_model(self._version_dir(version))
+
+    def publish(self, model: tf.keras.Model, trained_rows: int) -> int:
+        """Save model as the next version and make it current"""
+        version = max(self.versions(), default=0) + 1
+        directory = self._version_dir(version)
+        model.save(directory)
+        with open(self._meta_path(version), "w") as f:
+            json.dump(
+                {
+                    "version": version,
+                    "trained_rows": trained_rows,
+                    "created_at": datetime.now().isoformat(),
+                },
+                f,
+            )
+        self.set_current(version)
+        self._prune()
+        return version
+
+    def set_current(self, version: int):
+        tmp_path = os.path.join(self.directory, "CURRENT.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(str(version))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.directory, "CURRENT"))
+
+    def _prune(self):
+        current = self.current_version()
+        versions = self.versions()
+        for version in versions[: max(len(versions) - self.keep, 0)]:
+            if version != current:
+                shutil.rmtree(self._version_dir(version), ignore_errors=True)
+
+    def _version_dir(self, version: int) -> str:
+        return os.path.join(self.directory, f"v{version}")
+
+    def _meta_path(self, version: int) -> str:
+        return os.path.join(self._version_dir(version), "meta.json")
+
+
+class EngagementTrainer:
+    """Trains engagement model updates off the serving path.
+
+    Each run copies the live model, fits the copy with mini-batches of the
+    feedback rows added since the last version (mixed with up to `replay`
+    older rows so earlier feedback isn't forgotten) on a dedicated thread,
+    publishes it as a new version and hands it to `on_model`, which swaps
+    it in. Requests made while a run is in progress are coalesced into one
+    follow-up run.
+    """
+
+    def __init__(
+        self,
+        registry: ModelRegistry,
+        feedback: FeedbackStore,
+        batch_size: int = 32,
+        epochs: int = 1,
+        replay: int = 512,
+        min_new_rows: int = 1,
+    ):
+        self.registry = registry
+        self.feedback = feedback
+        self.batch_size = batch_size
+        self.epochs = epochs
+        self.replay = replay
+        self.min_new_rows = min_new_rows
+        self._worker = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="engagement-train"
+        )
+        self._task: Optional[asyncio.Task] = None
+        self._requested = False
+
+    @property
+    def trained_rows(self) -> int:
+        # Taken over every version, so rolling back doesn't retrain on the
+        # feedback that produced the rejected versions
+        return max(
+            (
+                self.registry.metadata(version)["trained_rows"]
+                for version in self.registry.versions()
+            ),
+            default=0,
+        )
+
+    def request(self, model_source, on_model):
+        """Schedule a training run; model_source() returns the live model"""
+        self._requested = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(model_source, on_model))
+
+    async def _run(self, model_source, on_model):
+        loop = asyncio.get_running_loop()
+        while self._requested:
+            self._requested = False
+            try:
+                result = await loop.run_in_executor(
+                    self._worker, self._train, model_source()
+                )
+                if result is not None:
+                    await on_model(*result)
+            except Exception as e:
+                print(f"Engagement training failed: {e}")
+
+    def _train(self, live: tf.keras.Model) -> Optional[Tuple[int, tf.keras.Model]]:
+        rows = self.feedback.rows()
+        start = min(self.trained_rows, len(rows))
+        if len(rows) - start < self.min_new_rows:
+            return None
+        batch = np.asarray(rows[start:])
+        if start and self.replay:
+            replay = np.random.choice(start, min(start, self.replay), replace=False)
+            batch = np.vstack([batch, np.asarray(rows[np.sort(replay)])])
+        np.random.shuffle(batch)
+
+        # Train a copy so the serving model is never touched mid-update
+        model = tf.keras.models.clone_model(live)
+        model.set_weights(live.get_weights())
+        model.compile(
+            optimizer="adam", loss="binary_crossentropy", metrics=["accuracy"]
+        )
+        model.fit(
+            batch[:, :FEATURE_DIM],
+            batch[:, FEATURE_DIM:],
+            batch_size=self.batch_size,
+            epochs=self.epochs,
+            verbose=0,
+        )
+        return self.registry.publish(model, trained_rows=len(rows)), model
+
+    def shutdown(self):
+        self._worker.shutdown(wait=False, cancel_futures=True)
+
+
+def create_engagement_trainer() -> EngagementTrainer:
+    """Build a trainer configured by ENGAGEMENT_TRAIN_BATCH, ENGAGEMENT_TRAIN_EPOCHS,
+    ENGAGEMENT_TRAIN_REPLAY and ENGAGEMENT_MODEL_VERSIONS"""
+    return EngagementTrainer(
+        ModelRegistry(keep=int(os.getenv("ENGAGEMENT_MODEL_VERSIONS", "5"))),
+        FeedbackStore(),
+        batch_size=int(os.getenv("ENGAGEMENT_TRAIN_BATCH", "32")),
+        epochs=int(os.getenv("ENGAGEMENT_TRAIN_EPOCHS", "1")),
+        replay=int(os.getenv("ENGAGEMENT_TRAIN_REPLAY", "512")),
+    )
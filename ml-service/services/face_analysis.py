@@ -0,0 +1,87 @@
+import face_recognition
+import numpy as np
+from typing import Any, Dict, List, Optional
+
+
+class FaceAnalysis:
+    """Per-request cache of the expensive face processing steps.
+
+    The image is decoded once and detection, landmarks, encodings and quality
+    metrics are each computed at most once, so quality checks, verification,
+    registration, anomaly detection and engagement prediction can all share
+    the same work.
+    """
+
+    def __init__(self, service, image: np.ndarray):
+        self._service = service
+        self.image = image
+        self._face_locations: Optional[List[tuple]] = None
+        self._encodings: Optional[List[np.ndarray]] = None
+        self._encoding: Optional[np.ndarray] = None
+        self._landmarks: Optional[Dict[str, Any]] = None
+        self._quality: Optional[Dict[str, Any]] = None
+
+    @property
+    def face_locations(self) -> List[tuple]:
+        """Face locations, detected on first access"""
+        if self._face_locations is None:
+            self._face_locations = self._service.detect_faces(self.image)
+        return self._face_locations
+
+    @property
+    def encoding(self) -> np.ndarray:
+        """Encoding of the first detected face"""
+        if self._encoding is None:
+            if self._encodings is not None and self._encodings:
+                self._encoding = self._encodings[0]
+            else:
+                if not self.face_locations:
+                    raise ValueError("No face detected in image")
+                self._encoding = self._service.get_face_encoding(
+                    self.image, self.face_locations[0]
+                )
+        return self._encoding
+
+    @property
+    def encodings(self) -> List[np.ndarray]:
+        """Encodings of every detected face, in detection order"""
+        if self._encodings is None:
+            if not self.face_locations:
+                self._encodings = []
+            else:
+                self._encodings = face_recognition.face_encodings(
+                    self.image, self.face_locations
+                )
+        return self._encodings
+
+    @property
+    def landmarks(self) -> Dict[str, Any]:
+        """Landmarks of the first detected face"""
+        if self._landmarks is None:
+            self._landmarks = self._service.get_face_landmarks(
+                self.image, self.face_locations[:1]
+            )
+        return self._landmarks
+
+    @property
+    def quality(self) -> Dict[str, Any]:
+        """Quality metrics of the first detected face"""
+        if self._quality is None:
+            self._quality = self._service.compute_face_quality(
+                self.image, self.face_locations
+            )
+        return self._quality
+
+    def warm(self, encoding: bool = True, landmarks: bool = False) -> "FaceAnalysis":
+        """Eagerly compute quality and, optionally, encoding and landmarks.
+
+        Lets the expensive steps run on an inference worker thread so later
+        property access on the event loop only reads cached values.
+        """
+        self.quality
+        if self.face_locations:
+            if encoding:
+                self.encoding
+            if landmarks:
+                self.landmarks
+        return self
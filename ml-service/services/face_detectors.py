@@ -0,0 +1,284 @@
+import cv2
+import face_recognition
+import glob
+import json
+import numpy as np
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List
+from .face_tracker import _iou_matrix
+
+BENCHMARK_PATH = "data/detector_benchmark.json"
+YUNET_MODEL_PATH = "data/models/face_detection_yunet_2023mar.onnx"
+
+
+class FaceDetector(ABC):
+    """Finds faces in an RGB image as (top, right, bottom, left) boxes.
+
+    One instance is shared by every inference pool thread, so detect must be
+    safe to call concurrently.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def detect(self, image: np.ndarray, upsample: int = 1) -> List[tuple]:
+        pass
+
+
+class HOGDetector(FaceDetector):
+    """dlib's HOG detector: CPU-friendly, weaker on small or turned faces"""
+
+    name = "hog"
+
+    def detect(self, image: np.ndarray, upsample: int = 1) -> List[tuple]:
+        return face_recognition.face_locations(
+            image, number_of_times_to_upsample=upsample, model="hog"
+        )
+
+
+class CNNDetector(FaceDetector):
+    """dlib's MMOD CNN detector: most accurate, slow without a GPU"""
+
+    name = "cnn"
+
+    def detect(self, image: np.ndarray, upsample: int = 1) -> List[tuple]:
+        return face_recognition.face_locations(
+            image, number_of_times_to_upsample=upsample, model="cnn"
+        )
+
+
+class YuNetDetector(FaceDetector):
+    """OpenCV's YuNet DNN detector (needs the ONNX model on disk).
+
+    upsample is not used; YuNet finds small faces at native resolution.
+    The network's input size is set per call, so each thread gets its own.
+    """
+
+    name = "yunet"
+
+    def __init__(
+        self,
+        model_path: str = YUNET_MODEL_PATH,
+        score_threshold: float = 0.8,
+    ):
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"YuNet model not found at {model_path}")
+        self.model_path = model_path
+        self.score_threshold = score_threshold
+        self._local = threading.local()
+
+    def detect(self, image: np.ndarray, upsample: int = 1) -> List[tuple]:
+        detector = getattr(self._local, "detector", None)
+        if detector is None:
+            detector = self._local.detector = cv2.FaceDetectorYN.create(
+                self.model_path, "", (320, 320), self.score_threshold
+            )
+        height, width = image.shape[:2]
+        detector.setInputSize((width, height))
+        _, faces = detector.detect(cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+        if faces is None:
+            return []
+        return [
+            _from_xywh(x, y, w, h, width, height) for x, y, w, h in faces[:, :4]
+        ]
+
+
+class HaarDetector(FaceDetector):
+    """OpenCV's frontal-face Haar cascade: fastest, least accurate.
+
+    CascadeClassifier is not thread-safe, so each thread loads its own.
+    """
+
+    name = "haar"
+
+    def __init__(self):
+        self.path = os.path.join(
+            cv2.data.haarcascades, "haarcascade_frontalface_default.xml"
+        )
+        self._local = threading.local()
+        self._cascade()
+
+    def _cascade(self) -> "cv2.CascadeClassifier":
+        cascade = getattr(self._local, "cascade", None)
+        if cascade is None:
+            cascade = cv2.CascadeClassifier(self.path)
+            if cascade.empty():
+                raise FileNotFoundError(f"Haar cascade not found at {self.path}")
+            self._local.cascade = cascade
+        return cascade
+
+    def detect(self, image: np.ndarray, upsample: int = 1) -> List[tuple]:
+        height, width = image.shape[:2]
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        # Each upsample step halves the smallest face looked for, like dlib's
+        min_size = max(12, 40 >> max(upsample, 0))
+        faces = self._cascade().detectMultiScale(
+            gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_size, min_size)
+        )
+        return [_from_xywh(x, y, w, h, width, height) for x, y, w, h in faces]
+
+
+DETECTORS = {
+    HOGDetector.name: HOGDetector,
+    CNNDetector.name: CNNDetector,
+    YuNetDetector.name: YuNetDetector,
+    HaarDetector.name: HaarDetector,
+}
+
+
+def available_detectors() -> Dict[str, FaceDetector]:
+    """Every backend that can be constructed here (e.g. has its model file)"""
+    detectors = {}
+    for name, factory in DETECTORS.items():
+        try:
+            detectors[name] = factory()
+        except Exception as e:
+            print(f"Face detector '{name}' unavailable: {e}")
+    return detectors
+
+
+def load_samples(directory: str) -> List[tuple]:
+    """(RGB image, boxes) pairs from a labelled sample directory.
+
+    Boxes come from `labels.json` ({file name: [[top, right, bottom, left],
+    ...]}), which is required: labelling with one of the detectors would
+    score it a perfect recall and bias the selection. Images without an
+    entry are skipped.
+    """
+    labels_path = os.path.join(directory, "labels.json")
+    if not os.path.exists(labels_path):
+        raise FileNotFoundError(f"Benchmark labels not found at {labels_path}")
+    with open(labels_path, "r") as f:
+        labels = json.load(f)
+    samples = []
+    for path in sorted(glob.glob(os.path.join(directory, "*"))):
+        boxes = labels.get(os.path.basename(path))
+        if boxes is None:
+            continue
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        samples.append((image, [tuple(box) for box in boxes]))
+    return samples
+
+
+def benchmark(
+    detectors: Dict[str, FaceDetector],
+    samples: List[tuple],
+    upsample: int = 1,
+    iou_threshold: float = 0.4,
+) -> Dict[str, Dict[str, float]]:
+    """Mean latency (ms per image) and recall of each detector on samples"""
+    results = {}
+    for name, detector in detectors.items():
+        found = total = 0
+        elapsed = 0.0
+        # One untimed run so lazy initialisation isn't counted
+        if samples:
+            detector.detect(samples[0][0], upsample)
+        for image, truth in samples:
+            started = time.perf_counter()
+            boxes = detector.detect(image, upsample)
+            elapsed += time.perf_counter() - started
+            total += len(truth)
+            if truth and boxes:
+                iou = _iou_matrix(
+                    np.array(truth, dtype=np.float32),
+                    np.array(boxes, dtype=np.float32),
+                )
+                found += int((iou.max(axis=1) >= iou_threshold).sum())
+        results[name] = {
+            "latency_ms": 1000 * elapsed / max(len(samples), 1),
+            "recall": found / total if total else 1.0,
+        }
+    return results
+
+
+def select_detector(results: Dict[str, Dict[str, float]], recall_floor: float) -> str:
+    """The fastest detector meeting recall_floor, else the one with best recall"""
+    eligible = [name for name, r in results.items() if r["recall"] >= recall_floor]
+    if eligible:
+        return min(eligible, key=lambda name: results[name]["latency_ms"])
+    return max(results, key=lambda name: results[name]["recall"])
+
+
+def run_benchmark(samples_dir: str, recall_floor: float) -> dict:
+    """Benchmark every available detector and record the selection"""
+    results = benchmark(available_detectors(), load_samples(samples_dir))
+    report = {
+        "selected": select_detector(results, recall_floor),
+        "recall_floor": recall_floor,
+        "samples_dir": samples_dir,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(BENCHMARK_PATH), exist_ok=True)
+    tmp_path = f"{BENCHMARK_PATH}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, BENCHMARK_PATH)
+    return report
+
+
+def create_detector() -> FaceDetector:
+    """Build the detector named by FACE_DETECTOR (hog|cnn|yunet|haar|auto).
+
+    auto uses the choice recorded by the last benchmark run, or benchmarks
+    now against FACE_DETECTOR_SAMPLES with FACE_DETECTOR_RECALL_FLOOR if
+    there is no record, falling back to HOG without labelled samples.
+    """
+    name = os.getenv("FACE_DETECTOR", "hog")
+    if name == "auto":
+        name = _auto_select()
+    if name not in DETECTORS:
+        raise ValueError(f"Unknown face detector '{name}'")
+    try:
+        return DETECTORS[name]()
+    except Exception as e:
+        print(f"Face detector '{name}' unavailable, using hog: {e}")
+        return HOGDetector()
+
+
+def _auto_select() -> str:
+    if os.path.exists(BENCHMARK_PATH):
+        with open(BENCHMARK_PATH, "r") as f:
+            return json.load(f)["selected"]
+    samples_dir = os.getenv("FACE_DETECTOR_SAMPLES", "data/detector_samples")
+    if not os.path.exists(os.path.join(samples_dir, "labels.json")):
+        return HOGDetector.name
+    recall_floor = float(os.getenv("FACE_DETECTOR_RECALL_FLOOR", "0.9"))
+    return run_benchmark(samples_dir, recall_floor)["selected"]
+
+
+def _from_xywh(x, y, w, h, width: int, height: int) -> tuple:
+    return (
+        max(0, int(y)),
+        min(width, int(x + w)),
+        min(height, int(y + h)),
+        max(0, int(x)),
+    )
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Usage: python -m services.face_detectors benchmark [samples_dir] [recall_floor]
+    if len(sys.argv) < 2 or sys.argv[1] != "benchmark":
+        print(
+            "Usage: python -m services.face_detectors benchmark "
+            "[samples_dir] [recall_floor]"
+        )
+        sys.exit(1)
+    samples_dir = sys.argv[2] if len(sys.argv) > 2 else "data/detector_samples"
+    recall_floor = float(sys.argv[3]) if len(sys.argv) > 3 else 0.9
+    report = run_benchmark(samples_dir, recall_floor)
+    for name, result in sorted(
+        report["results"].items(), key=lambda item: item[1]["latency_ms"]
+    ):
+        print(
+            f"{name:6s} {result['latency_ms']:8.1f} ms  recall {result['recall']:.3f}"
+        )
+    print(f"Selected '{report['selected']}' (recall floor {recall_floor})")
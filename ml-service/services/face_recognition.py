@@ -1,221 +1,417 @@
-import face_recognition
-import numpy as np
-import base64
-import cv2
-import os
-from typing import Dict, Any
-import json
-from datetime import datetime
-
-
-class FaceRecognitionService:
-    def __init__(self):
-        self.face_encodings = {}
-        self.face_locations = {}
-        self.known_face_encodings = []
-        self.known_face_ids = []
-        self.load_known_faces()
-
-    def load_known_faces(self):
-        """Load known face encodings from storage"""
-        try:
-            if os.path.exists("data/face_encodings.json"):
-                with open("data/face_encodings.json", "r") as f:
-                    data = json.load(f)
-                    self.face_encodings = data.get("encodings", {})
-                    self.known_face_encodings = list(self.face_encodings.values())
-                    self.known_face_ids = list(self.face_encodings.keys())
-        except Exception as e:
-            print(f"Error loading face encodings: {e}")
-
-    def save_known_faces(self):
-        """Save known face encodings to storage"""
-        try:
-            os.makedirs("data", exist_ok=True)
-            with open("data/face_encodings.json", "w") as f:
-                json.dump({"encodings": self.face_encodings}, f)
-        except Exception as e:
-            print(f"Error saving face encodings: {e}")
-
-    def decode_base64_image(self, base64_string: str) -> np.ndarray:
-        """Decode base64 image to numpy array"""
-        try:
-            # Remove data URL prefix if present
-            if "," in base64_string:
-                base64_string = base64_string.split(",")[1]
-
-            # Decode base64 string
-            image_data = base64.b64decode(base64_string)
-            nparr = np.frombuffer(image_data, np.uint8)
-            image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        except Exception as e:
-            raise ValueError(f"Invalid image data: {e}")
-
-    async def register_face(self, face_data: str, user_id: str) -> dict:
-        """Register a new face or update if better quality. Returns dict with status and message."""
-        try:
-            # Decode image
-            image = self.decode_base64_image(face_data)
-            # Detect face
-            face_locations = face_recognition.face_locations(image)
-            if not face_locations:
-                raise ValueError("No face detected in image")
-            # Get face encoding
-            face_encoding = face_recognition.face_encodings(image, face_locations)[0]
-            # Compute quality
-            quality = self.compute_face_quality(image)
-            # Check for duplicate face (by encoding)
-            if self.known_face_encodings:
-                face_distances = face_recognition.face_distance(
-                    self.known_face_encodings, face_encoding
-                )
-                best_match_index = int(np.argmin(face_distances))
-                best_match_distance = face_distances[best_match_index]
-                if best_match_distance < 0.6:
-                    matched_user_id = self.known_face_ids[best_match_index]
-                    prev_quality = 0
-                    if matched_user_id in self.face_encodings:
-                        prev_image = None
-                        # Try to reconstruct previous image quality if possible (not always available)
-                        # For now, just use 100 if exists
-                        prev_quality = 100
-                    if quality["score"] > prev_quality:
-                        # Overwrite with better quality
-                        self.face_encodings[matched_user_id] = face_encoding.tolist()
-                        self.save_known_faces()
-                        return {
-                            "status": "updated",
-                            "user_id": matched_user_id,
-                            "message": f"Face updated for user {matched_user_id} (better quality).",
-                        }
-                    else:
-                        return {
-                            "status": "duplicate",
-                            "user_id": matched_user_id,
-                            "message": f"Face already registered for user {matched_user_id} with equal or better quality.",
-                        }
-            # Register new face
-            self.face_encodings[user_id] = face_encoding.tolist()
-            self.known_face_encodings.append(face_encoding)
-            self.known_face_ids.append(user_id)
-            self.save_known_faces()
-            return {
-                "status": "new",
-                "user_id": user_id,
-                "message": f"Face registered for user {user_id}.",
-            }
-        except Exception as e:
-            raise Exception(f"Face registration failed: {e}")
-
-    def get_face_encoding(self, image: np.ndarray, face_location: tuple) -> np.ndarray:
-        """Get face encoding for a specific face location in an image"""
-        try:
-            # Use face_recognition to get face encodings
-            face_encodings = face_recognition.face_encodings(image, [face_location])
-            if not face_encodings:
-                raise ValueError("No face encoding found for the given face location")
-            return face_encodings[0]
-        except Exception as e:
-            raise Exception(f"Failed to get face encoding: {e}")
-
-    def detect_faces(self, image: np.ndarray) -> list:
-        """Detect face locations in an image"""
-        try:
-            # Use face_recognition to detect face locations
-            face_locations = face_recognition.face_locations(image)
-            return face_locations
-        except Exception as e:
-            raise Exception(f"Failed to detect faces: {e}")
-
-    def compute_face_quality(self, image: np.ndarray) -> dict:
-        """Compute face quality metrics for the first detected face in the image."""
-        face_locations = self.detect_faces(image)
-        if not face_locations:
-            return {
-                "sharpness": 0,
-                "brightness": 0,
-                "face_size_pct": 0,
-                "score": 0,
-                "sharpness_good": False,
-                "brightness_good": False,
-                "face_size_good": False,
-                "all_good": False,
-            }
-        top, right, bottom, left = face_locations[0]
-        face_img = image[top:bottom, left:right]
-        gray_face = cv2.cvtColor(face_img, cv2.COLOR_RGB2GRAY)
-        sharpness = cv2.Laplacian(gray_face, cv2.CV_64F).var()
-        brightness = gray_face.mean()
-        face_area = (right - left) * (bottom - top)
-        frame_area = image.shape[0] * image.shape[1]
-        face_size_pct = 100 * face_area / frame_area
-        sharpness_good = sharpness > 80
-        brightness_good = 80 < brightness < 200
-        face_size_good = face_size_pct > 5
-        all_good = sharpness_good and brightness_good and face_size_good
-        score = (
-            (int(sharpness_good) + int(brightness_good) + int(face_size_good)) / 3 * 100
-        )
-        return {
-            "sharpness": sharpness,
-            "brightness": brightness,
-            "face_size_pct": face_size_pct,
-            "score": score,
-            "sharpness_good": sharpness_good,
-            "brightness_good": brightness_good,
-            "face_size_good": face_size_good,
-            "all_good": all_good,
-        }
-
-    async def verify_face(self, face_data: str, user_id: str) -> Dict[str, Any]:
-        """Verify a face against registered faces"""
-        try:
-            # Decode image
-            image = self.decode_base64_image(face_data)
-
-            # Detect face
-            face_locations = face_recognition.face_locations(image)
-            if not face_locations:
-                raise ValueError("No face detected in image")
-
-            # Get face encoding
-            face_encoding = face_recognition.face_encodings(image, face_locations)[0]
-
-            # Compare with known faces
-            if not self.known_face_encodings:
-                return {"match": False, "confidence": 0.0, "face_id": None}
-
-            # Calculate face distances
-            face_distances = face_recognition.face_distance(
-                self.known_face_encodings, face_encoding
-            )
-            best_match_index = np.argmin(face_distances)
-            best_match_distance = face_distances[best_match_index]
-
-            # Convert distance to confidence (0-1)
-            confidence = 1 - best_match_distance
-
-            # Check if it's a match
-            is_match = (
-                best_match_distance < 0.6
-                and self.known_face_ids[best_match_index] == user_id
-            )
-
-            return {
-                "match": is_match,
-                "confidence": float(confidence),
-                "face_id": self.known_face_ids[best_match_index] if is_match else None,
-            }
-        except Exception as e:
-            raise Exception(f"Face verification failed: {e}")
-
-    def get_face_landmarks(self, image: np.ndarray) -> Dict[str, Any]:
-        """Get facial landmarks"""
-        try:
-            face_landmarks_list = face_recognition.face_landmarks(image)
-            if not face_landmarks_list:
-                return {}
-            return face_landmarks_list[0]
-        except Exception as e:
-            raise Exception(f"Failed to get face landmarks: {e}")
+import face_recognition
+import dlib
+import numpy as np
+import base64
+import cv2
+import os
+import asyncio
+from typing import Dict, Any, List, Optional, Union
+import threading
+from datetime import datetime
+from .embedding_store import EmbeddingStore
+from .ann_index import create_index
+from .face_analysis import FaceAnalysis
+from .gallery_storage import create_gallery_storage
+from .face_detectors import create_detector
+
+GALLERY_DIR = "data/gallery"
+LEGACY_ENCODINGS_PATH = "data/face_encodings.json"
+INDEX_PATH = "data/face_index.npz"
+
+
+class FaceRecognitionService:
+    def __init__(self):
+        self.face_locations = {}
+        # Images larger than this (longest side, pixels) are detected on a
+        # downscaled copy; 0 always detects at full resolution
+        self.detect_max_dimension = int(os.getenv("FACE_DETECT_MAX_DIM", "1280"))
+        self.detect_upsample = int(os.getenv("FACE_DETECT_UPSAMPLE", "1"))
+        self.detector = create_detector()
+        self.gallery = EmbeddingStore()
+        self.index = create_index(self.gallery)
+        self.storage = create_gallery_storage(GALLERY_DIR)
+        self.load_known_faces()
+
+    def load_known_faces(self):
+        """Load known face encodings from storage"""
+        try:
+            # Imports face_encodings.json on first start after an upgrade
+            self.gallery = self.storage.load(legacy_json_path=LEGACY_ENCODINGS_PATH)
+            self.index = create_index(self.gallery)
+            self.index.load(INDEX_PATH)
+        except Exception as e:
+            print(f"Error loading face encodings: {e}")
+
+    def save_known_faces(self):
+        """Snapshot the gallery and index, starting a fresh append log.
+
+        Blocking disk I/O; run it on a worker thread from async code.
+        """
+        try:
+            self.storage.compact()
+            self.index.save(INDEX_PATH)
+        except Exception as e:
+            print(f"Error saving face encodings: {e}")
+
+    def store_face(self, user_id: str, face_encoding: np.ndarray):
+        """Add or replace a registered encoding and append it to the log"""
+        self.gallery.add(user_id, face_encoding)
+        self.index.add(user_id, face_encoding)
+        self._persist_face(user_id, face_encoding)
+
+    async def _store_face_async(self, user_id: str, face_encoding: np.ndarray):
+        """store_face with the disk writes moved off the event loop"""
+        self.gallery.add(user_id, face_encoding)
+        self.index.add(user_id, face_encoding)
+        await asyncio.to_thread(self._persist_face, user_id, face_encoding)
+
+    def _persist_face(self, user_id: str, face_encoding: np.ndarray):
+        """Append a stored encoding to the log, compacting when it's due"""
+        try:
+            self.storage.put(user_id, face_encoding)
+        except Exception as e:
+            print(f"Error saving face encoding: {e}")
+        if self.storage.needs_compaction:
+            # Compaction reads the gallery back from disk, not from memory
+            self.save_known_faces()
+
+    def decode_base64_image(self, base64_string: str) -> np.ndarray:
+        """Decode base64 image to numpy array"""
+        try:
+            # Remove data URL prefix if present
+            if "," in base64_string:
+                base64_string = base64_string.split(",")[1]
+
+            # Decode base64 string
+            return self.decode_image_bytes(base64.b64decode(base64_string))
+        except Exception as e:
+            raise ValueError(f"Invalid image data: {e}")
+
+    def decode_image_bytes(self, image_data: bytes) -> np.ndarray:
+        """Decode encoded image bytes (JPEG, PNG, ...) to an RGB numpy array"""
+        nparr = np.frombuffer(image_data, np.uint8)
+        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Invalid image data: could not decode image")
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    def analyze(self, face_data: Union[str, bytes, FaceAnalysis]) -> FaceAnalysis:
+        """Wrap base64 or raw encoded image data in a per-request analysis context"""
+        if isinstance(face_data, FaceAnalysis):
+            return face_data
+        if isinstance(face_data, (bytes, bytearray, memoryview)):
+            # Raw uploads are decoded straight from the request buffer
+            return FaceAnalysis(self, self.decode_image_bytes(face_data))
+        return FaceAnalysis(self, self.decode_base64_image(face_data))
+
+    async def register_face(
+        self, face_data: Union[str, FaceAnalysis], user_id: str
+    ) -> dict:
+        """Register a new face or update if better quality. Returns dict with status and message."""
+        try:
+            analysis = self.analyze(face_data)
+            # Get face encoding (detects the face on first use)
+            face_encoding = analysis.encoding
+            # Compute quality
+            quality = analysis.quality
+            # Check for duplicate face (by encoding)
+            matches = self.index.search(face_encoding, k=1)
+            if matches:
+                matched_user_id, best_match_distance = matches[0]
+                if best_match_distance < 0.6:
+                    prev_quality = 0
+                    if matched_user_id in self.gallery:
+                        # Try to reconstruct previous image quality if possible (not always available)
+                        # For now, just use 100 if exists
+                        prev_quality = 100
+                    if quality["score"] > prev_quality:
+                        # Overwrite with better quality
+                        await self._store_face_async(matched_user_id, face_encoding)
+                        return {
+                            "status": "updated",
+                            "user_id": matched_user_id,
+                            "message": f"Face updated for user {matched_user_id} (better quality).",
+                        }
+                    else:
+                        return {
+                            "status": "duplicate",
+                            "user_id": matched_user_id,
+                            "message": f"Face already registered for user {matched_user_id} with equal or better quality.",
+                        }
+            # Register new face
+            await self._store_face_async(user_id, face_encoding)
+            return {
+                "status": "new",
+                "user_id": user_id,
+                "message": f"Face registered for user {user_id}.",
+            }
+        except Exception as e:
+            raise Exception(f"Face registration failed: {e}")
+
+    def delete_face(self, user_id: str) -> bool:
+        """Remove a registered face. Returns False if the user was not registered."""
+        removed = self.gallery.remove(user_id)
+        self.index.remove(user_id)
+        if removed:
+            try:
+                self.storage.delete(user_id)
+            except Exception as e:
+                print(f"Error saving face deletion: {e}")
+        return removed
+
+    def get_face_encoding(self, image: np.ndarray, face_location: tuple) -> np.ndarray:
+        """Get face encoding for a specific face location in an image"""
+        try:
+            # Use face_recognition to get face encodings
+            face_encodings = face_recognition.face_encodings(image, [face_location])
+            if not face_encodings:
+                raise ValueError("No face encoding found for the given face location")
+            return face_encodings[0]
+        except Exception as e:
+            raise Exception(f"Failed to get face encoding: {e}")
+
+    def detect_faces(
+        self,
+        image: np.ndarray,
+        max_dimension: Optional[int] = None,
+        upsample: Optional[int] = None,
+    ) -> list:
+        """Detect face locations in an image.
+
+        Detection cost grows with pixel count, so images whose longest side
+        exceeds max_dimension are detected on a downscaled copy and the boxes
+        are mapped back to full-resolution coordinates, where encoding runs.
+        upsample trades speed for recall of small faces.
+        """
+        if max_dimension is None:
+            max_dimension = self.detect_max_dimension
+        if upsample is None:
+            upsample = self.detect_upsample
+        try:
+            height, width = image.shape[:2]
+            scale = 1.0
+            if max_dimension and max(height, width) > max_dimension:
+                scale = max_dimension / max(height, width)
+                image = cv2.resize(
+                    image,
+                    (max(1, round(width * scale)), max(1, round(height * scale))),
+                    interpolation=cv2.INTER_AREA,
+                )
+            face_locations = self.detector.detect(image, upsample)
+            if scale == 1.0:
+                return face_locations
+            return [
+                (
+                    max(0, int(top / scale)),
+                    min(width, int(round(right / scale))),
+                    min(height, int(round(bottom / scale))),
+                    max(0, int(left / scale)),
+                )
+                for top, right, bottom, left in face_locations
+            ]
+        except Exception as e:
+            raise Exception(f"Failed to detect faces: {e}")
+
+    def compute_face_quality(
+        self, image: np.ndarray, face_locations: Optional[List[tuple]] = None
+    ) -> dict:
+        """Compute face quality metrics for the first detected face in the image."""
+        if face_locations is None:
+            face_locations = self.detect_faces(image)
+        if not face_locations:
+            return {
+                "sharpness": 0,
+                "brightness": 0,
+                "face_size_pct": 0,
+                "score": 0,
+                "sharpness_good": False,
+                "brightness_good": False,
+                "face_size_good": False,
+                "all_good": False,
+            }
+        top, right, bottom, left = face_locations[0]
+        face_img = image[top:bottom, left:right]
+        gray_face = cv2.cvtColor(face_img, cv2.COLOR_RGB2GRAY)
+        sharpness = cv2.Laplacian(gray_face, cv2.CV_64F).var()
+        brightness = gray_face.mean()
+        face_area = (right - left) * (bottom - top)
+        frame_area = image.shape[0] * image.shape[1]
+        face_size_pct = 100 * face_area / frame_area
+        sharpness_good = sharpness > 80
+        brightness_good = 80 < brightness < 200
+        face_size_good = face_size_pct > 5
+        all_good = sharpness_good and brightness_good and face_size_good
+        score = (
+            (int(sharpness_good) + int(brightness_good) + int(face_size_good)) / 3 * 100
+        )
+        return {
+            "sharpness": sharpness,
+            "brightness": brightness,
+            "face_size_pct": face_size_pct,
+            "score": score,
+            "sharpness_good": sharpness_good,
+            "brightness_good": brightness_good,
+            "face_size_good": face_size_good,
+            "all_good": all_good,
+        }
+
+    async def verify_face(
+        self, face_data: Union[str, FaceAnalysis], user_id: str
+    ) -> Dict[str, Any]:
+        """Verify a face against registered faces"""
+        try:
+            # Get face encoding (detects the face on first use)
+            face_encoding = self.analyze(face_data).encoding
+
+            # Compare with known faces
+            matches = self.index.search(face_encoding, k=1)
+            if not matches:
+                return {"match": False, "confidence": 0.0, "face_id": None}
+            best_match_id, best_match_distance = matches[0]
+
+            # Convert distance to confidence (0-1)
+            confidence = 1 - best_match_distance
+
+            # Check if it's a match
+            is_match = best_match_distance < 0.6 and best_match_id == user_id
+
+            return {
+                "match": is_match,
+                "confidence": float(confidence),
+                "face_id": best_match_id if is_match else None,
+            }
+        except Exception as e:
+            raise Exception(f"Face verification failed: {e}")
+
+    def identify_encodings(
+        self, face_encodings: List[np.ndarray]
+    ) -> List[Dict[str, Any]]:
+        """Identify many encodings against the gallery in one batched search"""
+        if not face_encodings:
+            return []
+        results = []
+        for matches in self.index.search_batch(np.asarray(face_encodings), k=1):
+            if not matches:
+                results.append({"match": False, "confidence": 0.0, "user_id": None})
+                continue
+            best_match_id, best_match_distance = matches[0]
+            is_match = best_match_distance < 0.6
+            results.append(
+                {
+                    "match": is_match,
+                    "confidence": float(1 - best_match_distance),
+                    "user_id": best_match_id if is_match else None,
+                }
+            )
+        return results
+
+    def get_face_encodings_batch(
+        self, images: List[np.ndarray], face_locations: List[List[tuple]]
+    ) -> List[List[np.ndarray]]:
+        """Encode the faces of several images, batching the dlib network call"""
+        encodings: List[List[np.ndarray]] = [[] for _ in images]
+        batch = [i for i, locations in enumerate(face_locations) if locations]
+        if not batch:
+            return encodings
+        try:
+            batch_faces = []
+            for i in batch:
+                detections = dlib.full_object_detections()
+                for shape in face_recognition.api._raw_face_landmarks(
+                    images[i], face_locations[i], model="small"
+                ):
+                    detections.append(shape)
+                batch_faces.append(detections)
+            descriptors = face_recognition.api.face_encoder.compute_face_descriptor(
+                [images[i] for i in batch], batch_faces, 1
+            )
+            for i, image_descriptors in zip(batch, descriptors):
+                encodings[i] = [np.array(d) for d in image_descriptors]
+        except (TypeError, RuntimeError, AttributeError):
+            # dlib builds without the batched overload encode image by image
+            for i in batch:
+                encodings[i] = face_recognition.face_encodings(
+                    images[i], face_locations[i]
+                )
+        return encodings
+
+    def identify_batch(
+        self, images: List[np.ndarray], face_locations: List[List[tuple]]
+    ) -> List[List[Dict[str, Any]]]:
+        """Encode and identify the detected faces of several images at once.
+
+        CPU-bound; call it through the inference executor from async code.
+        """
+        encodings = self.get_face_encodings_batch(images, face_locations)
+        flat = self.identify_encodings(
+            [encoding for image_encodings in encodings for encoding in image_encodings]
+        )
+        results = []
+        offset = 0
+        for locations, image_encodings in zip(face_locations, encodings):
+            image_results = flat[offset : offset + len(image_encodings)]
+            offset += len(image_encodings)
+            for result, location in zip(image_results, locations):
+                result["location"] = location
+            results.append(image_results)
+        return results
+
+    def identify_images(self, images: List[Union[str, bytes]]) -> List[Dict[str, Any]]:
+        """Decode, detect, encode and identify the faces of several images.
+
+        Each image becomes {"faces": [...]}, or {"error": ...} if it could
+        not be decoded or detected, so one bad image doesn't fail the rest.
+        Encoding and gallery matching of every face run as one batch.
+
+        CPU-bound; call it through the inference executor from async code.
+        """
+        results: List[Dict[str, Any]] = []
+        decoded, locations, indices = [], [], []
+        for i, face_data in enumerate(images):
+            try:
+                analysis = self.analyze(face_data)
+                face_locations = analysis.face_locations
+            except Exception as e:
+                results.append({"error": str(e)})
+                continue
+            results.append({"faces": []})
+            decoded.append(analysis.image)
+            locations.append(face_locations)
+            indices.append(i)
+        for i, faces in zip(indices, self.identify_batch(decoded, locations)):
+            for face in faces:
+                face["location"] = [int(v) for v in face["location"]]
+            results[i]["faces"] = faces
+        return results
+
+    def get_face_landmarks(
+        self, image: np.ndarray, face_locations: Optional[List[tuple]] = None
+    ) -> Dict[str, Any]:
+        """Get facial landmarks"""
+        try:
+            face_landmarks_list = face_recognition.face_landmarks(
+                image, face_locations
+            )
+            if not face_landmarks_list:
+                return {}
+            return face_landmarks_list[0]
+        except Exception as e:
+            raise Exception(f"Failed to get face landmarks: {e}")
+
+
+_shared_service: Optional[FaceRecognitionService] = None
+_shared_service_lock = threading.Lock()
+
+
+def get_face_recognition_service() -> FaceRecognitionService:
+    """Process-wide FaceRecognitionService shared by every ML service.
+
+    The gallery is loaded once at first use and registrations made through
+    any caller are visible to all of them.
+    """
+    global _shared_service
+    if _shared_service is None:
+        with _shared_service_lock:
+            if _shared_service is None:
+                _shared_service = FaceRecognitionService()
+    return _shared_service
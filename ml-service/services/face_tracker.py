@@ -0,0 +1,162 @@
+import itertools
+import math
+import time
+import numpy as np
+from typing import Any, List, Optional
+
+
+class Track:
+    """A face followed across frames, with its cached identity"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, location: tuple, now: float):
+        self.track_id = next(Track._ids)
+        self.location = location
+        self.identity: Any = None
+        self.confidence = 0.0
+        self.verified_at: Optional[float] = None
+        self.last_seen = now
+        self.missed = 0
+
+
+class FaceTracker:
+    """Associates face detections across frames and caches identities.
+
+    Detections are matched to existing tracks greedily by IoU, then by
+    centroid distance (relative to box size) for faces that moved further.
+    A track keeps its identity, so only faces that are new, due for
+    periodic re-verification, or whose last match was weak need to be
+    encoded again.
+    """
+
+    def __init__(
+        self,
+        iou_threshold: float = 0.3,
+        max_centroid_shift: float = 0.5,
+        reverify_interval: float = 5.0,
+        retry_interval: float = 0.5,
+        min_confidence: float = 0.5,
+        max_missed: int = 10,
+    ):
+        self.iou_threshold = iou_threshold
+        self.max_centroid_shift = max_centroid_shift
+        self.reverify_interval = reverify_interval
+        self.retry_interval = retry_interval
+        self.min_confidence = min_confidence
+        self.max_missed = max_missed
+        self.tracks: List[Track] = []
+
+    def update(
+        self, face_locations: List[tuple], now: Optional[float] = None
+    ) -> List[Track]:
+        """Assign each (top, right, bottom, left) detection to a track, in order"""
+        now = time.monotonic() if now is None else now
+        assigned: List[Optional[Track]] = [None] * len(face_locations)
+        unmatched = set(range(len(self.tracks)))
+
+        if self.tracks and face_locations:
+            track_boxes = np.array(
+                [t.location for t in self.tracks], dtype=np.float32
+            )
+            boxes = np.array(face_locations, dtype=np.float32)
+            iou = _iou_matrix(track_boxes, boxes)
+            # Greedy association, best overlaps first
+            for flat in np.argsort(-iou, axis=None):
+                t, d = np.unravel_index(flat, iou.shape)
+                if iou[t, d] < self.iou_threshold:
+                    break
+                if t in unmatched and assigned[d] is None:
+                    assigned[d] = self.tracks[t]
+                    unmatched.discard(t)
+            # Fall back to centroid distance for faces that moved further
+            for d, location in enumerate(face_locations):
+                if assigned[d] is not None or not unmatched:
+                    continue
+                candidates = list(unmatched)
+                shifts = _centroid_shift(track_boxes[candidates], boxes[d])
+                best = int(np.argmin(shifts))
+                if shifts[best] <= self.max_centroid_shift:
+                    assigned[d] = self.tracks[candidates[best]]
+                    unmatched.discard(candidates[best])
+
+        for d, location in enumerate(face_locations):
+            track = assigned[d]
+            if track is None:
+                track = Track(location, now)
+                self.tracks.append(track)
+            track.location = location
+            track.last_seen = now
+            track.missed = 0
+            assigned[d] = track
+
+        for t in unmatched:
+            self.tracks[t].missed += 1
+        self.tracks = [t for t in self.tracks if t.missed <= self.max_missed]
+        return assigned
+
+    def needs_identification(
+        self, track: Track, now: Optional[float] = None, pending: bool = False
+    ) -> bool:
+        """Whether the track's face should be encoded and matched this frame.
+
+        Weak matches and `pending` tracks (whose identity still needs more
+        independent matches, e.g. to confirm a check-in) are retried every
+        `retry_interval`, others re-verified every `reverify_interval`.
+        """
+        now = time.monotonic() if now is None else now
+        if track.verified_at is None:
+            return True
+        age = now - track.verified_at
+        if pending or track.confidence < self.min_confidence:
+            return age >= self.retry_interval
+        return age >= self.reverify_interval
+
+    def retry_spacing(self, frame_interval: Optional[float] = None) -> float:
+        """Shortest time between two identifications of a retried track.
+
+        Tracks are only looked at once per processed frame, so a retry lands
+        on the first frame at least `retry_interval` after the last one.
+        """
+        if not frame_interval:
+            return self.retry_interval
+        frames = max(1, math.ceil(self.retry_interval / frame_interval - 1e-6))
+        return frames * frame_interval
+
+    def set_identity(
+        self,
+        track: Track,
+        identity: Any,
+        confidence: float,
+        now: Optional[float] = None,
+    ):
+        """Cache the result of identifying a track's face"""
+        track.identity = identity
+        track.confidence = confidence
+        track.verified_at = time.monotonic() if now is None else now
+
+    def reset(self):
+        self.tracks = []
+
+
+def _iou_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """IoU between (top, right, bottom, left) boxes, shape (len(a), len(b))"""
+    top = np.maximum(a[:, None, 0], b[None, :, 0])
+    right = np.minimum(a[:, None, 1], b[None, :, 1])
+    bottom = np.minimum(a[:, None, 2], b[None, :, 2])
+    left = np.maximum(a[:, None, 3], b[None, :, 3])
+    intersection = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    area_a = (a[:, 1] - a[:, 3]) * (a[:, 2] - a[:, 0])
+    area_b = (b[:, 1] - b[:, 3]) * (b[:, 2] - b[:, 0])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-6), 0.0)
+
+
+def _centroid_shift(boxes: np.ndarray, box: np.ndarray) -> np.ndarray:
+    """Centroid distance from box to each of boxes, relative to box size"""
+    centers = np.stack(
+        [(boxes[:, 3] + boxes[:, 1]) / 2, (boxes[:, 0] + boxes[:, 2]) / 2], axis=1
+    )
+    center = np.array([(box[3] + box[1]) / 2, (box[0] + box[2]) / 2])
+    size = max(box[1] - box[3], box[2] - box[0], 1.0)
+    return np.linalg.norm(centers - center, axis=1) / size
@@ -0,0 +1,370 @@
+import fcntl
+import glob
+import json
+import numpy as np
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import List, Optional
+from .embedding_store import EmbeddingStore
+
+OP_PUT = 1
+OP_DELETE = 2
+
+# crc32, op, id length; followed by the UTF-8 id and, for puts, the vector
+RECORD_HEADER = struct.Struct("<IBH")
+
+
+class GalleryStorage:
+    """Crash-safe on-disk gallery: binary snapshot plus an append-only log.
+
+    Layout of `directory` for generation N:
+      CURRENT              text file naming the live snapshot generation
+      snapshot-N.npy       float32 (rows x dim) encodings
+      ids-N.npy            IDs in row order
+      log-N.bin            put/delete records written since snapshot N
+
+    Registrations append one small checksummed record instead of rewriting
+    the gallery. Compaction rotates to a fresh log, writes the next snapshot
+    to temporary files and publishes it by atomically replacing CURRENT, so a
+    crash at any point leaves either the old or the new generation intact.
+    On load, torn records at the end of a log are truncated away.
+
+    Several worker processes can share one directory. Appends, log rotation
+    and publishing hold an flock on `LOCK`, every append goes to the newest
+    log, and compaction rebuilds the snapshot from the files on disk rather
+    than from one process's memory, so no worker's records are dropped. Only
+    one process compacts at a time (`COMPACT` lock); the others skip.
+
+    With `mmap=True` the snapshot is memory-mapped rather than read, so
+    startup cost does not grow with the gallery and workers on one host share
+    its pages through the OS page cache. Build a fresh snapshot before
+    rolling out (`python -m services.gallery_storage compact`) so there is no
+    log to replay, since replaying copies the gallery into private memory.
+    """
+
+    def __init__(
+        self,
+        directory: str = "data/gallery",
+        dim: int = 128,
+        fsync: str = "always",
+        fsync_interval: float = 1.0,
+        compact_min_records: int = 1000,
+        mmap: bool = False,
+    ):
+        if fsync not in ("always", "interval", "never"):
+            raise ValueError(f"Unknown fsync policy '{fsync}'")
+        self.directory = directory
+        self.dim = dim
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.compact_min_records = compact_min_records
+        self.mmap = mmap
+        self._lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._lock_file = None
+        self._log_file = None
+        self._log_gen = 0
+        self._log_records = 0
+        self._snapshot_gen = 0
+        self._snapshot_size = 0
+        self._last_fsync = 0.0
+        # With the interval policy, fsyncs an append put off are done by this
+        self._sync_timer: Optional[threading.Timer] = None
+
+    def load(self, legacy_json_path: Optional[str] = None) -> EmbeddingStore:
+        """Load the latest snapshot and replay every newer log.
+
+        When no snapshot exists yet and `legacy_json_path` points at the old
+        face_encodings.json, its encodings are imported as generation 1.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with self._exclusive():
+            self._snapshot_gen = self._read_current()
+            if self._snapshot_gen == 0 and legacy_json_path and os.path.exists(
+                legacy_json_path
+            ):
+                with open(legacy_json_path, "r") as f:
+                    store = EmbeddingStore.from_dict(
+                        json.load(f).get("encodings", {}), dim=self.dim
+                    )
+                self._write_snapshot(1, store.ids, store.vectors)
+                self._snapshot_gen = 1
+
+            store = self._read_snapshot(self._snapshot_gen, self.mmap)
+            self._snapshot_size = len(store)
+
+            log_gens = [
+                g for g in self._generations("log") if g >= self._snapshot_gen
+            ]
+            self._log_records = 0
+            for gen in log_gens:
+                self._log_records += self._replay(self._path("log", gen), store)
+            self._log_gen = max(log_gens, default=self._snapshot_gen)
+            self._open_log(self._log_gen)
+        return store
+
+    def put(self, face_id: str, encoding) -> None:
+        """Append an insert/update record"""
+        vector = np.asarray(encoding, dtype=np.float32).reshape(-1)
+        self._append(OP_PUT, face_id, vector.tobytes())
+
+    def delete(self, face_id: str) -> None:
+        """Append a delete record"""
+        self._append(OP_DELETE, face_id, b"")
+
+    @property
+    def needs_compaction(self) -> bool:
+        return self._log_records >= max(self.compact_min_records, self._snapshot_size)
+
+    def compact(self) -> bool:
+        """Fold every log into a new snapshot generation and drop older files.
+
+        The snapshot is rebuilt from the current snapshot and logs on disk,
+        so records appended by other processes are kept. Returns False
+        without doing anything if another thread or process is compacting.
+        Blocking; run it on a worker thread from async code.
+        """
+        if not self._snapshot_lock.acquire(blocking=False):
+            return False
+        try:
+            with open(os.path.join(self.directory, "COMPACT"), "a") as guard:
+                try:
+                    fcntl.flock(guard.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+                with self._exclusive():
+                    self._follow_log()
+                    base = self._read_current()
+                    gen = self._log_gen + 1
+                    self._open_log(gen)
+                    self._log_gen = gen
+                    self._log_records = 0
+                # Every writer now appends to log `gen`; older logs are frozen
+                store = self._read_snapshot(base, mmap=False)
+                for log_gen in self._generations("log"):
+                    if base <= log_gen < gen:
+                        self._replay(self._path("log", log_gen), store)
+                self._write_arrays(gen, store.ids, store.vectors)
+                with self._exclusive():
+                    self._publish(gen)
+                    self._snapshot_gen = gen
+                    self._snapshot_size = len(store)
+                    for kind in ("snapshot", "ids", "log"):
+                        for old_gen in self._generations(kind):
+                            if old_gen < gen:
+                                os.remove(self._path(kind, old_gen))
+                return True
+        finally:
+            self._snapshot_lock.release()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._sync_timer is not None:
+                self._sync_timer.cancel()
+                self._sync_timer = None
+            if self._log_file is not None:
+                self._log_file.flush()
+                os.fsync(self._log_file.fileno())
+                self._log_file.close()
+                self._log_file = None
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+    @contextmanager
+    def _exclusive(self):
+        """Hold the in-process lock and the cross-process directory lock"""
+        with self._lock:
+            if self._lock_file is None:
+                self._lock_file = open(os.path.join(self.directory, "LOCK"), "a")
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _follow_log(self):
+        """Switch to the newest log if another process has rotated since"""
+        if os.path.exists(self._path("log", self._log_gen)) and not os.path.exists(
+            self._path("log", self._log_gen + 1)
+        ):
+            return
+        self._log_gen = max(self._generations("log"), default=self._log_gen)
+        self._log_records = 0
+        self._open_log(self._log_gen)
+
+    def _append(self, op: int, face_id: str, payload: bytes) -> None:
+        id_bytes = face_id.encode("utf-8")
+        body = bytes([op]) + struct.pack("<H", len(id_bytes)) + id_bytes + payload
+        record = (
+            RECORD_HEADER.pack(zlib.crc32(body), op, len(id_bytes))
+            + id_bytes
+            + payload
+        )
+        with self._exclusive():
+            self._follow_log()
+            self._log_file.write(record)
+            self._log_file.flush()
+            now = time.monotonic()
+            if self.fsync == "always" or (
+                self.fsync == "interval"
+                and now - self._last_fsync >= self.fsync_interval
+            ):
+                os.fsync(self._log_file.fileno())
+                self._last_fsync = now
+            elif self.fsync == "interval" and self._sync_timer is None:
+                # Make sure the tail of a burst is synced even if nothing
+                # else is appended after it
+                self._sync_timer = threading.Timer(
+                    self._last_fsync + self.fsync_interval - now, self._sync
+                )
+                self._sync_timer.daemon = True
+                self._sync_timer.start()
+            self._log_records += 1
+
+    def _sync(self):
+        with self._lock:
+            self._sync_timer = None
+            if self._log_file is not None:
+                os.fsync(self._log_file.fileno())
+                self._last_fsync = time.monotonic()
+
+    def _replay(self, path: str, store: EmbeddingStore) -> int:
+        """Apply a log to the store, truncating any torn tail. Returns record count."""
+        with open(path, "rb") as f:
+            data = f.read()
+        vector_size = self.dim * 4
+        offset = 0
+        records = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            crc, op, id_len = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + id_len + (vector_size if op == OP_PUT else 0)
+            if op not in (OP_PUT, OP_DELETE) or end > len(data):
+                break
+            body = bytes([op]) + struct.pack("<H", id_len) + data[start:end]
+            if zlib.crc32(body) != crc:
+                break
+            face_id = data[start : start + id_len].decode("utf-8")
+            if op == OP_PUT:
+                vector = np.frombuffer(data, np.float32, self.dim, start + id_len)
+                store.add(face_id, vector)
+            else:
+                store.remove(face_id)
+            offset = end
+            records += 1
+        if offset < len(data):
+            print(f"Truncating {len(data) - offset} torn bytes from {path}")
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+                os.fsync(f.fileno())
+        return records
+
+    def _write_snapshot(self, gen: int, ids: List[str], vectors: np.ndarray):
+        self._write_arrays(gen, ids, vectors)
+        self._publish(gen)
+
+    def _write_arrays(self, gen: int, ids: List[str], vectors: np.ndarray):
+        ids_array = np.array(ids, dtype=str) if ids else np.empty(0, dtype="<U1")
+        self._write_atomic(self._path("snapshot", gen), vectors.astype(np.float32))
+        self._write_atomic(self._path("ids", gen), ids_array)
+
+    def _publish(self, gen: int):
+        current_tmp = os.path.join(self.directory, "CURRENT.tmp")
+        with open(current_tmp, "w") as f:
+            f.write(f"{gen}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(current_tmp, os.path.join(self.directory, "CURRENT"))
+        self._fsync_directory()
+
+    def _read_snapshot(self, gen: int, mmap: bool) -> EmbeddingStore:
+        if not gen:
+            return EmbeddingStore(dim=self.dim)
+        if mmap:
+            vectors = np.load(self._path("snapshot", gen), mmap_mode="r")
+            ids = np.load(self._path("ids", gen), mmap_mode="r")
+            return EmbeddingStore.from_mapped(ids, vectors, dim=self.dim)
+        vectors = np.load(self._path("snapshot", gen))
+        ids = np.load(self._path("ids", gen)).tolist()
+        return EmbeddingStore.from_arrays(ids, vectors, dim=self.dim)
+
+    def _write_atomic(self, path: str, array: np.ndarray):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _open_log(self, gen: int):
+        if self._log_file is not None:
+            self._log_file.flush()
+            os.fsync(self._log_file.fileno())
+            self._log_file.close()
+        self._log_file = open(self._path("log", gen), "ab")
+        self._fsync_directory()
+
+    def _read_current(self) -> int:
+        try:
+            with open(os.path.join(self.directory, "CURRENT"), "r") as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _generations(self, kind: str) -> List[int]:
+        extension = "bin" if kind == "log" else "npy"
+        pattern = re.compile(rf"{kind}-(\d+)\.{extension}$")
+        gens = []
+        for path in glob.glob(os.path.join(self.directory, f"{kind}-*.{extension}")):
+            match = pattern.search(path)
+            if match:
+                gens.append(int(match.group(1)))
+        return sorted(gens)
+
+    def _path(self, kind: str, gen: int) -> str:
+        extension = "bin" if kind == "log" else "npy"
+        return os.path.join(self.directory, f"{kind}-{gen:08d}.{extension}")
+
+    def _fsync_directory(self):
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+def create_gallery_storage(directory: str = "data/gallery") -> GalleryStorage:
+    """Build gallery storage configured from FACE_STORE_* environment variables"""
+    return GalleryStorage(
+        directory,
+        fsync=os.getenv("FACE_STORE_FSYNC", "always").lower(),
+        fsync_interval=float(os.getenv("FACE_STORE_FSYNC_INTERVAL", "1.0")),
+        compact_min_records=int(os.getenv("FACE_STORE_COMPACT_RECORDS", "1000")),
+        mmap=os.getenv("FACE_GALLERY_MMAP", "false").lower() in ("1", "true", "yes"),
+    )
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Usage: python -m services.gallery_storage compact [directory]
+    if len(sys.argv) < 2 or sys.argv[1] != "compact":
+        print("Usage: python -m services.gallery_storage compact [directory]")
+        sys.exit(1)
+    directory = sys.argv[2] if len(sys.argv) > 2 else "data/gallery"
+    storage = GalleryStorage(directory)
+    gallery = storage.load(legacy_json_path="data/face_encodings.json")
+    storage.compact()
+    storage.close()
+    print(f"Wrote snapshot of {len(gallery)} faces to {directory}")
@@ -0,0 +1,57 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Optional
+
+
+class InferenceExecutor:
+    """Bounded thread pool for CPU-bound face work.
+
+    dlib detection/encoding and NumPy matching release the GIL, so running
+    them on worker threads keeps the event loop free for WebSocket receives
+    and REST requests. At most `max_workers` jobs run and at most
+    `max_pending` more wait for a thread; callers beyond that wait in `run`
+    before anything is queued, which pushes back on the producer.
+    """
+
+    def __init__(
+        self, max_workers: Optional[int] = None, max_pending: Optional[int] = None
+    ):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = (
+            max_pending if max_pending is not None else self.max_workers * 2
+        )
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="inference"
+        )
+        self._slots = asyncio.Semaphore(self.max_workers + self.max_pending)
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run fn in the pool, waiting for a free slot first"""
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, partial(fn, *args, **kwargs))
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+_shared_executor: Optional[InferenceExecutor] = None
+_shared_executor_lock = threading.Lock()
+
+
+def get_inference_executor() -> InferenceExecutor:
+    """Process-wide inference pool sized by INFERENCE_WORKERS / INFERENCE_QUEUE"""
+    global _shared_executor
+    if _shared_executor is None:
+        with _shared_executor_lock:
+            if _shared_executor is None:
+                workers = os.getenv("INFERENCE_WORKERS")
+                pending = os.getenv("INFERENCE_QUEUE")
+                _shared_executor = InferenceExecutor(
+                    max_workers=int(workers) if workers else None,
+                    max_pending=int(pending) if pending else None,
+                )
+    return _shared_executor
@@ -0,0 +1,172 @@
+import numpy as np
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+Landmarks = Dict[str, Sequence[Tuple[float, float]]]
+
+# face_recognition's 68-point model reports 72 points across these groups
+# (the lip groups share their corner points); encoders always use this order
+CANONICAL_GROUPS = [
+    ("chin", 17),
+    ("left_eyebrow", 5),
+    ("right_eyebrow", 5),
+    ("nose_bridge", 4),
+    ("nose_tip", 5),
+    ("left_eye", 6),
+    ("right_eye", 6),
+    ("top_lip", 12),
+    ("bottom_lip", 12),
+]
+CANONICAL_POINTS = sum(count for _, count in CANONICAL_GROUPS)
+FEATURE_DIM = CANONICAL_POINTS * 2
+
+
+def _group_slice(name: str) -> slice:
+    start = 0
+    for group, count in CANONICAL_GROUPS:
+        if group == name:
+            return slice(start, start + count)
+        start += count
+    raise KeyError(name)
+
+
+_LEFT_EYE = _group_slice("left_eye")
+_RIGHT_EYE = _group_slice("right_eye")
+
+# Scale-normalised distances that carry most of the signal: eye openness and
+# width, mouth opening and width, brow raise, nose length and jaw proportions.
+# Points are (landmark group, index) in face_recognition's 68-point layout.
+REDUCED_PAIRS = [
+    (("left_eye", 1), ("left_eye", 5)),
+    (("left_eye", 2), ("left_eye", 4)),
+    (("left_eye", 0), ("left_eye", 3)),
+    (("right_eye", 1), ("right_eye", 5)),
+    (("right_eye", 2), ("right_eye", 4)),
+    (("right_eye", 0), ("right_eye", 3)),
+    (("top_lip", 0), ("top_lip", 6)),
+    (("top_lip", 9), ("bottom_lip", 9)),
+    (("top_lip", 3), ("bottom_lip", 3)),
+    (("left_eyebrow", 2), ("left_eye", 1)),
+    (("right_eyebrow", 2), ("right_eye", 2)),
+    (("nose_bridge", 0), ("nose_tip", 2)),
+    (("nose_tip", 2), ("chin", 8)),
+    (("chin", 0), ("chin", 16)),
+    (("chin", 4), ("chin", 12)),
+]
+
+
+@lru_cache(maxsize=None)
+def _pair_indices(n: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Upper triangle in row-major order, i.e. the (i, j > i) loop order
+    return np.triu_indices(n, k=1)
+
+
+def pairwise_distances(landmarks: Landmarks) -> np.ndarray:
+    """Distances between every pair of points within each landmark group.
+
+    Groups are concatenated in the order of `landmarks`, and pairs within a
+    group follow (0, 1), (0, 2), ..., (n-2, n-1).
+    """
+    return pairwise_distances_batch([landmarks])[0]
+
+
+def pairwise_distances_batch(faces: List[Landmarks]) -> np.ndarray:
+    """pairwise_distances for several faces with the same layout, (faces, features)"""
+    if not faces:
+        return np.empty((0, 0))
+    features = []
+    for group in faces[0]:
+        points = np.asarray([face[group] for face in faces], dtype=np.float64)
+        i, j = _pair_indices(points.shape[1])
+        features.append(np.linalg.norm(points[:, i] - points[:, j], axis=-1))
+    return np.concatenate(features, axis=1)
+
+
+def reduced_distances(landmarks: Landmarks) -> np.ndarray:
+    """REDUCED_PAIRS distances divided by the distance between the eyes"""
+    return reduced_distances_batch([landmarks])[0]
+
+
+def reduced_distances_batch(faces: List[Landmarks]) -> np.ndarray:
+    """reduced_distances for several faces, (faces, len(REDUCED_PAIRS))"""
+    if not faces:
+        return np.empty((0, len(REDUCED_PAIRS)))
+    a = np.asarray(
+        [[face[g][k] for (g, k), _ in REDUCED_PAIRS] for face in faces],
+        dtype=np.float64,
+    )
+    b = np.asarray(
+        [[face[g][k] for _, (g, k) in REDUCED_PAIRS] for face in faces],
+        dtype=np.float64,
+    )
+    left_eye = np.asarray([face["left_eye"] for face in faces], dtype=np.float64)
+    right_eye = np.asarray([face["right_eye"] for face in faces], dtype=np.float64)
+    scale = np.linalg.norm(left_eye.mean(axis=1) - right_eye.mean(axis=1), axis=-1)
+    distances = np.linalg.norm(a - b, axis=-1)
+    return distances / np.maximum(scale, 1e-6)[:, None]
+
+
+class LandmarkEncoder:
+    """Encodes landmarks as a fixed-order, aligned float32 vector.
+
+    Points are gathered in CANONICAL_GROUPS order regardless of dict order,
+    centred between the eyes, rotated so the eyes are level and divided by
+    the distance between them, so the encoding does not depend on where the
+    face is in the frame, its size or its roll. Each face becomes
+    FEATURE_DIM values laid out as x0, y0, x1, y1, ...
+
+    Points are gathered into a per-thread buffer that is reused across
+    calls, so steady-state encoding does not allocate beyond the result.
+    """
+
+    def __init__(self, initial_batch: int = 16):
+        self.initial_batch = initial_batch
+        self._local = threading.local()
+
+    def encode(self, landmarks: Landmarks) -> np.ndarray:
+        """Encode one face, shape (FEATURE_DIM,)"""
+        return self.encode_batch([landmarks])[0]
+
+    def encode_batch(
+        self, faces: List[Landmarks], out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Encode several faces, shape (faces, FEATURE_DIM), into out if given"""
+        n = len(faces)
+        points = self._buffer(n)
+        for f, landmarks in enumerate(faces):
+            row = 0
+            for group, count in CANONICAL_GROUPS:
+                group_points = landmarks.get(group)
+                if group_points is None or len(group_points) != count:
+                    raise ValueError(f"Expected {count} '{group}' landmarks")
+                points[f, row : row + count] = group_points
+                row += count
+
+        left = points[:, _LEFT_EYE].mean(axis=1)
+        right = points[:, _RIGHT_EYE].mean(axis=1)
+        points -= ((left + right) / 2)[:, None, :]
+        axis = right - left
+        scale = np.maximum(np.linalg.norm(axis, axis=1), 1e-6)
+        cos = (axis[:, 0] / scale)[:, None]
+        sin = (axis[:, 1] / scale)[:, None]
+
+        if out is None:
+            out = np.empty((n, FEATURE_DIM), dtype=np.float32)
+        aligned = out.reshape(n, CANONICAL_POINTS, 2)
+        x, y = points[:, :, 0], points[:, :, 1]
+        aligned[:, :, 0] = (x * cos + y * sin) / scale[:, None]
+        aligned[:, :, 1] = (y * cos - x * sin) / scale[:, None]
+        return out
+
+    def _buffer(self, n: int) -> np.ndarray:
+        buffer = getattr(self._local, "points", None)
+        if buffer is None or len(buffer) < n:
+            size = max(n, self.initial_batch, 0 if buffer is None else 2 * len(buffer))
+            buffer = np.empty((size, CANONICAL_POINTS, 2), dtype=np.float32)
+            self._local.points = buffer
+        return buffer[:n]
+
+
+# Shared by the engagement and anomaly services
+landmark_encoder = LandmarkEncoder()
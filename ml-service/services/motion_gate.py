@@ -0,0 +1,144 @@
+import cv2
+import numpy as np
+import time
+from typing import Callable, List, Optional
+
+
+class MotionGate:
+    """Skips face detection on frames where nothing has moved.
+
+    Each frame is reduced to a small blurred grayscale thumbnail and compared
+    with the thumbnail of the last frame that was actually detected on (so
+    slow drift still accumulates into a change). Then:
+
+      * no change        -> the cached face locations are reused
+      * small changes    -> detection runs only on the changed regions and
+                            cached faces elsewhere are kept
+      * large changes    -> the whole frame is detected
+
+    A full detection is forced every `refresh_interval` seconds so the cache
+    can never go stale for long.
+    """
+
+    def __init__(
+        self,
+        thumbnail_width: int = 160,
+        pixel_threshold: int = 25,
+        min_changed_fraction: float = 0.002,
+        max_region_fraction: float = 0.5,
+        region_padding: float = 0.25,
+        refresh_interval: float = 2.0,
+    ):
+        self.thumbnail_width = thumbnail_width
+        self.pixel_threshold = pixel_threshold
+        self.min_changed_fraction = min_changed_fraction
+        self.max_region_fraction = max_region_fraction
+        self.region_padding = region_padding
+        self.refresh_interval = refresh_interval
+        self._reference: Optional[np.ndarray] = None
+        self._locations: List[tuple] = []
+        self._detected_at = 0.0
+        self.skipped = 0
+        self.partial = 0
+        self.full = 0
+
+    def detect(
+        self,
+        frame: np.ndarray,
+        detect_fn: Callable[[np.ndarray], List[tuple]],
+        now: Optional[float] = None,
+    ) -> List[tuple]:
+        """Face locations in frame, calling detect_fn only where needed"""
+        now = time.monotonic() if now is None else now
+        thumbnail = self._thumbnail(frame)
+        if (
+            self._reference is None
+            or self._reference.shape != thumbnail.shape
+            or now - self._detected_at >= self.refresh_interval
+        ):
+            return self._detect_full(frame, thumbnail, detect_fn, now)
+
+        regions = self.changed_regions(thumbnail, frame.shape)
+        if not regions:
+            self.skipped += 1
+            return list(self._locations)
+
+        height, width = frame.shape[:2]
+        area = sum((b - t) * (r - l) for t, r, b, l in regions)
+        if area > self.max_region_fraction * height * width:
+            return self._detect_full(frame, thumbnail, detect_fn, now)
+
+        # Keep cached faces clear of every changed region, re-detect the rest
+        locations = [
+            location
+            for location in self._locations
+            if not any(_overlaps(location, region) for region in regions)
+        ]
+        for top, right, bottom, left in regions:
+            for t, r, b, l in detect_fn(frame[top:bottom, left:right]):
+                locations.append((t + top, r + left, b + top, l + left))
+        self.partial += 1
+        self._locations = locations
+        # The reference only moves where we looked, so update it there
+        self._update_reference(thumbnail, regions, frame.shape)
+        return list(locations)
+
+    def changed_regions(self, thumbnail: np.ndarray, shape: tuple) -> List[tuple]:
+        """Padded (top, right, bottom, left) full-resolution boxes of changes"""
+        diff = cv2.absdiff(thumbnail, self._reference)
+        mask = (diff > self.pixel_threshold).astype(np.uint8)
+        if mask.mean() < self.min_changed_fraction:
+            return []
+        mask = cv2.dilate(mask, np.ones((5, 5), np.uint8))
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+        height, width = shape[:2]
+        scale = width / thumbnail.shape[1]
+        regions = []
+        for x, y, w, h, _ in stats[1:count]:
+            pad_x = w * self.region_padding
+            pad_y = h * self.region_padding
+            regions.append(
+                (
+                    max(0, int((y - pad_y) * scale)),
+                    min(width, int((x + w + pad_x) * scale)),
+                    min(height, int((y + h + pad_y) * scale)),
+                    max(0, int((x - pad_x) * scale)),
+                )
+            )
+        return regions
+
+    def stats(self) -> dict:
+        return {
+            "skipped_detections": self.skipped,
+            "partial_detections": self.partial,
+            "full_detections": self.full,
+        }
+
+    def _detect_full(self, frame, thumbnail, detect_fn, now) -> List[tuple]:
+        self._locations = list(detect_fn(frame))
+        self._reference = thumbnail
+        self._detected_at = now
+        self.full += 1
+        return list(self._locations)
+
+    def _update_reference(self, thumbnail: np.ndarray, regions, shape: tuple):
+        scale = thumbnail.shape[1] / shape[1]
+        for top, right, bottom, left in regions:
+            t, b = int(top * scale), int(np.ceil(bottom * scale))
+            l, r = int(left * scale), int(np.ceil(right * scale))
+            self._reference[t:b, l:r] = thumbnail[t:b, l:r]
+
+    def _thumbnail(self, frame: np.ndarray) -> np.ndarray:
+        height, width = frame.shape[:2]
+        size = (
+            self.thumbnail_width,
+            max(1, round(height * self.thumbnail_width / width)),
+        )
+        gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        small = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+        # Blur away sensor noise and compression artefacts
+        return cv2.GaussianBlur(small, (5, 5), 0)
+
+
+def _overlaps(a: tuple, b: tuple) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[3] < b[1] and b[3] < a[1]
@@ -0,0 +1,116 @@
+import asyncio
+import time
+from typing import Optional
+
+
+class LatestFrameSlot:
+    """Single-slot mailbox that only ever holds a stream's freshest frame.
+
+    The receiver overwrites the slot as frames arrive and the processor takes
+    whatever is newest, so when inference is slower than the camera, stale
+    frames are dropped (and counted) instead of queueing up.
+    `frame_interval` is a moving average of the time between frames taken
+    for processing, i.e. the inverse of the processed frame rate.
+    """
+
+    def __init__(self, smoothing: float = 0.2):
+        self._frame: Optional[bytes] = None
+        self._ready = asyncio.Event()
+        self._closed = False
+        self.smoothing = smoothing
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.frame_interval: Optional[float] = None
+        self._taken_at: Optional[float] = None
+
+    def put(self, frame: bytes):
+        """Store a frame, replacing any frame not yet processed"""
+        if self._frame is not None:
+            self.dropped += 1
+        self._frame = frame
+        self.received += 1
+        self._ready.set()
+
+    async def get(self) -> Optional[bytes]:
+        """Wait for the next frame. Returns None once closed and drained."""
+        while self._frame is None:
+            if self._closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        frame, self._frame = self._frame, None
+        self.processed += 1
+        now = time.monotonic()
+        if self._taken_at is not None:
+            interval = now - self._taken_at
+            if self.frame_interval is None:
+                self.frame_interval = interval
+            else:
+                self.frame_interval += self.smoothing * (
+                    interval - self.frame_interval
+                )
+        self._taken_at = now
+        return frame
+
+    def close(self):
+        self._closed = True
+        self._ready.set()
+
+    def stats(self) -> dict:
+        return {
+            "received_frames": self.received,
+            "processed_frames": self.processed,
+            "dropped_frames": self.dropped,
+        }
+
+
+class FrameRateController:
+    """Suggests a client frame rate from measured processing time.
+
+    Tracks an exponential moving average of per-frame processing time and
+    targets `headroom` of the rate the service can sustain, clamped to
+    [min_fps, max_fps]. `should_notify` reports when the target has moved
+    enough to be worth telling the client.
+    """
+
+    def __init__(
+        self,
+        min_fps: float = 1.0,
+        max_fps: float = 15.0,
+        headroom: float = 0.8,
+        smoothing: float = 0.2,
+        notify_change: float = 0.2,
+    ):
+        self.min_fps = min_fps
+        self.max_fps = max_fps
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.notify_change = notify_change
+        self.avg_processing_time: Optional[float] = None
+        self._notified_fps: Optional[float] = None
+
+    def record(self, seconds: float):
+        """Record how long one frame took to process"""
+        if self.avg_processing_time is None:
+            self.avg_processing_time = seconds
+        else:
+            self.avg_processing_time += self.smoothing * (
+                seconds - self.avg_processing_time
+            )
+
+    @property
+    def target_fps(self) -> float:
+        if not self.avg_processing_time:
+            return self.max_fps
+        fps = self.headroom / self.avg_processing_time
+        return max(self.min_fps, min(self.max_fps, fps))
+
+    def should_notify(self) -> bool:
+        """True when the target moved by more than notify_change since last sent"""
+        target = self.target_fps
+        last = self._notified_fps
+        if last is None or abs(target - last) > self.notify_change * last:
+            self._notified_fps = target
+            return True
+        return False
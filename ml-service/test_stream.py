@@ -1,56 +1,38 @@
 import cv2
-import numpy as np
 import asyncio
-import websockets
-import json
 import base64
 from datetime import datetime
 import os
 from dotenv import load_dotenv
-from services.face_recognition import FaceRecognitionService
+from services.face_recognition import (
+    GALLERY_DIR,
+    INDEX_PATH,
+    LEGACY_ENCODINGS_PATH,
+    get_face_recognition_service,
+)
+from services.face_tracker import FaceTracker
+from services.motion_gate import MotionGate
+from services.checkin_dispatcher import create_checkin_dispatcher
 import requests
 import time
 import random
 import string
-import face_recognition
 
 load_dotenv()
 
-FACE_ENCODINGS_PATH = "data/face_encodings.json"
+FACE_ENCODINGS_PATH = LEGACY_ENCODINGS_PATH
 
 
-def load_face_encodings():
-    if os.path.exists(FACE_ENCODINGS_PATH):
-        with open(FACE_ENCODINGS_PATH, "r") as f:
-            data = json.load(f)
-            encodings = data.get("encodings", {})
-            known_face_encodings = [np.array(v) for v in encodings.values()]
-            known_face_ids = list(encodings.keys())
-            return encodings, known_face_encodings, known_face_ids
-    return {}, [], []
-
-
-def save_face_encodings(encodings):
-    os.makedirs("data", exist_ok=True)
-    with open(FACE_ENCODINGS_PATH, "w") as f:
-        json.dump({"encodings": encodings}, f)
-
-
-# Initialize face recognition service
-face_service = FaceRecognitionService()
-# Load persistent encodings
-(
-    face_service.face_encodings,
-    face_service.known_face_encodings,
-    face_service.known_face_ids,
-) = load_face_encodings()
-print("Loaded users:", face_service.known_face_ids)
+# Initialize face recognition service (loads persistent encodings)
+face_service = get_face_recognition_service()
+print("Loaded users:", face_service.gallery.ids)
 
 # Test configuration
 STREAM_ID = "test_stream"
 LOCATION = "test_location"
 SESSION_ID = "test_session"
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:3000")
+checkins = create_checkin_dispatcher(BACKEND_URL)
 
 
 async def process_frame(frame):
@@ -62,36 +44,30 @@ async def process_frame(frame):
     # Detect faces
     face_locations = face_service.detect_faces(rgb_frame)
 
+    # Encode and match every face in the frame as one batch
+    try:
+        results = face_service.identify_batch([rgb_frame], [face_locations])[0]
+    except Exception as e:
+        print(f"Verification error: {e}")
+        results = [None] * len(face_locations)
+
     # Process each face
-    for face_location in face_locations:
+    for face_location, result in zip(face_locations, results):
         # Draw rectangle around face
         top, right, bottom, left = face_location
         cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
 
-        # Crop the face region
-        face_image = rgb_frame[top:bottom, left:right]
-        # Encode the face region as JPEG
-        _, buffer = cv2.imencode(".jpg", cv2.cvtColor(face_image, cv2.COLOR_RGB2BGR))
-        face_base64 = base64.b64encode(buffer).decode("utf-8")
-
-        # Try to match against all registered users
-        try:
-            # If no known faces, skip
-            if not face_service.known_face_encodings:
-                text = "No faces registered"
-                color = (0, 0, 255)
-            else:
-                # Use a dummy user_id (will be ignored in is_match logic)
-                result = await face_service.verify_face(face_base64, "dummy")
-        if result["match"]:
-                    text = f"Match: {result['face_id']} ({result['confidence']:.2f})"
-                    color = (0, 255, 0)
+        if result is None:
+            text = "Error"
+            color = (0, 0, 255)
+        elif not len(face_service.gallery):
+            text = "No faces registered"
+            color = (0, 0, 255)
+        elif result["match"]:
+            text = f"Match: {result['user_id']} ({result['confidence']:.2f})"
+            color = (0, 255, 0)
         else:
             text = "No Match"
-                    color = (0, 0, 255)
-        except Exception as e:
-            print(f"Verification error: {e}")
-            text = "Error"
             color = (0, 0, 255)
 
         cv2.putText(
@@ -99,25 +75,16 @@ async def process_frame(frame):
         )
 
         # If face is verified, send check-in to backend
-        if "result" in locals() and result.get("match"):
-            try:
-                async with websockets.connect(f"{BACKEND_URL}/ws") as websocket:
-                    await websocket.send(
-                        json.dumps(
-                            {
-                                "type": "check_in",
-                                "data": {
-                                    "studentId": result["face_id"],
-                                    "sessionId": SESSION_ID,
-                                    "location": LOCATION,
-                                    "confidence": result["confidence"],
-                                    "timestamp": datetime.now().isoformat(),
-                                },
-                            }
-                        )
-                    )
-            except Exception as e:
-                print(f"Failed to send check-in: {e}")
+        if result is not None and result["match"]:
+            checkins.submit(
+                {
+                    "studentId": result["user_id"],
+                    "sessionId": SESSION_ID,
+                    "location": LOCATION,
+                    "confidence": result["confidence"],
+                    "timestamp": datetime.now().isoformat(),
+                }
+            )
 
     return frame
 
@@ -264,24 +231,16 @@ async def registration_mode():
                 quality = face_service.compute_face_quality(rgb_frame)
                 is_duplicate = False
                 matched_user_id = None
-                if face_service.known_face_encodings:
-                    import numpy as np
-
-                    face_distances = face_recognition.face_distance(
-                        face_service.known_face_encodings, face_encoding
-                    )
-                    best_match_index = int(np.argmin(face_distances))
-                    best_match_distance = face_distances[best_match_index]
+                matches = face_service.index.search(face_encoding, k=1)
+                if matches:
+                    best_match_id, best_match_distance = matches[0]
                     if best_match_distance < 0.3:
                         is_duplicate = True
-                        matched_user_id = face_service.known_face_ids[best_match_index]
+                        matched_user_id = best_match_id
                         prev_quality = 100  # Simulate previous quality as 100
                         if quality["score"] > prev_quality:
                             # Overwrite with better quality
-                            face_service.face_encodings[matched_user_id] = (
-                                face_encoding.tolist()
-                            )
-                            save_face_encodings(face_service.face_encodings)
+                            face_service.store_face(matched_user_id, face_encoding)
                             confirm_message = f"Face updated for user {matched_user_id} (better quality)."
                         else:
                             confirm_message = f"Face already registered for user {matched_user_id} with equal or better quality."
@@ -291,12 +250,9 @@ async def registration_mode():
                     # Generate a unique matric number
                     while True:
                         user_id = generate_user_id()
-                        if user_id not in face_service.face_encodings:
+                        if user_id not in face_service.gallery:
                             break
-                    face_service.face_encodings[user_id] = face_encoding.tolist()
-                    face_service.known_face_encodings.append(face_encoding)
-                    face_service.known_face_ids.append(user_id)
-                    save_face_encodings(face_service.face_encodings)
+                    face_service.store_face(user_id, face_encoding)
                     confirm_message = f"Face registered for user: {user_id}"
                     confirm_time = time.time()
                     print(confirm_message)
@@ -319,6 +275,8 @@ async def recognition_mode():
     show_payload_info = False
     recognized_counter = {}
     already_checked_in = set()
+    tracker = FaceTracker()
+    motion_gate = MotionGate()
     frame_count = 0
     total_time = 0
     start_time = time.time()
@@ -329,33 +287,35 @@ async def recognition_mode():
             print("Error: Could not read frame")
             break
         rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        face_locations = face_service.detect_faces(rgb_frame)
-        for face_location in face_locations:
+        # Only re-detect when something in view has moved
+        face_locations = motion_gate.detect(rgb_frame, face_service.detect_faces)
+        tracks = tracker.update(face_locations)
+        for face_location, track in zip(face_locations, tracks):
             top, right, bottom, left = face_location
             cv2.rectangle(frame, (left, top), (right, bottom), (0, 255, 0), 2)
-            face_image = rgb_frame[top:bottom, left:right]
-            _, buffer = cv2.imencode(
-                ".jpg", cv2.cvtColor(face_image, cv2.COLOR_RGB2BGR)
-            )
-            face_base64 = base64.b64encode(buffer).decode("utf-8")
             try:
-                if not face_service.known_face_encodings:
+                if not len(face_service.gallery):
                     text = "No faces registered"
                     color = (0, 0, 255)
                 else:
-                    # Recognition logic: match against any user
-                    face_encoding = face_service.get_face_encoding(
-                        rgb_frame, face_location
+                    # Recognition logic: match against any user, reusing the
+                    # track's cached identity until it is due for re-checking.
+                    # Matches not yet checked in are retried often so the
+                    # debounce below sees independent recognitions
+                    pending = bool(
+                        track.identity
+                        and track.identity[1] < 0.3
+                        and track.identity[0] not in already_checked_in
                     )
-                    import numpy as np
-
-                    face_distances = face_recognition.face_distance(
-                        face_service.known_face_encodings, face_encoding
-                    )
-                    best_match_index = int(np.argmin(face_distances))
-                    best_match_distance = face_distances[best_match_index]
+                    fresh = tracker.needs_identification(track, pending=pending)
+                    if fresh:
+                        face_encoding = face_service.get_face_encoding(
+                            rgb_frame, face_location
+                        )
+                        match = face_service.index.search(face_encoding, k=1)[0]
+                        tracker.set_identity(track, match, 1 - match[1])
+                    matched_user_id, best_match_distance = track.identity
                     if best_match_distance < 0.3:
-                        matched_user_id = face_service.known_face_ids[best_match_index]
                         text = f"Match: {matched_user_id} (distance: {best_match_distance:.2f})"
                         color = (0, 255, 0)
                         # Info overlay for payload
@@ -381,9 +341,11 @@ async def recognition_mode():
                                     (255, 255, 0),
                                     1,
                                 )
-                        # Count consecutive recognitions
+                        # Count consecutive recognitions; a cached identity
+                        # would only repeat the last one
                         recognized_counter.setdefault(matched_user_id, 0)
-                        recognized_counter[matched_user_id] += 1
+                        if fresh:
+                            recognized_counter[matched_user_id] += 1
                         # Simulate backend call only once per user per session
                         if (
                             recognized_counter[matched_user_id] == 10
@@ -464,12 +426,20 @@ async def recognition_mode():
 
 def clear_face_encodings():
     import os
-
-    if os.path.exists(FACE_ENCODINGS_PATH):
-        os.remove(FACE_ENCODINGS_PATH)
-        print(f"{FACE_ENCODINGS_PATH} has been deleted. You can now re-register faces.")
+    import shutil
+
+    removed = False
+    for path in (FACE_ENCODINGS_PATH, INDEX_PATH):
+        if os.path.exists(path):
+            os.remove(path)
+            removed = True
+    if os.path.isdir(GALLERY_DIR):
+        shutil.rmtree(GALLERY_DIR)
+        removed = True
+    if removed:
+        print("Face gallery has been deleted. You can now re-register faces.")
     else:
-        print(f"{FACE_ENCODINGS_PATH} does not exist.")
+        print("Face gallery does not exist.")
 
 
 async def main():
@@ -483,6 +453,7 @@ async def main():
         await recognition_mode()
     else:
         print("Invalid selection. Exiting.")
+    await checkins.stop()
 
 
 if __name__ == "__main__":
@@ -491,4 +462,4 @@ if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "clear_db":
         clear_face_encodings()
     else:
-    asyncio.run(main())
+        asyncio.run(main())
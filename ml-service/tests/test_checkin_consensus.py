@@ -0,0 +1,52 @@
+import pytest
+
+from services.checkin_consensus import CheckinConsensus
+from services.face_tracker import FaceTracker
+
+LOCATION = (100, 200, 200, 100)
+MATCH = {"match": True, "user_id": "student-1", "confidence": 0.9}
+
+
+def seconds_to_check_in(fps: float, duration: float = 30.0):
+    """Feed one steady face through the tracker into consensus, like a stream
+    processing `fps` frames a second does, and return when it checked in"""
+    tracker = FaceTracker()
+    consensus = CheckinConsensus()
+    frame_interval = 1.0 / fps
+    hit_interval = tracker.retry_spacing(frame_interval)
+    for frame in range(int(duration * fps)):
+        now = frame * frame_interval
+        (track,) = tracker.update([LOCATION], now=now)
+        pending = bool(
+            track.identity
+            and not consensus.is_checked_in("session", MATCH["user_id"])
+        )
+        if not tracker.needs_identification(track, now=now, pending=pending):
+            continue
+        tracker.set_identity(track, MATCH, MATCH["confidence"], now=now)
+        if consensus.observe(
+            "session", MATCH["user_id"], now=now, hit_interval=hit_interval
+        ):
+            return now
+    return None
+
+
+@pytest.mark.parametrize("fps", [1.0, 1.25, 1.5, 2.5, 5.0, 15.0])
+def test_slow_streams_still_check_in(fps):
+    checked_in_at = seconds_to_check_in(fps)
+    assert checked_in_at is not None
+    assert checked_in_at <= CheckinConsensus().max_window
+
+
+def test_one_fps_checks_in_after_min_hits_frames():
+    # Every frame is a fresh match at 1 fps, so the fifth frame confirms
+    assert seconds_to_check_in(1.0) == pytest.approx(4.0)
+
+
+def test_sparse_matches_do_not_check_in():
+    consensus = CheckinConsensus()
+    # Five matches, but far further apart than the stream's frame rate allows
+    for i in range(5):
+        assert not consensus.observe(
+            "session", "student-1", now=i * 10.0, hit_interval=1.0
+        )